@@ -0,0 +1,68 @@
+''' Shared helpers for the benchmarks. They run offline against in-process stand-ins, nothing here needs a server '''
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+from odim.helper import configure_databases as configure  # noqa: F401, re-exported for the benchmark scripts
+
+
+def environment():
+  ''' What a result depends on besides the code, stored with the results so that runs stay comparable '''
+  import pydantic
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)),
+                            capture_output=True, text=True, timeout=5).stdout.strip() or None
+  except Exception:
+    commit = None
+  return {"python" : platform.python_version(),
+          "implementation" : platform.python_implementation(),
+          "platform" : platform.platform(),
+          "pydantic" : pydantic.VERSION,
+          "commit" : commit}
+
+
+def percentile(samples, p):
+  if not samples:
+    return 0.0
+  s = sorted(samples)
+  k = min(len(s)-1, max(0, int(round(p/100.0*(len(s)-1)))))
+  return s[k]
+
+
+def summarize(samples):
+  ''' Latency summary in milliseconds '''
+  return {"count" : len(samples),
+          "mean" : 1000*sum(samples)/len(samples) if samples else 0.0,
+          "p50" : 1000*percentile(samples, 50),
+          "p95" : 1000*percentile(samples, 95),
+          "p99" : 1000*percentile(samples, 99)}
+
+
+class SlowCollection(object):
+  ''' Wraps a mongomock collection and blocks for `latency` seconds on every call, imitating a pymongo round trip '''
+
+  def __init__(self, collection, latency):
+    self.collection = collection
+    self.latency = latency
+
+  def __getattr__(self, name):
+    attr = getattr(self.collection, name)
+    if not callable(attr):
+      return attr
+    def call(*args, **kwargs):
+      time.sleep(self.latency)
+      return attr(*args, **kwargs)
+    return call
+
+
+class SlowDatabase(object):
+  def __init__(self, db, latency):
+    self.db = db
+    self.latency = latency
+
+  def __getitem__(self, name):
+    return SlowCollection(self.db[name], self.latency)
@@ -0,0 +1,62 @@
+''' Compares two JSON outputs of the same benchmark, e.g. before and after an upgrade. The timings (us_per_op,
+us_per_row, ms, mean, p50, p95, p99) of the second run are set against the first, lower being better. Exits with 1
+when one got slower by more than --threshold percent, so it can gate CI.
+
+  python benchmarks/compare.py before.json after.json --threshold 10
+'''
+import argparse
+import json
+import sys
+
+TIMINGS = ("us_per_op", "us_per_row", "ms", "mean", "p50", "p95", "p99")
+
+
+def timings(results, prefix=""):
+  ''' Flattens the nested results into {"name.metric" : value} for the timing metrics '''
+  out = {}
+  for k, v in results.items():
+    if isinstance(v, dict):
+      out.update(timings(v, prefix+k+"."))
+    elif k in TIMINGS and isinstance(v, (int, float)):
+      out[prefix+k] = v
+  return out
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("baseline")
+  parser.add_argument("current")
+  parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent")
+  args = parser.parse_args()
+
+  with open(args.baseline) as f:
+    baseline = json.load(f)
+  with open(args.current) as f:
+    current = json.load(f)
+  if baseline.get("benchmark") != current.get("benchmark"):
+    sys.exit("The files hold different benchmarks: %s and %s" % (baseline.get("benchmark"), current.get("benchmark")))
+  for k in ("python", "pydantic", "platform"):
+    if baseline.get("environment", {}).get(k) != current.get("environment", {}).get(k):
+      print("warning: %s differs (%s vs %s), the runs are not fully comparable" % (k, baseline.get("environment", {}).get(k), current.get("environment", {}).get(k)))
+
+  before, after = timings(baseline["results"]), timings(current["results"])
+  regressions = 0
+  width = max([ len(k) for k in after ] + [10])
+  print("%-*s %12s %12s %8s" % (width, "metric", "before", "after", "change"))
+  for k in sorted(after):
+    if k not in before:
+      print("%-*s %12s %12.3f %8s" % (width, k, "-", after[k], "new"))
+      continue
+    change = 100.0*(after[k]-before[k])/before[k] if before[k] else 0.0
+    flag = ""
+    if change > args.threshold:
+      flag = "  SLOWER"
+      regressions+= 1
+    print("%-*s %12.3f %12.3f %+7.1f%%%s" % (width, k, before[k], after[k], change, flag))
+  if regressions:
+    print("%d metric(s) slower by more than %.0f%%" % (regressions, args.threshold))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
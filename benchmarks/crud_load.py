@@ -0,0 +1,179 @@
+''' Throughput and tail latency of the OdimRouter.mount_crud endpoints under concurrent load. The routes are mounted
+on an in-process FastAPI app driven through httpx's ASGI transport, so nothing leaves the process: every request goes
+through routing, validation, extend_query callables, Odim and serialization, with the database being mongomock
+(optionally slowed down by --latency per call to imitate round trips).
+
+  python benchmarks/crud_load.py --concurrency 20 --duration 10
+  python benchmarks/crud_load.py --mix get=8,search=2 --driver executor --latency 2
+  python benchmarks/crud_load.py --identity-map --server-timing --total estimated
+
+Reports req/s and latency percentiles per route as JSON, comparable with benchmarks/compare.py.
+'''
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List, Optional
+
+from common import SlowDatabase, configure, environment, summarize
+
+from odim.helper import register_connection
+from odim.mongo import BaseMongoModel
+from odim.router import OdimRouter
+
+ROUTES = ("create", "get", "search", "save", "update", "delete")
+
+
+class Item(BaseMongoModel):
+  name : str
+  value : Optional[int]
+  tags : List[str] = []
+  tenant : Optional[str]
+
+  class Config:
+    db_name = "bench"
+    collection_name = "items"
+
+
+def tenant_of(request):
+  return request.headers.get("x-tenant", "t0")
+
+
+def parse_mix(mix : str) -> dict:
+  ''' "get=5,search=2" as route weights '''
+  weights = {}
+  for part in mix.split(","):
+    route, _, weight = part.partition("=")
+    if route not in ROUTES:
+      raise SystemExit("Unknown route '%s' in --mix, use %s" % (route, ", ".join(ROUTES)))
+    weights[route] = float(weight or 1)
+  return weights
+
+
+def build_app(args):
+  import fastapi
+  app = fastapi.FastAPI()
+  router = OdimRouter()
+  router.mount_crud("/items/", model=Item, extend_query={"tenant" : tenant_of}, total=args.total,
+                    identity_map=args.identity_map, server_timing=args.server_timing)
+  app.include_router(router)
+  return app
+
+
+class Workload(object):
+  ''' Picks the next request by the mix weights, keeping track of the ids created per tenant '''
+
+  def __init__(self, weights : dict, tenants : int, seed : int):
+    self.routes = list(weights.keys())
+    self.weights = list(weights.values())
+    self.tenants = [ "t%d" % i for i in range(tenants) ]
+    self.ids = { t : [] for t in self.tenants }
+    self.random = random.Random(seed)
+
+  def body(self, i : int, tenant : str):
+    # PUT replaces the whole document, the tenant has to stay in it for the extend_query of later requests
+    return {"name" : "item%d" % i, "value" : i, "tags" : ["a", "b"], "tenant" : tenant}
+
+  def next(self, i : int):
+    ''' (route label, method, url, json body, tenant) of the next request '''
+    route = self.random.choices(self.routes, self.weights)[0]
+    tenant = self.random.choice(self.tenants)
+    ids = self.ids[tenant]
+    if route != "search" and route != "create" and not ids:
+      route = "create"
+    if route == "create":
+      return "POST /items/", "POST", "/items/", self.body(i, tenant), tenant
+    if route == "search":
+      return "GET /items/", "GET", "/items/?limit=20&sort=-value&q=" + json.dumps({"value__gte" : self.random.randint(0, 100)}), None, tenant
+    if route == "delete":
+      id = ids.pop(self.random.randrange(len(ids)))
+      return "DELETE /items/{id}", "DELETE", "/items/"+id, None, tenant
+    id = self.random.choice(ids)
+    if route == "get":
+      return "GET /items/{id}", "GET", "/items/"+id, None, tenant
+    if route == "save":
+      return "PUT /items/{id}", "PUT", "/items/"+id, self.body(i, tenant), tenant
+    return "PATCH /items/{id}", "PATCH", "/items/"+id, {"name" : "renamed%d" % i}, tenant
+
+
+async def run(args):
+  import httpx
+  import mongomock
+  configure({"bench" : "mongodb://localhost/bench?driver=" + args.driver})
+  db = mongomock.MongoClient()["bench"]
+  register_connection("bench", SlowDatabase(db, args.latency/1000.0) if args.latency else db)
+  workload = Workload(parse_mix(args.mix), args.tenants, args.seed)
+  app = build_app(args)
+  samples = {}
+  errors = {}
+  counter = iter(range(10**12))
+
+  async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app, raise_app_exceptions=False), base_url="http://bench") as client:
+
+    async def request(record : bool):
+      i = next(counter)
+      label, method, url, body, tenant = workload.next(i)
+      start = time.perf_counter()
+      rsp = await client.request(method, url, json=body, headers={"x-tenant" : tenant})
+      elapsed = time.perf_counter()-start
+      if label == "POST /items/" and rsp.status_code == 201:
+        workload.ids[tenant].append(rsp.json()["_id"])
+      if not record:
+        return
+      samples.setdefault(label, []).append(elapsed)
+      if rsp.status_code >= 400:
+        errors[label] = errors.get(label, 0)+1
+
+    # seed every tenant, then warm up the routes without recording
+    for _ in range(args.seed_items):
+      for t in workload.tenants:
+        rsp = await client.post("/items/", json=workload.body(next(counter), t), headers={"x-tenant" : t})
+        workload.ids[t].append(rsp.json()["_id"])
+    for _ in range(args.warmup):
+      await request(False)
+
+    deadline = time.perf_counter()+args.duration
+    async def worker():
+      while time.perf_counter() < deadline:
+        await request(True)
+    started = time.perf_counter()
+    await asyncio.gather(*[ worker() for _ in range(args.concurrency) ])
+    elapsed = time.perf_counter()-started
+
+  routes = {}
+  for label, s in sorted(samples.items()):
+    routes[label] = {**summarize(s), "rps" : len(s)/elapsed, "errors" : errors.get(label, 0)}
+  total = sum( len(s) for s in samples.values() )
+  return {"requests" : total, "rps" : total/elapsed, "errors" : sum(errors.values()), "seconds" : elapsed,
+          "all" : summarize([ x for s in samples.values() for x in s ]), "routes" : routes}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--concurrency", type=int, default=10, help="requests in flight")
+  parser.add_argument("--duration", type=float, default=5, help="seconds of measured load")
+  parser.add_argument("--mix", default="create=1,get=6,search=3,save=1,update=1,delete=1", help="route weights")
+  parser.add_argument("--tenants", type=int, default=3, help="distinct extend_query tenants")
+  parser.add_argument("--seed-items", type=int, default=50, help="documents created per tenant before the run")
+  parser.add_argument("--warmup", type=int, default=100, help="unrecorded requests before the run")
+  parser.add_argument("--driver", default="sync", choices=("sync", "executor"))
+  parser.add_argument("--latency", type=float, default=0, help="simulated database round trip in ms")
+  parser.add_argument("--total", default="exact", choices=("exact", "estimated", "capped", "none"))
+  parser.add_argument("--identity-map", action="store_true")
+  parser.add_argument("--server-timing", action="store_true")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--output", default=None, help="also write the JSON to this file")
+  args = parser.parse_args()
+
+  results = asyncio.run(run(args))
+  config = { k : getattr(args, k) for k in ("concurrency", "duration", "mix", "tenants", "driver", "latency", "total", "identity_map", "server_timing") }
+  out = json.dumps({"benchmark" : "crud_load", "environment" : environment(), "config" : config, "results" : results}, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(out)
+  print(out)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,96 @@
+''' Cost of turning stored rows into model instances: find() with full pydantic validation against the trusted
+construct() path (Config.trusted_reads / trusted=True), with and without post_init hooks. The rows carry
+Decimal128, ObjectId and nested documents like real Mongo results; mongomock keeps it offline.
+
+  python benchmarks/hydration.py --rows 10000
+'''
+import argparse
+import asyncio
+import json
+import time
+from decimal import Decimal
+from typing import List, Optional
+
+from bson import Decimal128, ObjectId
+from pydantic import BaseModel
+
+from common import configure
+
+from odim import Odim, SearchParams
+from odim.helper import register_connection
+from odim.mongo import BaseMongoModel
+
+
+class Tag(BaseModel):
+  name : str
+  weight : Optional[float]
+
+
+class Item(BaseMongoModel):
+  name : str
+  value : Optional[int]
+  price : Optional[Decimal]
+  owner : Optional[ObjectId]
+  tags : List[Tag] = []
+  active : bool = True
+
+  class Config:
+    db_name = "bench"
+    collection_name = "items"
+
+
+class HookedItem(Item):
+  class Config:
+    db_name = "bench"
+    collection_name = "items"
+
+
+def post_init(cls, obj):
+  obj.name = obj.name.upper()
+  return obj
+
+
+async def timed(fnc, repeat):
+  best = None
+  for _ in range(repeat):
+    t = time.perf_counter()
+    rows = await fnc()
+    dur = time.perf_counter()-t
+    best = dur if best is None else min(best, dur)
+  return best, len(rows)
+
+
+def main():
+  import mongomock
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--rows", type=int, default=10000)
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  configure({"bench" : "mongodb://localhost/bench"})
+  db = mongomock.MongoClient()["bench"]
+  db["items"].insert_many([{"name" : "item%d" % i, "value" : i, "price" : Decimal128("%d.50" % i), "owner" : ObjectId(),
+                            "tags" : [{"name" : "t%d" % (i%7), "weight" : 0.5}], "active" : True}
+                           for i in range(args.rows)])
+  register_connection("bench", db)
+  HookedItem.add_hook("post_init", post_init)
+  params = SearchParams(limit=args.rows)
+
+  async def run():
+    # the collection scan is paid by both paths, measure it alone to get the hydration share
+    scan, _ = await timed(lambda: asyncio.sleep(0, list(db["items"].find({}).limit(args.rows))), args.repeat)
+    out = {"scan_only" : {"ms" : 1000*scan}}
+    for name, model, trusted in (("validated", Item, False),
+                                 ("trusted", Item, True),
+                                 ("validated_hooks", HookedItem, False),
+                                 ("trusted_hooks", HookedItem, True)):
+      dur, count = await timed(lambda: Odim(model).find({}, params, trusted=trusted), args.repeat)
+      out[name] = {"ms" : 1000*dur, "rows" : count, "us_per_row" : 1e6*(dur-scan)/max(1, count)}
+    return out
+
+  results = asyncio.run(run())
+  print(json.dumps({"benchmark" : "hydration", "rows" : args.rows, "results" : results}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,70 @@
+''' p50/p99 latency of concurrent Odim(Model).find() calls for each mongo driver.
+
+With the blocking "sync" driver every find() holds the event loop for the whole round trip, so latency grows with the
+number of parallel requests. The "executor" and "motor" drivers keep the loop free.
+
+  python benchmarks/mongo_concurrency.py --parallel 50 --latency 5
+  python benchmarks/mongo_concurrency.py --uri mongodb://localhost/bench   # real server, adds the motor driver
+'''
+import argparse
+import asyncio
+import json
+import time
+from typing import Optional
+
+from common import SlowDatabase, configure, summarize
+
+from odim import Odim
+from odim.helper import register_connection
+from odim.mongo import BaseMongoModel
+
+
+class Item(BaseMongoModel):
+  name : str
+  value : Optional[int]
+
+  class Config:
+    db_name = "bench"
+    collection_name = "items"
+
+
+async def run_driver(driver, args):
+  if args.uri:
+    configure({"bench" : args.uri + ("&" if "?" in args.uri else "?") + "driver=" + driver})
+  else:
+    import mongomock
+    configure({"bench" : "mongodb://localhost/bench?driver=" + driver})
+    db = mongomock.MongoClient()["bench"]
+    db["items"].insert_many([{"name" : "item%d" % i, "value" : i} for i in range(args.rows)])
+    register_connection("bench", SlowDatabase(db, args.latency/1000.0))
+
+  async def one(arrived):
+    # all requests of a round arrive together, latency is measured from their arrival
+    await Odim(Item).find({"value__lt" : args.rows})
+    return time.perf_counter() - arrived
+
+  samples = []
+  for _ in range(args.rounds):
+    arrived = time.perf_counter()
+    samples.extend(await asyncio.gather(*[one(arrived) for _ in range(args.parallel)]))
+  return summarize(samples)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--parallel", type=int, default=20, help="parallel find() calls per round")
+  parser.add_argument("--rounds", type=int, default=5)
+  parser.add_argument("--rows", type=int, default=20)
+  parser.add_argument("--latency", type=float, default=5, help="simulated round trip in ms (stand-in only)")
+  parser.add_argument("--uri", default=None, help="run against a real mongo server instead of the stand-in")
+  args = parser.parse_args()
+
+  drivers = ["sync", "executor"] + (["motor"] if args.uri else [])
+  out = {}
+  for driver in drivers:
+    out[driver] = asyncio.run(run_driver(driver, args))
+  print(json.dumps({"benchmark" : "mongo_concurrency", "parallel" : args.parallel, "results" : out}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,55 @@
+''' Overhead of constructing the Odim wrapper, Odim(Model) and Odim(instance), with the cached model binding and with
+the binding resolved from scratch on every call (the behaviour before the binding cache).
+
+  python benchmarks/odim_construction.py --number 100000
+'''
+import argparse
+import json
+import timeit
+from typing import Optional
+
+from common import configure
+
+from odim import Odim
+from odim.helper import invalidate_model_binding
+from odim.mongo import BaseMongoModel
+
+
+class Item(BaseMongoModel):
+  name : str
+  value : Optional[int]
+
+  class Config:
+    db_name = "bench"
+    collection_name = "items"
+    softdelete = "deleted"
+
+
+def construct_cold():
+  invalidate_model_binding(Item)
+  return Odim(Item).get_connection_identifier
+
+
+def construct_cached():
+  return Odim(Item).get_connection_identifier
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--number", type=int, default=20000)
+  args = parser.parse_args()
+  configure({"bench" : "mongodb://localhost/bench"})
+  item = Item(name="x", value=1)
+
+  out = {}
+  for name, fnc in (("class_cold", construct_cold),
+                    ("class_cached", construct_cached),
+                    ("instance_cached", lambda: Odim(item).get_connection_identifier)):
+    fnc()
+    best = min(timeit.repeat(fnc, number=args.number, repeat=5))
+    out[name] = {"us_per_call" : 1e6*best/args.number}
+  print(json.dumps({"benchmark" : "odim_construction", "number" : args.number, "results" : out}, indent=2))
+
+
+if __name__ == "__main__":
+  main()
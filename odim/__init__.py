@@ -2,6 +2,8 @@
  data on multiple sources '''
 import enum
 import inspect
+import time
+from collections import OrderedDict
 from enum import Enum
 from typing import Any, List, Optional, TypeVar, Union, Generic
 
@@ -9,10 +11,18 @@ from bson.objectid import ObjectId
 from pymysql import Timestamp
 from odim.helper import awaited
 
-from pydantic import BaseModel, Field, root_validator
+from pydantic import BaseModel, Field, PrivateAttr, root_validator
 from pydantic.generics import GenericModel
 from datetime import datetime
-from odim.helper import get_config, get_connection_info, get_connector_for_model
+from odim.helper import chunked, decode_cursor, encode_cursor, get_config, get_connection_info, get_model_binding, invalidate_model_binding
+from odim import cache as odim_cache
+from odim import references
+from odim.hydration import construct_trusted
+from odim.identity import get_identity_map, identity_map, identity_scope
+from odim.querylog import get_query_log, query_log, query_log_scope
+from odim.indexes import ensure_indexes, index_advisor
+from odim.metrics import current_span, instrumentation, instrumented
+from odim.transaction import Transaction, get_transaction, transaction
 
 
 all_json_encoders = {
@@ -22,11 +32,15 @@ all_json_encoders = {
 
 T = TypeVar('T')
 
+relevance_sort = "_score" # sort key ordering by the text search relevance, most relevant first
+
 class SearchParams(BaseModel):
   ''' Describes how to search the details '''
   offset : int = 0
   limit : int = 25
-  sort : Optional[str] = Field(default=None, description="Order by field list, separated by comma with - signifying descending order. e.g. name,-created_at  will order by name ASC and created_at DESC", regex="[,a-zA-Z0-9_-]*")
+  sort : Optional[str] = Field(default=None, description="Order by field list, separated by comma with - signifying descending order. e.g. name,-created_at  will order by name ASC and created_at DESC. _score orders by the text relevance of a __search", regex="[,a-zA-Z0-9_-]*")
+  after : Optional[str] = Field(default=None, description="Keyset pagination cursor, the next_cursor of the previous page. Replaces offset")
+  keyset : bool = Field(default=False, description="Paginate with next_cursor instead of offset, implied by after")
 
 class CachedTimestamps(GenericModel, Generic[T]):
   set : Timestamp = Field(description="Time when the results were cached")
@@ -34,9 +48,10 @@ class CachedTimestamps(GenericModel, Generic[T]):
 
 class SearchResponse(GenericModel, Generic[T]):
   search : dict = Field(description="The search data that was performed")
-  total : int =  Field(description="The total number of results")
+  total : Optional[int] =  Field(description="The total number of results. Depending on the endpoint it is exact, estimated, capped or not counted at all")
   results : List[T]
   cached : Optional[CachedTimestamps] = Field(description="Optional information if the results were cached.", default=False)
+  next_cursor : Optional[str] = Field(description="Pass as `after` to get the next page, missing on the last page", default=None)
 
   class Config:
     json_encoders = all_json_encoders
@@ -50,6 +65,8 @@ class Operation(Enum):
   exact = "__is"
   isnot = "__not"
   contains = "__contains"
+  startswith = "__startswith"
+  search = "__search"
   gt = "__gt"
   gte = "__gte"
   lt = "__lt"
@@ -64,6 +81,11 @@ def parse_fieldop(field):
 
 
 class BaseOdimModel(BaseModel):
+  _references : dict = PrivateAttr(default_factory=dict)
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    references.collect_references(cls)
 
   @root_validator(pre=True)
   def generic_validators_pre(cls, values):
@@ -86,13 +108,29 @@ class BaseOdimModel(BaseModel):
   async def update(self, *args, **kwargs):
     return await Odim(self).update(*args, **kwargs)
 
+  @classmethod
+  async def save_many(cls, *args, **kwargs):
+    return await Odim(cls).save_many(*args, **kwargs)
+
   async def delete(self, force_harddelete = False):
     return await Odim(self).delete(force_harddelete = force_harddelete)
 
+  @classmethod
+  async def update_many(cls, *args, **kwargs):
+    return await Odim(cls).update_many(*args, **kwargs)
+
+  @classmethod
+  async def delete_many(cls, *args, **kwargs):
+    return await Odim(cls).delete_many(*args, **kwargs)
+
   @classmethod
   async def find(cls, *args, **kwargs):
     return await Odim(cls).find(*args, **kwargs)
 
+  @classmethod
+  def iterate(cls, *args, **kwargs):
+    return Odim(cls).iterate(*args, **kwargs)
+
   @classmethod
   async def count(cls, *args, **kwargs):
     return await Odim(cls).count(*args, **kwargs)
@@ -101,6 +139,10 @@ class BaseOdimModel(BaseModel):
   async def get(cls, *args, **kwargs):
     return await Odim(cls).get(*args, **kwargs)
 
+  @classmethod
+  async def get_many(cls, *args, **kwargs):
+    return await Odim(cls).get_many(*args, **kwargs)
+
   @classmethod
   def add_hook(cls, hook_type, fnc):
     if not hasattr(cls, "Config"):
@@ -109,6 +151,13 @@ class BaseOdimModel(BaseModel):
       cls.Config.odim_hooks = {"pre_init":[], "post_init":[], "pre_save":[], "post_save":[],"pre_remove":[],"post_remove":[],"pre_validate":[],"post_validate":[]}
     if fnc not in cls.Config.odim_hooks[hook_type]:
       cls.Config.odim_hooks[hook_type].append(fnc)
+    invalidate_model_binding(cls)
+
+  def referenced(self, name : str):
+    ''' The document(s) referenced by the field, loaded by find(..., prefetch=[name]) '''
+    if name not in self._references:
+      raise AttributeError("Reference '%s' was not prefetched" % name)
+    return self._references[name]
 
   def __str__(self):
     if hasattr(self, 'id'):
@@ -120,6 +169,11 @@ class BaseOdimModel(BaseModel):
     return self.__str__()
 
 
+# LRU of the partial model classes, the field selections come from requests
+projected_models = OrderedDict()
+max_projected_models = 256
+
+
 class Odim(object):
   ''' Initiates the wrapper to communicate with backends based on the pydantic model Config metaclass '''
   protocols = []
@@ -127,7 +181,7 @@ class Odim(object):
   instance = None
 
   def __new__(cls, model):
-    odimclass = get_connector_for_model(model)
+    odimclass = get_model_binding(model).connector
     return super(Odim, cls).__new__(odimclass)
 
 
@@ -137,37 +191,124 @@ class Odim(object):
     else:
       self.model = model.__class__
       self.instance = model
+    self.binding = get_model_binding(self.model)
 
-  @property
-  def get_connection_identifier(self):
-    if hasattr(self.model, 'Config'):
-      if hasattr(self.model.Config, 'db_name'):
-        return self.model.Config.db_name
-      if hasattr(self.model.Config, 'db_uri'):
-        return self.model.Config.db_uri
+  @classmethod
+  def resolve_connection(cls, model):
+    ''' Finds the DATABASES alias the model is stored in, the result is cached on the model binding '''
+    if hasattr(model, 'Config'):
+      if hasattr(model.Config, 'db_name'):
+        return model.Config.db_name
+      if hasattr(model.Config, 'db_uri'):
+        return model.Config.db_uri
     for key in get_config('DATABASES', default={}).keys():
       cp = get_connection_info(key)
-      if cp.protocol in self.protocols:
+      if cp.protocol in cls.protocols:
         return key
     raise AttributeError("missing database definition")
 
+  @classmethod
+  def resolve_collection_name(cls, model):
+    return model.__class__.__name__
+
+  @property
+  def get_connection_identifier(self):
+    return self.binding.connection
+
   def softdelete(self):
-    if hasattr(self.model, 'Config') and hasattr(self.model.Config, 'softdelete'):
-      return getattr(self.model.Config,'softdelete')
+    return self.binding.softdelete
+
+  def get_hooks(self, hook_type):
+    return self.binding.hooks.get(hook_type, [])
 
   def execute_hooks(self, hook_type, obj, *args, **kwargs):
-    if hasattr(self.model, "Config") and hasattr(self.model.Config, "odim_hooks"):
-      for fnc in self.model.Config.odim_hooks.get(hook_type,[]):
-        obj2 = awaited(fnc(self.model, obj, *args, **kwargs))
-        if obj2!=None:
-          obj = obj2
+    ''' Runs the hooks synchronously, async hooks are resolved through awaited '''
+    for fnc in self.get_hooks(hook_type):
+      obj2 = awaited(fnc(self.model, obj, *args, **kwargs))
+      if obj2!=None:
+        obj = obj2
+    return obj
+
+  async def async_execute_hooks(self, hook_type, obj, *args, **kwargs):
+    ''' Runs the hooks from a coroutine, sync hooks are called inline and async ones awaited on the running loop '''
+    hooks = self.get_hooks(hook_type)
+    if not hooks:
+      return obj
+    span = current_span.get()
+    start = time.perf_counter() if span is not None else None
+    for fnc in hooks:
+      obj2 = fnc(self.model, obj, *args, **kwargs)
+      if inspect.isawaitable(obj2):
+        obj2 = await obj2
+      if obj2!=None:
+        obj = obj2
+    if start is not None:
+      span.hooks+= time.perf_counter()-start
     return obj
 
 
+  def hydrate(self, model, row : dict, trusted : Optional[bool] = None):
+    ''' Builds the instance from a stored row, validated or trusted (Config.trusted_reads or trusted=True) '''
+    if trusted is None:
+      trusted = self.binding.trusted_reads
+    span = current_span.get()
+    if span is None:
+      return construct_trusted(model, row) if trusted else model(**row)
+    start = time.perf_counter()
+    rsp = construct_trusted(model, row) if trusted else model(**row)
+    span.hydrate+= time.perf_counter()-start
+    return rsp
+
+
+  async def ensure_indexes(self) -> dict:
+    ''' Creates the indexes of Config.indexes missing in the database, see odim.indexes '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+
+  def record_query_shape(self, query : dict, params : SearchParams = None):
+    ''' Feeds the index advisor, when it is enabled '''
+    if index_advisor.enabled:
+      index_advisor.record(self, query, params)
+
+
+  async def invalidate_cache(self):
+    ''' Drops the cached find/count results of this model's collection/table '''
+    await odim_cache.invalidate(self.binding)
+
+
+  def lookup(self, id, *conditions):
+    ''' The instance of the active identity map, for plain gets only (none of the conditions set) '''
+    im = get_identity_map()
+    if im is None or any(conditions):
+      return None, None
+    return im, im.get(self.model, id)
+
+  def remember(self, obj):
+    ''' Maps the saved instance in the active identity map '''
+    im = get_identity_map()
+    if im is not None:
+      im.put(self.model, obj)
+
+  def remember_update(self, obj):
+    im = get_identity_map()
+    if im is not None:
+      im.update(self.model, obj)
+
+  def forget(self, id=None):
+    ''' Drops the deleted instance, or all instances of the model, from the active identity map '''
+    im = get_identity_map()
+    if im is None:
+      return
+    if id is None:
+      im.clear(self.model)
+    else:
+      im.discard(self.model, id)
+
+
   def has_hooks(self, *hook_types):
     ''' Whether there are hooks '''
     for hk in hook_types:
-      if hasattr(self.model, "Config") and hasattr(self.model.Config, "odim_hooks") and len(self.model.Config.odim_hooks.get(hk, []))>0:
+      if len(self.get_hooks(hk))>0:
         return True
     return False
 
@@ -177,21 +318,192 @@ class Odim(object):
     raise NotImplementedError("Method not implemented for this connector")
 
 
+  def get_transaction(self) -> Optional[Transaction]:
+    ''' The odim.transaction block open for this model's connection, writes are queued into it '''
+    return get_transaction(self.get_connection_identifier)
+
+  def new_id(self):
+    ''' Identifier for a new document when the connector generates them client side, None for database generated ids '''
+    return None
+
+  async def write_many(self, items : List[tuple], ordered : bool = False, extend_query : dict = {}, include_deleted : bool = False):
+    ''' Writes (instance, created) pairs that already went through the pre_save hooks in one bulk operation and sets
+    the ids of the created ones. Used by save_many and by transactions '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+  async def write_updates(self, items : List[tuple], extend_query : dict = {}, include_deleted : bool = False):
+    ''' Writes the set fields of (instance, only_fields) pairs that already went through the pre_save hooks '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+  async def write_deletes(self, ids : list, extend_query : dict = {}, softdelete : bool = False):
+    ''' Deletes (or marks soft deleted) the documents with these ids, without running hooks '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+  @classmethod
+  async def begin_transaction(cls, tx : Transaction):
+    ''' Opens the backend transaction of tx.alias and stores its connection/session in tx.handle '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+  @classmethod
+  async def commit_transaction(cls, tx : Transaction):
+    raise NotImplementedError("Method not implemented for this connector")
+
+  @classmethod
+  async def rollback_transaction(cls, tx : Transaction):
+    raise NotImplementedError("Method not implemented for this connector")
+
+
+  async def save_many(self, objs : List[BaseModel], ordered : bool = False, chunk_size : int = 1000, extend_query : dict = {}, include_deleted : bool = False) -> list:
+    ''' Saves many documents with one bulk round trip per chunk_size documents. New documents are inserted and get their
+    ids assigned, documents with an id replace the stored one within the extend_query/softdelete scope. pre_save hooks run for the chunk before it is written, post_save
+    hooks after it was written.
+    :param objs: instances of the model
+    :param ordered: stop at the first failing write instead of attempting all of them
+    :return: the ids in the order of objs '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+
   async def update(self, extend_query : dict= {}, include_deleted : bool = False, only_fields : Optional[List['str']] = None):
     ''' Saves only the changed fields leaving other fields alone '''
     raise NotImplementedError("Method not implemented for this connector")
 
 
-  async def get(self, id : str, extend_query : dict= {}, include_deleted : bool = False):
+  async def get(self, id : str, extend_query : dict= {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None):
     '''
     Retrieves the document by its id
     :param id: id of the docuemnt
     :param extend_query additional search limiters:
+    :param fields: fetch only these fields, the result is an instance of a partial clone of the model
+    :param exclude: fetch all fields but these
+    :param trusted: build the instance without validation, defaults to Config.trusted_reads
     :return: the document as pydantic instance
     '''
     raise NotImplementedError("Method not implemented for this connector")
 
 
+  @instrumented("get_many")
+  async def get_many(self, ids : list, extend_query : dict= {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None, chunk_size : int = 1000) -> "ManyResult":
+    '''
+    Retrieves the documents of many ids with one query ($in / IN) per chunk_size ids
+    :param ids: the ids, duplicates are fetched once
+    :return: the instances in the order of ids with None for the ids that were not found, which are listed in `missing`
+    '''
+    im = get_identity_map()
+    if any((extend_query, include_deleted, fields, exclude)):
+      im = None
+    found = {}
+    wanted = {}
+    for id in ids:
+      key = str(id)
+      if key in found or key in wanted:
+        continue
+      x = im.get(self.model, id) if im is not None else None
+      if x is not None:
+        found[key] = x
+      else:
+        wanted[key] = id
+    for chunk in chunked(list(wanted.values()), chunk_size):
+      for x in await self.fetch_ids(chunk, extend_query, include_deleted, fields, exclude, trusted):
+        found[str(x.id)] = x
+        if im is not None:
+          im.put(self.model, x)
+    rsp = ManyResult( found.get(str(id)) for id in ids )
+    rsp.missing = [ id for id in ids if str(id) not in found ]
+    return rsp
+
+
+  async def fetch_ids(self, ids : list, extend_query : dict= {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None) -> list:
+    ''' The instances (with init hooks) of the documents with these ids in one query, in no particular order '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+
+  id_field = "id"
+
+  def get_projected_model(self, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None):
+    ''' The model class holding only the requested fields (the id is always kept), cloned once per field selection '''
+    if not fields and not exclude:
+      return self.model
+    for f in list(fields or []) + list(exclude or []):
+      if f not in self.model.__fields__:
+        raise AttributeError("Unknown field '%s' for %s" % (f, self.model.__name__))
+    fields, exclude = sorted(set(fields or [])), sorted(set(exclude or []))
+    key = (self.model, tuple(fields), tuple(exclude))
+    m = projected_models.get(key)
+    if m is not None:
+      projected_models.move_to_end(key)
+      return m
+    from odim import dynmodels
+    from odim.model_factory import ModelFactory
+    keep = [ "id", *fields ] if fields else []
+    m = ModelFactory.clone(self.model, name=self.model.__name__+"Partial", fields=keep, exclude=[ f for f in exclude if f != "id" ])
+    projected_models[key] = m
+    while len(projected_models) > max_projected_models:
+      _, evicted = projected_models.popitem(last=False)
+      dynmodels.used_model_names.pop(evicted.__name__, None)
+      invalidate_model_binding(evicted)
+    return m
+
+
+  def get_projection(self, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None):
+    ''' Returns the model class to build the results from and the stored names of its fields to fetch, None meaning all '''
+    model = self.get_projected_model(fields, exclude)
+    if model is self.model:
+      return model, None
+    return model, [ f.alias for f in model.__fields__.values() ]
+
+
+  def is_keyset(self, params : SearchParams = None) -> bool:
+    ''' Whether the search pages with cursors, params.after given or params.keyset set for the first page '''
+    return bool(params) and bool(getattr(params, "after", None) or getattr(params, "keyset", False))
+
+
+  def get_sort(self, params : SearchParams = None) -> List[tuple]:
+    ''' The (field, descending) sort keys. For keyset pagination they end with the id so that the order is stable,
+    otherwise the id is left out so that an index on the sort fields alone serves the sort '''
+    sort = []
+    if params and params.sort not in (None, ''):
+      for so in params.sort.split(','):
+        if so[0] == "-":
+          sort.append( (so[1:], True) )
+        else:
+          sort.append( (so, False) )
+    if self.is_keyset(params) and self.id_field not in [f for f, _ in sort]:
+      sort.append( (self.id_field, False) )
+    return sort
+
+
+  def sorts_by_relevance(self, params : SearchParams = None) -> bool:
+    return any( f == relevance_sort for f, _ in self.get_sort(params) )
+
+
+  def get_sort_value(self, obj, field):
+    return getattr(obj, "id" if field == self.id_field else field, None)
+
+
+  def next_cursor(self, results : list, params : SearchParams = None) -> Optional[str]:
+    ''' The `after` token for the page following these results, None when there is no further page or the search
+    does not page with cursors (see is_keyset) '''
+    if not self.is_keyset(params) or not params.limit or len(results) < params.limit:
+      return None
+    if self.sorts_by_relevance(params):
+      return None
+    return encode_cursor([self.get_sort_value(results[-1], f) for f, _ in self.get_sort(params)])
+
+
+  def get_keyset_values(self, params : SearchParams = None) -> Optional[List[tuple]]:
+    ''' Pairs the sort keys with the values decoded from params.after as (field, descending, value) '''
+    after = getattr(params, "after", None) if params else None
+    if not after:
+      return None
+    if self.sorts_by_relevance(params):
+      raise ValueError("Keyset pagination is not available when sorting by relevance")
+    sort = self.get_sort(params)
+    values = decode_cursor(after)
+    if len(values) != len(sort):
+      raise ValueError("The pagination cursor does not match the sort order")
+    return [ (f, desc, v) for (f, desc), v in zip(sort, values) ]
+
+
   def parse_query_operations(self, query : dict):
     ''' Gets the normalized search operations from the query fields '''
     rsp = {}
@@ -201,32 +513,92 @@ class Odim(object):
     return rsp
 
 
-  async def find(self, query : dict, params : SearchParams = None, include_deleted : bool = False):
+  async def find(self, query : dict, params : SearchParams = None, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None, prefetch : Optional[List[str]] = None):
     ''' Performs search using a dictionary qury to find documents on that particular collection/table
     :param query: dictionary of field:value pairs
-    :param params: additional search params like ordering and limit offset
+    :param params: additional search params like ordering and limit offset, or params.after for keyset pagination
+    :param fields: fetch only these fields (Mongo projection / SQL column list), results are partial clones of the model
+    :param exclude: fetch all fields but these
+    :param trusted: build the instances without validation (see odim.hydration), defaults to Config.trusted_reads
+    :param prefetch: reference fields whose documents are loaded for the whole page (see odim.references)
+    :param cache_ttl: (keyword) serve the results from the result cache for this many seconds, defaults to Config.cache_ttl
     :return: the list of documents as per pydantic type    '''
     raise NotImplementedError("Method not implemented for this connector")
 
 
-  async def count(self, query : dict, include_deleted : bool = False) -> int:
+  async def iterate(self, query : dict, params : SearchParams = None, include_deleted : bool = False, batch_size : int = 100, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None):
+    ''' Async generator over the search results, fetching batch_size documents/rows at a time instead of loading the
+    whole result set. The hooks run for every document.
+
+    async for obj in Odim(Model).iterate({"field" : 1}, batch_size=500):
+      ...
+    '''
+    raise NotImplementedError("Method not implemented for this connector")
+    yield
+
+
+  async def count(self, query : dict, include_deleted : bool = False, limit : Optional[int] = None) -> int:
     ''' Do the search and count the documents
 
     :param query: dictionary of field:value pairs
+    :param limit: stop counting at this number (capped count)
+    :param cache_ttl: (keyword) serve the count from the result cache for this many seconds, defaults to Config.cache_ttl
     :return: the number of results '''
     raise NotImplementedError("Method not implemented for this connector")
 
 
+  async def estimate_count(self, query : dict, include_deleted : bool = False, cap : Optional[int] = None) -> int:
+    ''' Cheap approximate number of results from the database statistics. Where the backend has no estimate for
+    filtered queries they are counted, up to cap when given '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+
+  async def total(self, query : dict, mode : str = "exact", cap : int = 10000, **kwargs) -> Optional[int]:
+    ''' The total for a search response, counted as the mode says: exact, estimated, capped (at most cap) or none '''
+    if mode == "exact":
+      return await self.count(query, **kwargs)
+    elif mode == "estimated":
+      return await self.estimate_count(query, cap=cap, **kwargs)
+    elif mode == "capped":
+      return await self.count(query, limit=cap, **kwargs)
+    elif mode == "none":
+      return None
+    raise AttributeError("Unknown total mode '%s', use one of exact, estimated, capped, none" % mode)
+
+
   async def delete(self, obj : str, extend_query = {}, force_harddelete : bool = False):
     ''' Delete the document from storage '''
     raise NotImplementedError("Method not implemented for this connector")
 
 
+  async def update_many(self, query : dict, set_fields : dict, include_deleted : bool = False, hooks : bool = True) -> int:
+    ''' Sets the fields on all documents matching the query in one statement
+    :param query: dictionary of field:value pairs, the same language as find
+    :param set_fields: field:value pairs to set
+    :param hooks: run pre_save/post_save hooks. The matching documents are only loaded when the model has such hooks,
+                  changes the pre_save hooks make to the instances are not written
+    :return: the number of modified documents '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+
+  async def delete_many(self, query : dict, force_harddelete : bool = False, include_deleted : bool = False, hooks : bool = True) -> int:
+    ''' Deletes (or soft deletes) all documents matching the query in one statement
+    :param query: dictionary of field:value pairs, the same language as find
+    :param hooks: run pre_remove/post_remove hooks, the matching documents are only loaded when the model has such hooks
+    :return: the number of deleted documents '''
+    raise NotImplementedError("Method not implemented for this connector")
+
+
 
 class NotFoundException(Exception):
   pass
 
 
+class ManyResult(list):
+  ''' get_many results aligned with the requested ids, None where a document was not found '''
+  missing = []
+
+
 class hook(object):
   ''' Decorator that connects function as a hook
   :param hook_type: individual or list of signal types
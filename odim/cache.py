@@ -0,0 +1,132 @@
+'''
+Opt-in result cache for find/count. Enable it per model with Config.cache_ttl (seconds) and optionally
+Config.cache_max_size / Config.cache_backend, or per call with the cache_ttl argument of find and count.
+Any save/update/delete through Odim drops the cached results of that model's collection/table.
+'''
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from typing import Optional
+
+
+class CacheEntry(object):
+  ''' Cached value along with the wall clock times it was stored and expires at '''
+  __slots__ = ("value", "set", "expires")
+
+  def __init__(self, value, set : float, expires : float):
+    self.value = value
+    self.set = set
+    self.expires = expires
+
+  def timestamps(self):
+    return {"set" : datetime.fromtimestamp(self.set), "expires" : datetime.fromtimestamp(self.expires)}
+
+
+class CacheBackend(object):
+  ''' Interface of a result cache store. The namespace identifies one collection/table, keys are the serialized
+  queries. Shared stores (redis, memcached, ...) implement these coroutines and have to pickle the entries themselves '''
+
+  async def get(self, namespace : str, key : str) -> Optional[CacheEntry]:
+    raise NotImplementedError("Method not implemented for this cache backend")
+
+  async def set(self, namespace : str, key : str, entry : CacheEntry, max_size : Optional[int] = None):
+    raise NotImplementedError("Method not implemented for this cache backend")
+
+  async def invalidate(self, namespace : str):
+    raise NotImplementedError("Method not implemented for this cache backend")
+
+
+class MemoryCache(CacheBackend):
+  ''' In-process cache, one LRU per namespace evicting the least recently used entries above max_size '''
+
+  def __init__(self, max_size : int = 1000):
+    self.max_size = max_size
+    self.namespaces = {}
+
+  async def get(self, namespace, key):
+    ns = self.namespaces.get(namespace)
+    if ns is None:
+      return None
+    entry = ns.get(key)
+    if entry is None:
+      return None
+    if entry.expires <= time.time():
+      ns.pop(key, None)
+      return None
+    ns.move_to_end(key)
+    return entry
+
+  async def set(self, namespace, key, entry, max_size=None):
+    ns = self.namespaces.setdefault(namespace, OrderedDict())
+    ns[key] = entry
+    ns.move_to_end(key)
+    limit = max_size or self.max_size
+    while len(ns) > limit:
+      ns.popitem(last=False)
+
+  async def invalidate(self, namespace):
+    self.namespaces.pop(namespace, None)
+
+
+default_backend = MemoryCache()
+
+def set_default_backend(backend : CacheBackend):
+  ''' Replaces the store used by models that do not set Config.cache_backend '''
+  global default_backend
+  default_backend = backend
+
+
+class ResultList(list):
+  ''' List of find() results served through the cache, `cached` holds the set/expires timestamps '''
+  cached = None
+
+
+def encode_key_part(o):
+  ''' Non JSON values tagged with their type, so that e.g. an ObjectId and its string form get different keys '''
+  if hasattr(o, "dict"):
+    return {"$type" : type(o).__name__, "value" : o.dict()}
+  return {"$type" : "%s.%s" % (type(o).__module__, type(o).__qualname__), "value" : str(o)}
+
+
+def cache_key(operation, args, kwargs):
+  return json.dumps([operation, args, kwargs], sort_keys=True, default=encode_key_part)
+
+
+def get_backend(binding) -> CacheBackend:
+  return binding.cache_backend or default_backend
+
+
+def cache_namespace(binding):
+  return "%s/%s" % (binding.connection, binding.collection_name)
+
+
+def cached_query(fnc):
+  ''' Serves the decorated Odim read method from the cache when a ttl is set for the call or the model '''
+  @wraps(fnc)
+  async def wrapper(self, *args, cache_ttl : Optional[int] = None, **kwargs):
+    ttl = cache_ttl if cache_ttl is not None else self.binding.cache_ttl
+    if not ttl:
+      return await fnc(self, *args, **kwargs)
+    backend = get_backend(self.binding)
+    namespace = cache_namespace(self.binding)
+    key = cache_key(fnc.__name__, args, kwargs)
+    entry = await backend.get(namespace, key)
+    if entry is None:
+      value = await fnc(self, *args, **kwargs)
+      now = time.time()
+      entry = CacheEntry(value, now, now+ttl)
+      await backend.set(namespace, key, entry, self.binding.cache_max_size)
+    if isinstance(entry.value, list):
+      # shallow copies, so that callers modifying the results do not change the cached instances
+      rsp = ResultList(x.copy() if hasattr(x, "copy") else x for x in entry.value)
+      rsp.cached = entry.timestamps()
+      return rsp
+    return entry.value
+  return wrapper
+
+
+async def invalidate(binding):
+  ''' Drops all cached results of the model's collection/table '''
+  await get_backend(binding).invalidate(cache_namespace(binding))
@@ -1,20 +1,38 @@
 import json
 from typing import Optional
-from fastapi import Query
+from fastapi import HTTPException, Query
 from pydantic import BaseModel, Field, ValidationError
 import re
 
+from odim.helper import decode_cursor
+
 class SearchParams:
 
   def __init__( self,
                 q: Optional[str] = Query(None, description="Query string to search. Urlencoded key=value or JSON dictionary with fields"),
                 limit: Optional[int] = Query(description="Limit the number of results to x", default=25),
                 offset: Optional[int] = Query(description="From which record to start", default=0),
-                sort: Optional[str] = Query(None, description="Fields to sort by. Comma separated list of fields (- determines DESC order). ", example="name,-created_at")
+                sort: Optional[str] = Query(None, description="Fields to sort by. Comma separated list of fields (- determines DESC order). ", example="name,-created_at"),
+                after: Optional[str] = Query(None, description="Keyset pagination cursor, the next_cursor of the previous page. Faster than offset on deep pages"),
+                fields: Optional[str] = Query(None, description="Comma separated list of fields to return, all fields when missing", example="name,created_at"),
+                keyset: Optional[bool] = Query(False, description="Return a next_cursor for keyset pagination, implied by after")
               ):
     self.limit = limit
     self.offset = offset
     self.sort = sort
+    if after:
+      try:
+        decode_cursor(after)
+      except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    self.after = after
+    self.keyset = bool(keyset)
+    self.fields = None
+    if fields:
+      self.fields = [ f for f in fields.split(",") if f ]
+      for f in self.fields:
+        if not re.fullmatch("[a-zA-Z0-9_]+", f):
+          raise HTTPException(status_code=400, detail="The field in fields param seems to be incorrect")
     if q:
       try:
         self.q = json.loads(q)
@@ -36,7 +54,7 @@ class SearchParams:
 
 
   def dict(self):
-    return {"q":self.q, "limit":self.limit, "offset":self.offset, "sort":self.sort}
+    return {"q":self.q, "limit":self.limit, "offset":self.offset, "sort":self.sort, "after":self.after, "keyset":self.keyset, "fields":self.fields}
 
   def __str__(self):
     return json.dumps(self.dict())
\ No newline at end of file
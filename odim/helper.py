@@ -1,11 +1,21 @@
 import asyncio
+import base64
 import inspect
+import json
 import os
+import random
 import re
 import threading
 import urllib
-from typing import Optional
+import urllib.parse
+from datetime import datetime
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Callable, Dict, Optional
 import pydantic
+from bson.objectid import ObjectId
+
+from odim.indexes import parse_index
 
 settings_module = None
 modsloaded = False
@@ -37,7 +47,7 @@ def get_base_from_module(module, parent_class):
       return x
 
 
-def get_connector_for_model(model):
+def resolve_connector_for_model(model):
   global connectors, odim_module
   if not connectors:
     connectors = [
@@ -65,6 +75,69 @@ def get_connector_for_model(model):
   raise AttributeError("No connector was found for instance class. Do you have the db_name or db_uri Config attr set?")
 
 
+def resolve_connector_for_alias(alias):
+  ''' The Odim connector class handling the protocol of a DATABASES alias (or connection uri) '''
+  protocol = get_connection_info(alias).protocol
+  for connector in (__import__('odim.mongo', fromlist=['odim']), __import__('odim.mysql', fromlist=['odim'])):
+    odim_class = get_base_from_module(connector, __import__('odim').Odim)
+    if protocol in odim_class.protocols:
+      return odim_class
+  raise AttributeError("No connector was found for the '%s' protocol of %s" % (protocol, alias))
+
+
+class ModelBinding(object):
+  ''' What Odim needs to know about a model class to reach its storage. It is resolved once per class and reused until
+  invalidate_model_binding is called for it '''
+
+  def __init__(self, model, connector):
+    self.model = model
+    self.connector = connector
+    self.collection_name = connector.resolve_collection_name(model)
+    self.softdelete = getattr(getattr(model, 'Config', None), 'softdelete', None)
+    self.hooks = getattr(getattr(model, 'Config', None), 'odim_hooks', {})
+    self.cache_ttl = getattr(getattr(model, 'Config', None), 'cache_ttl', None)
+    self.cache_max_size = getattr(getattr(model, 'Config', None), 'cache_max_size', None)
+    self.cache_backend = getattr(getattr(model, 'Config', None), 'cache_backend', None)
+    self.trusted_reads = getattr(getattr(model, 'Config', None), 'trusted_reads', False)
+    retry_policy = getattr(getattr(model, 'Config', None), 'retry_policy', None)
+    self.retry_policy = RetryPolicy(**retry_policy) if isinstance(retry_policy, dict) else retry_policy
+    self.indexes = [ parse_index(x) for x in getattr(getattr(model, 'Config', None), 'indexes', []) ]
+    self._connection = None
+
+  @property
+  def connection(self):
+    ''' The DATABASES alias (or uri), resolved on first use so that models can be bound before the config is loaded '''
+    if self._connection is None:
+      self._connection = self.connector.resolve_connection(self.model)
+    return self._connection
+
+
+model_bindings = {}
+
+def get_model_binding(model) -> ModelBinding:
+  cls = model if inspect.isclass(model) else model.__class__
+  try:
+    return model_bindings[cls]
+  except KeyError:
+    binding = ModelBinding(cls, resolve_connector_for_model(cls))
+    model_bindings[cls] = binding
+    return binding
+
+
+def invalidate_model_binding(model=None):
+  ''' Forgets the binding of the model class and its subclasses, or of all models when called without one '''
+  if model is None:
+    model_bindings.clear()
+    return
+  for cls in list(model_bindings.keys()):
+    if issubclass(cls, model):
+      model_bindings.pop(cls, None)
+
+
+def get_connector_for_model(model):
+  return get_model_binding(model).connector
+
+
 
 class ConnParams(pydantic.BaseModel):
   protocol : str
@@ -73,6 +146,8 @@ class ConnParams(pydantic.BaseModel):
   username : Optional[str] = None
   password : Optional[str] = None
   db : Optional[str]
+  driver : Optional[str] = None
+  options : Dict[str, Any] = {}
 
   def url(self, withdb=True):
     u = self.protocol+"://"
@@ -86,7 +161,7 @@ class ConnParams(pydantic.BaseModel):
     return u
 
 
-def get_connection_info(db) -> ConnParams:
+def parse_connection_info(db) -> ConnParams:
   dbs = get_config('DATABASES')
   if db in dbs:
     if not isinstance(dbs[db], str):
@@ -102,49 +177,270 @@ def get_connection_info(db) -> ConnParams:
     cp.password = urllib.parse.unquote(parsed.password)
   if parsed.path:
     cp.db = parsed.path[1:]
+  if parsed.query:
+    qs = urllib.parse.parse_qs(parsed.query)
+    if "driver" in qs:
+      cp.driver = qs["driver"][0]
+    cp.options = { k : parse_option(v[0]) for k, v in qs.items() if k!="driver" }
   return cp
 
-class RunThread(threading.Thread):
-  def __init__(self, func):
-    self.func = func
-    super().__init__()
 
-  def run(self):
-    try:
-      loop = asyncio.get_event_loop() or asyncio.new_event_loop()
-      asyncio.set_event_loop(loop)
-    except RuntimeError as e:
-      loop = None
-    if inspect.iscoroutine(self.func):
-
-      if loop and loop.is_running():
-        self.result = loop.run_until_complete(self.func)
-      elif loop and not loop.is_running():
-        self.result = asyncio.run(asyncio.ensure_future(self.func))
-      else:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        self.result = loop.run_until_complete(self.func)
-        # self.result = asyncio.run(asyncio.ensure_future(self.func))
-    else:
-      self.result = self.func
-    
-      
-def awaited(func):
-  if inspect.isfunction(func) or inspect.iscoroutine(func):
+def parse_option(value : str):
+  ''' Connection uri query values (?maxsize=20&autocommit=false) as numbers, booleans and None when they look like it '''
+  constants = {"true" : True, "false" : False, "none" : None, "null" : None}
+  if value.lower() in constants:
+    return constants[value.lower()]
+  for t in (int, float):
     try:
-      thread = RunThread(func)
-      thread.start()
-      thread.join()
+      return t(value)
+    except ValueError:
+      pass
+  return value
+
+
+class RetryPolicy(object):
+  ''' Retries a coroutine on the errors the connector classifies as retryable, waiting with exponential backoff and
+  jitter in between. The waits are asyncio.sleep, the event loop keeps serving other requests meanwhile '''
+
+  def __init__(self, retries : int = 2, backoff : float = 0.1, max_backoff : float = 2.0, jitter : float = 0.5):
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.jitter = jitter
+
+  @classmethod
+  def from_options(cls, options : dict, **defaults):
+    ''' The policy from the retries, retry_backoff, retry_max_backoff and retry_jitter connection options '''
+    kw = dict(defaults)
+    for key, opt in (("retries", "retries"), ("backoff", "retry_backoff"), ("max_backoff", "retry_max_backoff"), ("jitter", "retry_jitter")):
+      if opt in options:
+        kw[key] = options[opt]
+    return cls(**kw)
+
+  def delay(self, attempt : int) -> float:
+    d = min(self.max_backoff, self.backoff * (2 ** attempt))
+    return d * (1 - self.jitter*random.random())
+
+  async def call(self, fnc : Callable, retryable : Callable[[Exception], bool], on_retry : Optional[Callable] = None):
+    ''' Awaits fnc(), calling it again up to `retries` times while it raises retryable errors '''
+    attempt = 0
+    while True:
       try:
-        return thread.result
-      except AttributeError:
-        return None
-    except AttributeError as e:
-      return None
+        return await fnc()
+      except Exception as e:
+        if attempt >= self.retries or not retryable(e):
+          raise
+        if on_retry:
+          on_retry(e, attempt)
+        await asyncio.sleep(self.delay(attempt))
+        attempt+= 1
+
+
+connection_params = {}
+connection_handles = {}
+connection_closers = {}
+
+def load_connections():
+  ''' Parses every DATABASES entry once. Called lazily on first use, or explicitly on application startup '''
+  for alias in get_config('DATABASES', default={}).keys():
+    if alias not in connection_params:
+      connection_params[alias] = parse_connection_info(alias)
+  return connection_params
+
+
+def get_connection_info(db) -> ConnParams:
+  ''' Returns the parsed connection settings of a DATABASES alias (or a connection uri) '''
+  try:
+    return connection_params[db]
+  except KeyError:
+    if not connection_params:
+      load_connections()
+      if db in connection_params:
+        return connection_params[db]
+    cp = parse_connection_info(db)
+    connection_params[db] = cp
+    return cp
+
+
+def get_connection(alias):
+  ''' The live client (mongo) or pool (mysql) opened for the alias, None when it was not used yet '''
+  return connection_handles.get(alias)
+
+
+def register_connection(alias, handle, close=None):
+  ''' Stores the client or pool of the alias. `close` is called (and awaited when needed) by reload_connections '''
+  connection_handles[alias] = handle
+  if close:
+    connection_closers[alias] = close
   else:
+    connection_closers.pop(alias, None)
+  return handle
+
+
+def configure_databases(databases : dict):
+  ''' Uses the given DATABASES instead of the settings module and forgets the connections and model bindings of the
+  previous ones. Meant for tests and scripts that have no settings module '''
+  global settings_module, modsloaded
+  settings_module = {"DATABASES": databases}
+  modsloaded = True
+  connection_params.clear()
+  connection_handles.clear()
+  connection_closers.clear()
+  invalidate_model_binding()
+
+
+async def reload_connections():
+  ''' Re-reads the DATABASES config, closes the clients and pools opened for the previous settings and forgets the
+  model bindings that were resolved against them '''
+  closers = list(connection_closers.values())
+  connection_handles.clear()
+  connection_closers.clear()
+  connection_params.clear()
+  invalidate_model_binding()
+  for close in closers:
+    rsp = close()
+    if inspect.isawaitable(rsp):
+      await rsp
+  load_connections()
+
+
+class HookLoopThread(threading.Thread):
+  ''' Long living helper thread with its own event loop. Coroutines that must be resolved synchronously while a loop is
+  already running in the calling thread are handed over to it '''
+  def __init__(self):
+    super().__init__(name="odim-hooks", daemon=True)
+    self.loop = asyncio.new_event_loop()
+
+  def run(self):
+    asyncio.set_event_loop(self.loop)
+    self.loop.run_forever()
+
+
+hook_thread = None
+hook_thread_lock = threading.Lock()
+sync_loops = threading.local()
+
+
+def get_hook_thread():
+  global hook_thread
+  with hook_thread_lock:
+    if hook_thread is None or not hook_thread.is_alive():
+      hook_thread = HookLoopThread()
+      hook_thread.start()
+  return hook_thread
+
+
+async def _await(aw):
+  return await aw
+
+
+def run_in_new_thread(aw):
+  ''' Runs the awaitable on a fresh loop in a short lived thread and waits for it '''
+  result = {}
+  def run():
+    try:
+      result["value"] = asyncio.run(_await(aw))
+    except BaseException as e:
+      result["error"] = e
+  thread = threading.Thread(target=run, name="odim-hooks-nested", daemon=True)
+  thread.start()
+  thread.join()
+  if "error" in result:
+    raise result["error"]
+  return result["value"]
+
+
+def awaited(func):
+  ''' Resolves the result of a hook call synchronously. Plain values are returned as they are, awaitables are run on an
+  idle loop of the calling thread and only when a loop is already running here they go to the shared helper thread.
+  A hook running on the helper thread that resolves another async hook (e.g. builds a model with one) would block its
+  loop, such nested calls get a thread of their own '''
+  if not inspect.isawaitable(func):
     return func
+  try:
+    running = asyncio.get_running_loop()
+  except RuntimeError:
+    loop = getattr(sync_loops, "loop", None)
+    if loop is None or loop.is_closed():
+      loop = sync_loops.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(func)
+  thread = get_hook_thread()
+  if running is thread.loop:
+    return run_in_new_thread(func)
+  return asyncio.run_coroutine_threadsafe(_await(func), thread.loop).result()
+
+
+class context_scope(object):
+  ''' Sets a context variable to the value for the enclosed code, usable with `with` and `async with`. Subclasses
+  name the variable in `var` '''
+  var = None
+
+  def __init__(self, value):
+    self.value = value
+    self.previous = None
+
+  def __enter__(self):
+    self.previous = self.var.get()
+    self.var.set(self.value)
+    return self.value
+
+  def __exit__(self, *exc):
+    # set instead of reset, FastAPI may close dependencies in a copied context
+    self.var.set(self.previous)
+    return False
+
+  async def __aenter__(self):
+    return self.__enter__()
+
+  async def __aexit__(self, *exc):
+    return self.__exit__(*exc)
+
+
+def chunked(items, size):
+  ''' Splits the sequence into lists of at most size items '''
+  items = list(items)
+  size = max(1, size or len(items))
+  for i in range(0, len(items), size):
+    yield items[i:i+size]
+
+
+def encode_cursor_value(v):
+  if isinstance(v, ObjectId):
+    return {"$oid" : str(v)}
+  if isinstance(v, datetime):
+    return {"$date" : v.isoformat()}
+  if isinstance(v, Decimal):
+    return {"$dec" : str(v)}
+  if isinstance(v, Enum):
+    return v.value
+  return v
+
+
+def decode_cursor_value(v):
+  if isinstance(v, dict):
+    if "$oid" in v:
+      return ObjectId(v["$oid"])
+    if "$date" in v:
+      return datetime.fromisoformat(v["$date"])
+    if "$dec" in v:
+      return Decimal(v["$dec"])
+  return v
+
+
+def encode_cursor(values : list) -> str:
+  ''' Opaque keyset pagination token holding the sort key values of the last returned row '''
+  js = json.dumps([encode_cursor_value(v) for v in values], separators=(",", ":"))
+  return base64.urlsafe_b64encode(js.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor : str) -> list:
+  try:
+    js = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    values = json.loads(js)
+    assert isinstance(values, list)
+    return [decode_cursor_value(v) for v in values]
+  except Exception:
+    raise ValueError("Invalid pagination cursor")
 
 
 def camel_case_to_snake_case(name):
@@ -0,0 +1,79 @@
+'''
+Trusted hydration of stored rows into model instances. Data Odim wrote itself does not need the full pydantic
+validation on every read, so models with Config.trusted_reads (or reads with trusted=True) are built with construct()
+and a conversion plan compiled once per model class. The plan only converts what the drivers return differently from
+the field types: Decimal128 to Decimal, ints to bool (MySQL), raw values to Enums and dicts to nested models.
+Validation and the pre_validate/post_validate hooks are skipped, pre_init/post_init hooks still run.
+'''
+from decimal import Decimal
+from enum import Enum
+
+from bson import Decimal128
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SEQUENCE, SHAPE_SET, SHAPE_SINGLETON, SHAPE_TUPLE_ELLIPSIS
+from pydantic.utils import lenient_issubclass
+
+SEQUENCE_SHAPES = (SHAPE_LIST, SHAPE_SEQUENCE, SHAPE_SET, SHAPE_TUPLE_ELLIPSIS)
+
+plans = {}
+
+
+def to_decimal(v):
+  if isinstance(v, Decimal128):
+    return v.to_decimal()
+  return v
+
+
+def to_bool(v):
+  if isinstance(v, int) and not isinstance(v, bool):
+    return bool(v)
+  return v
+
+
+def get_type_converter(t):
+  if lenient_issubclass(t, BaseModel):
+    return lambda v: construct_trusted(t, v) if isinstance(v, dict) else v
+  if lenient_issubclass(t, Decimal):
+    return to_decimal
+  if lenient_issubclass(t, Enum):
+    return lambda v: v if isinstance(v, t) else t(v)
+  if t is bool:
+    return to_bool
+  return None
+
+
+def get_field_converter(field):
+  conv = get_type_converter(field.type_)
+  if conv is None:
+    return None
+  if field.shape == SHAPE_SINGLETON:
+    return conv
+  if field.shape in SEQUENCE_SHAPES:
+    return lambda v: [ conv(x) for x in v ] if isinstance(v, (list, tuple, set)) else v
+  return None
+
+
+def get_plan(model):
+  ''' The (field name, stored name, converter) triplets of the model, compiled once per class '''
+  try:
+    return plans[model]
+  except KeyError:
+    plan = [ (name, field.alias, get_field_converter(field)) for name, field in model.__fields__.items() ]
+    plans[model] = plan
+    return plan
+
+
+def construct_trusted(model, row : dict):
+  ''' Builds the instance from a stored row without validating it '''
+  values = {}
+  for name, alias, conv in get_plan(model):
+    if alias in row:
+      v = row[alias]
+    elif name in row:
+      v = row[name]
+    else:
+      continue
+    if conv is not None and v is not None:
+      v = conv(v)
+    values[name] = v
+  return model.construct(_fields_set=set(values.keys()), **values)
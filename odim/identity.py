@@ -0,0 +1,79 @@
+'''
+Request scoped identity map. While a scope is active, repeated `Odim(Model).get(id)` calls of the same model and id
+return the same instance without another round trip. save/update refresh the mapped instance, delete drops it and the
+query based update_many/delete_many forget the whole model. Only plain gets use the map: with extend_query,
+include_deleted or a field projection the database is asked as usual.
+
+    with identity_scope() as im:
+      ...
+      im.stats() # {"hits" : 3, "misses" : 1, "size" : 1}
+
+or per FastAPI request with `dependencies=[Depends(identity_map)]` (mount_crud(..., identity_map=True) does that).
+'''
+import contextvars
+from typing import Optional
+
+from odim.helper import context_scope
+
+current_identity_map = contextvars.ContextVar("odim_identity_map", default=None)
+
+
+def get_identity_map() -> Optional["IdentityMap"]:
+  return current_identity_map.get()
+
+
+class IdentityMap(object):
+
+  def __init__(self):
+    self.objects = {}
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, model, id):
+    obj = self.objects.get((model, str(id)))
+    if obj is None:
+      self.misses+= 1
+    else:
+      self.hits+= 1
+    return obj
+
+  def put(self, model, obj):
+    if obj is not None and getattr(obj, "id", None) not in (None, ""):
+      self.objects[(model, str(obj.id))] = obj
+
+  def update(self, model, obj):
+    ''' Copies the set fields of a partial update onto the mapped instance '''
+    mapped = self.objects.get((model, str(obj.id)))
+    if mapped is None or mapped is obj:
+      return
+    for k in obj.__fields_set__:
+      setattr(mapped, k, getattr(obj, k))
+
+  def discard(self, model, id):
+    self.objects.pop((model, str(id)), None)
+
+  def clear(self, model=None):
+    ''' Forgets the instances of the model, or all of them '''
+    if model is None:
+      self.objects.clear()
+      return
+    for key in [ k for k in self.objects.keys() if k[0] is model ]:
+      del self.objects[key]
+
+  def stats(self):
+    return {"hits" : self.hits, "misses" : self.misses, "size" : len(self.objects)}
+
+
+class identity_scope(context_scope):
+  ''' Activates a fresh identity map for the enclosed code, usable with `with` and `async with` '''
+  var = current_identity_map
+
+  def __init__(self, identity_map : Optional[IdentityMap] = None):
+    super().__init__(identity_map or IdentityMap())
+    self.identity_map = self.value
+
+
+async def identity_map():
+  ''' FastAPI dependency scoping an identity map to the request '''
+  with identity_scope() as im:
+    yield im
@@ -0,0 +1,208 @@
+'''
+Declarative indexes. A model lists its indexes in Config.indexes, `ensure_indexes` creates the missing ones:
+
+    class Config:
+      collection_name = "orders"
+      softdelete = "deleted"
+      indexes = [
+        "-created_at",                                     # one field, - is descending
+        ["tenant", "deleted", "-created_at"],              # compound
+        {"fields" : ["email"], "unique" : True},
+        {"fields" : ["code"], "unique" : True, "partial" : {"deleted" : False}},
+        {"fields" : ["expires_at"], "ttl" : 0},           # Mongo TTL, seconds after the date
+        {"fields" : ["title", "body"], "text" : True},     # Mongo text / MySQL FULLTEXT index for __search
+      ]
+
+    await ensure_indexes([Order, Customer])  # at startup, creating only what is missing
+
+MySQL has neither partial nor TTL indexes, there a full index is created for a non unique partial index, unique
+partial ones (a full unique index would be a stronger constraint) and TTL indexes are skipped with a warning.
+
+The index advisor records the query shapes (equality, range and sort fields) of find/iterate/count and reports the
+ones no declared index supports:
+
+    index_advisor.enable()
+    ...
+    index_advisor.report(unsupported=True)
+'''
+from typing import List, Optional
+
+
+class Index(object):
+  ''' One declared index, fields are (name, descending) pairs '''
+
+  def __init__(self, fields : List[tuple], unique : bool = False, name : Optional[str] = None, partial : Optional[dict] = None, ttl : Optional[int] = None, text : bool = False):
+    if not fields:
+      raise AttributeError("An index needs at least one field")
+    self.fields = fields
+    self.unique = unique
+    self.partial = partial
+    self.ttl = ttl
+    self.text = text
+    self.name = name or "ix_"+"__".join( f+("_desc" if desc else "") for f, desc in fields )+("_text" if text else "")
+
+  @property
+  def field_names(self) -> List[str]:
+    return [ f for f, _ in self.fields ]
+
+  def __repr__(self):
+    return "Index<%s>" % self.name
+
+
+def parse_index_field(field : str) -> tuple:
+  if field.startswith("-"):
+    return (field[1:], True)
+  return (field, False)
+
+
+def parse_index(spec) -> Index:
+  ''' An Index from its Config.indexes declaration: "field", ["a", "-b"], {"fields" : [...], ...} or an Index '''
+  if isinstance(spec, Index):
+    return spec
+  if isinstance(spec, str):
+    return Index([parse_index_field(spec)])
+  if isinstance(spec, (list, tuple)):
+    return Index([ parse_index_field(f) for f in spec ])
+  if isinstance(spec, dict):
+    spec = dict(spec)
+    fields = spec.pop("fields", None)
+    if isinstance(fields, str):
+      fields = [fields]
+    return Index([ parse_index_field(f) for f in fields or [] ], **spec)
+  raise AttributeError("Invalid index definition %r" % (spec, ))
+
+
+def get_indexes(model) -> List[Index]:
+  ''' The parsed Config.indexes of the model '''
+  from odim.helper import get_model_binding
+  return get_model_binding(model).indexes
+
+
+async def ensure_indexes(models : list) -> dict:
+  ''' Creates the missing declared indexes of the models, returns {model name : {"created" : [...], "existing" : [...],
+  "conflicts" : [...]}}. An index whose name is taken by a different definition is reported as conflict and left alone '''
+  from odim import Odim
+  rsp = {}
+  for model in models:
+    rsp[model.__name__] = await Odim(model).ensure_indexes()
+  return rsp
+
+
+primary_index = Index([("id", False)], name="primary")
+
+
+class QueryShape(object):
+  ''' The fields a query filters on by equality and by range, the sort it asks for and how often it was seen '''
+
+  def __init__(self, model, equality : tuple, ranges : tuple, sort : tuple, text : bool, unindexable : tuple):
+    self.model = model
+    self.equality = equality
+    self.ranges = ranges
+    self.sort = sort
+    self.text = text
+    self.unindexable = unindexable
+    self.count = 0
+
+  def is_by_id(self) -> bool:
+    return "id" in self.equality or "_id" in self.equality
+
+  def supported_by(self, index : Index) -> bool:
+    ''' Whether the index serves the shape: a prefix of it on equality fields (when the query has some), followed by
+    the sort (same or fully reversed directions) when there is one. Without equality fields it has to start with the
+    sort or a range field. A partial index only counts when the query filters on its partial fields '''
+    if index.partial and not set(index.partial.keys()) <= set(self.equality):
+      return False
+    if self.text or index.text:
+      return self.text and index.text
+    names = index.field_names
+    pos = 0
+    while pos < len(names) and names[pos] in self.equality:
+      pos+= 1
+    if self.equality and pos == 0:
+      return False
+    if self.sort:
+      keys = index.fields[pos:pos+len(self.sort)]
+      if [ f for f, _ in keys ] != [ f for f, _ in self.sort ]:
+        return False
+      return len(set( d1 != d2 for (_, d1), (_, d2) in zip(keys, self.sort) )) == 1
+    return pos > 0 or names[0] in self.ranges
+
+  def suggestion(self) -> Optional[list]:
+    ''' An index declaration following the equality, sort, range rule '''
+    if self.text:
+      return None
+    fields = list(self.equality) + [ ("-" if desc else "")+f for f, desc in self.sort ]
+    fields+= [ f for f in self.ranges if f not in fields ][:1]
+    return fields or None
+
+  def as_dict(self, index : Optional[Index]):
+    return {
+      "model" : self.model.__name__,
+      "equality" : list(self.equality),
+      "range" : list(self.ranges),
+      "sort" : [ ("-" if desc else "")+f for f, desc in self.sort ],
+      "text" : self.text,
+      "unindexable" : list(self.unindexable),
+      "count" : self.count,
+      "index" : index.name if index else None,
+      "supported" : index is not None,
+      "suggested" : None if index else self.suggestion(),
+    }
+
+
+class IndexAdvisor(object):
+  ''' Collects the query shapes issued while enabled and matches them against the declared indexes '''
+
+  def __init__(self, max_shapes : int = 10000):
+    self.enabled = False
+    self.max_shapes = max_shapes
+    self.shapes = {}
+
+  def enable(self):
+    self.enabled = True
+
+  def disable(self):
+    self.enabled = False
+
+  def clear(self):
+    self.shapes.clear()
+
+  def record(self, odim, query : dict, params=None):
+    from odim import Operation, relevance_sort
+    equality, ranges, unindexable = [], [], []
+    text = False
+    for k, (op, v) in odim.parse_query_operations(query).items():
+      if op in (Operation.exact, Operation.null):
+        equality.append(k)
+      elif op == Operation.search:
+        text = True
+      elif op == Operation.contains:
+        unindexable.append(k)
+      else:
+        ranges.append(k)
+    sort = [ (f, desc) for f, desc in odim.get_sort(params) if f not in (odim.id_field, relevance_sort) ] if params else []
+    if not (equality or ranges or sort or text or unindexable):
+      return # an unfiltered scan, no index to advise
+    key = (odim.model, tuple(sorted(equality)), tuple(sorted(ranges)), tuple(sort), text, tuple(sorted(unindexable)))
+    shape = self.shapes.get(key)
+    if shape is None:
+      if len(self.shapes) >= self.max_shapes:
+        return
+      shape = self.shapes[key] = QueryShape(*key)
+    shape.count+= 1
+
+  def report(self, unsupported : bool = False) -> List[dict]:
+    ''' The recorded shapes, most frequent first, with the declared index serving them or a suggested one '''
+    rsp = []
+    for shape in sorted(self.shapes.values(), key=lambda s: -s.count):
+      if shape.is_by_id():
+        index = primary_index
+      else:
+        index = next(( ix for ix in get_indexes(shape.model) if shape.supported_by(ix) ), None)
+      if unsupported and index is not None:
+        continue
+      rsp.append(shape.as_dict(index))
+    return rsp
+
+
+index_advisor = IndexAdvisor()
@@ -0,0 +1,81 @@
+'''
+DataLoader style batching of get(). The load(id) calls made in the same event loop tick, typically from coroutines run
+with asyncio.gather, are collected and resolved with one get_many query:
+
+    loader = Loader(Author)
+    authors = await asyncio.gather(*[ loader.load(post.author_id) for post in posts ])
+
+A loader caches what it loaded, create one per request (or use it within an identity_scope).
+'''
+import asyncio
+from typing import List, Optional
+
+from odim import NotFoundException, Odim
+
+
+class Loader(object):
+
+  def __init__(self, model, extend_query : dict = {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, max_batch_size : int = 1000, cache : bool = True):
+    self.model = model
+    self.kwargs = {"extend_query" : extend_query, "include_deleted" : include_deleted, "fields" : fields, "exclude" : exclude}
+    self.max_batch_size = max_batch_size
+    self.cache = cache
+    self.futures = {}
+    self.pending = {}
+    self.batches = 0
+    self.loads = 0
+
+  def load(self, id) -> asyncio.Future:
+    ''' Awaitable of the instance with the id, NotFoundException when it does not exist '''
+    self.loads+= 1
+    key = str(id)
+    fut = self.futures.get(key)
+    if fut is not None:
+      return fut
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    if self.cache:
+      self.futures[key] = fut
+    if not self.pending:
+      loop.call_soon(self.dispatch)
+    self.pending.setdefault(key, (id, []))[1].append(fut)
+    return fut
+
+  async def load_many(self, ids : list) -> list:
+    return await asyncio.gather(*[ self.load(id) for id in ids ])
+
+  def clear(self, id=None):
+    ''' Forgets a cached id, or all of them, so that they are loaded again '''
+    if id is None:
+      self.futures.clear()
+    else:
+      self.futures.pop(str(id), None)
+
+  def dispatch(self):
+    pending, self.pending = self.pending, {}
+    items = list(pending.values())
+    for i in range(0, len(items), self.max_batch_size):
+      asyncio.ensure_future(self.resolve(items[i:i+self.max_batch_size]))
+
+  async def resolve(self, items):
+    self.batches+= 1
+    try:
+      found = await Odim(self.model).get_many([ id for id, _ in items ], **self.kwargs)
+    except Exception as e:
+      for id, futs in items:
+        self.futures.pop(str(id), None)
+        for fut in futs:
+          if not fut.done():
+            fut.set_exception(e)
+      return
+    for (id, futs), obj in zip(items, found):
+      for fut in futs:
+        if fut.done():
+          continue
+        if obj is None:
+          fut.set_exception(NotFoundException())
+        else:
+          fut.set_result(obj)
+
+  def stats(self):
+    return {"loads" : self.loads, "batches" : self.batches, "cached" : len(self.futures)}
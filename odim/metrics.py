@@ -0,0 +1,249 @@
+'''
+Instrumentation of the Odim operations. While enabled, every get/get_many/find/count/save/save_many/update/
+update_many/delete/delete_many call is recorded per model and operation: calls, errors, rows returned and histograms
+of the total time and of the time spent in database round trips, in hydration/validation and in hooks.
+
+    from odim.metrics import instrumentation
+    instrumentation.enable()
+    ...
+    instrumentation.stats()              # {"Order" : {"find" : {"calls" : 10, "rows" : 250, "db" : {...}, ...}}}
+    instrumentation.prometheus_text()    # text exposition format for a /metrics endpoint
+    instrumentation.add_listener(fnc)    # fnc(model=..., operation=..., timings={...}, rows=..., error=...)
+
+Independently of that, statements slower than the slow query threshold are logged, a sample of them when
+slow_query_sample is below 1:
+
+    instrumentation.configure(slow_query_threshold=0.2, slow_query_sample=0.1)
+'''
+import contextvars
+import logging
+import random
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Optional
+
+from odim.querylog import current_query_log, query_shape
+
+log = logging.getLogger("uvicorn")
+
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+phases = ("total", "db", "hydrate", "hooks")
+
+
+class Histogram(object):
+  ''' Counts of observations per bucket upper bound (seconds), the last slot being +Inf '''
+  __slots__ = ("buckets", "counts", "sum", "count")
+
+  def __init__(self, buckets : tuple = default_buckets):
+    self.buckets = buckets
+    self.counts = [0]*(len(buckets)+1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value : float):
+    self.counts[bisect_left(self.buckets, value)]+= 1
+    self.sum+= value
+    self.count+= 1
+
+  def quantile(self, q : float) -> Optional[float]:
+    ''' Upper bound of the bucket holding the q quantile '''
+    if not self.count:
+      return None
+    rank = q*self.count
+    seen = 0
+    for bound, cnt in zip(self.buckets+(float("inf"), ), self.counts):
+      seen+= cnt
+      if seen >= rank:
+        return bound
+    return float("inf")
+
+  def as_dict(self):
+    return {"count" : self.count, "sum" : self.sum, "p50" : self.quantile(0.5), "p95" : self.quantile(0.95), "p99" : self.quantile(0.99)}
+
+
+class OperationMetrics(object):
+  ''' What was recorded for one model and operation '''
+
+  def __init__(self, buckets : tuple = default_buckets):
+    self.calls = 0
+    self.errors = 0
+    self.rows = 0
+    self.histograms = { p : Histogram(buckets) for p in phases }
+
+  def as_dict(self):
+    return {"calls" : self.calls, "errors" : self.errors, "rows" : self.rows, **{ p : h.as_dict() for p, h in self.histograms.items() }}
+
+
+class Span(object):
+  ''' The time one operation spent in each phase so far '''
+  __slots__ = ("model", "operation", "db", "hydrate", "hooks")
+
+  def __init__(self, model : str, operation : str):
+    self.model = model
+    self.operation = operation
+    self.db = 0.0
+    self.hydrate = 0.0
+    self.hooks = 0.0
+
+
+current_span = contextvars.ContextVar("odim_span", default=None)
+
+unset = object()
+
+
+def escape_label(value) -> str:
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Instrumentation(object):
+
+  def __init__(self):
+    self.enabled = False
+    self.buckets = default_buckets
+    self.operations = {}
+    self.listeners = []
+    self.slow_query_threshold = 1.0 # seconds, None disables the slow query log
+    self.slow_query_sample = 1.0
+
+  def configure(self, enabled : Optional[bool] = None, buckets : Optional[tuple] = None, slow_query_threshold : Optional[float] = unset, slow_query_sample : Optional[float] = None):
+    if enabled is not None:
+      self.enabled = enabled
+    if buckets is not None:
+      self.buckets = tuple(sorted(buckets))
+      self.reset()
+    if slow_query_threshold is not unset:
+      self.slow_query_threshold = slow_query_threshold
+    if slow_query_sample is not None:
+      self.slow_query_sample = slow_query_sample
+
+  def enable(self):
+    self.enabled = True
+
+  def disable(self):
+    self.enabled = False
+
+  def reset(self):
+    self.operations = {}
+
+  def add_listener(self, fnc : Callable):
+    ''' fnc(model=..., operation=..., timings={"total" : s, "db" : s, "hydrate" : s, "hooks" : s}, rows=n, error=e)
+    is called after every recorded operation, e.g. to feed statsd or OpenTelemetry '''
+    if fnc not in self.listeners:
+      self.listeners.append(fnc)
+
+  def remove_listener(self, fnc : Callable):
+    if fnc in self.listeners:
+      self.listeners.remove(fnc)
+
+  def record(self, span : Span, total : float, rows : int, error : Optional[BaseException] = None):
+    key = (span.model, span.operation)
+    m = self.operations.get(key)
+    if m is None:
+      m = self.operations[key] = OperationMetrics(self.buckets)
+    m.calls+= 1
+    m.rows+= rows
+    if error is not None:
+      m.errors+= 1
+    timings = {"total" : total, "db" : span.db, "hydrate" : span.hydrate, "hooks" : span.hooks}
+    for p, v in timings.items():
+      m.histograms[p].observe(v)
+    for fnc in self.listeners:
+      try:
+        fnc(model=span.model, operation=span.operation, timings=timings, rows=rows, error=error)
+      except Exception as e:
+        log.warning("Odim metrics listener %s failed: %s", fnc, e)
+
+  def slow_query(self, kind : str, statement, seconds : float):
+    threshold = self.slow_query_threshold
+    if threshold is None or seconds < threshold:
+      return
+    if self.slow_query_sample < 1 and random.random() >= self.slow_query_sample:
+      return
+    span = current_span.get()
+    log.warning("Slow %s query %.1fms%s: %s", kind, 1000*seconds, " (%s.%s)" % (span.model, span.operation) if span else "", statement)
+
+  def stats(self) -> dict:
+    rsp = {}
+    for (model, operation), m in self.operations.items():
+      rsp.setdefault(model, {})[operation] = m.as_dict()
+    return rsp
+
+  def prometheus_text(self) -> str:
+    ''' The metrics in the Prometheus text exposition format '''
+    lines = [
+      "# HELP odim_operations_total Odim operations per model and operation",
+      "# TYPE odim_operations_total counter",
+    ]
+    for (model, operation), m in self.operations.items():
+      lines.append('odim_operations_total{model="%s",operation="%s"} %d' % (escape_label(model), escape_label(operation), m.calls))
+    lines+= ["# HELP odim_operation_errors_total Failed Odim operations", "# TYPE odim_operation_errors_total counter"]
+    for (model, operation), m in self.operations.items():
+      lines.append('odim_operation_errors_total{model="%s",operation="%s"} %d' % (escape_label(model), escape_label(operation), m.errors))
+    lines+= ["# HELP odim_operation_rows_total Rows/documents returned", "# TYPE odim_operation_rows_total counter"]
+    for (model, operation), m in self.operations.items():
+      lines.append('odim_operation_rows_total{model="%s",operation="%s"} %d' % (escape_label(model), escape_label(operation), m.rows))
+    lines+= ["# HELP odim_operation_seconds Time per operation and phase (total, db, hydrate, hooks)", "# TYPE odim_operation_seconds histogram"]
+    for (model, operation), m in self.operations.items():
+      for phase, h in m.histograms.items():
+        labels = 'model="%s",operation="%s",phase="%s"' % (escape_label(model), escape_label(operation), phase)
+        cumulative = 0
+        for bound, cnt in zip(h.buckets+(float("inf"), ), h.counts):
+          cumulative+= cnt
+          lines.append('odim_operation_seconds_bucket{%s,le="%s"} %d' % (labels, "+Inf" if bound == float("inf") else repr(bound), cumulative))
+        lines.append('odim_operation_seconds_sum{%s} %r' % (labels, h.sum))
+        lines.append('odim_operation_seconds_count{%s} %d' % (labels, h.count))
+    return "\n".join(lines)+"\n"
+
+
+instrumentation = Instrumentation()
+
+
+def count_rows(result) -> int:
+  if isinstance(result, list):
+    return sum( 1 for x in result if x is not None )
+  if result is None or isinstance(result, (int, str, bool)) or not hasattr(result, "__fields__"):
+    return 0
+  return 1
+
+
+def instrumented(operation : str):
+  ''' Records the decorated Odim coroutine method as `operation` of its model, in the metrics and in the query log of
+  the request (see odim.querylog) '''
+  def decorator(fnc):
+    @wraps(fnc)
+    async def wrapper(self, *args, **kwargs):
+      qlog = current_query_log.get()
+      if not instrumentation.enabled and qlog is None:
+        return await fnc(self, *args, **kwargs)
+      span = Span(self.model.__name__, operation)
+      token = current_span.set(span)
+      nested = token.old_value not in (None, contextvars.Token.MISSING)
+      start = time.perf_counter()
+      error = None
+      rows = 0
+      try:
+        rsp = await fnc(self, *args, **kwargs)
+        rows = count_rows(rsp)
+        return rsp
+      except BaseException as e:
+        error = e
+        raise
+      finally:
+        current_span.reset(token)
+        duration = time.perf_counter()-start
+        if instrumentation.enabled:
+          instrumentation.record(span, duration, rows, error)
+        if qlog is not None:
+          qlog.record(span.model, operation, query_shape(args, kwargs), duration, span.db, nested)
+    return wrapper
+  return decorator
+
+
+def observe_statement(kind : str, statement, seconds : float):
+  ''' Adds a database round trip to the running operation and logs it when it was slow '''
+  span = current_span.get()
+  if span is not None:
+    span.db+= seconds
+  instrumentation.slow_query(kind, statement, seconds)
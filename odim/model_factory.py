@@ -11,12 +11,13 @@ from enum import Enum
 from os import path, getcwd
 from typing import Any, List, Optional, Type, Union
 
-from odim.helper import snake_case_to_camel_case
+from odim.helper import invalidate_model_binding, snake_case_to_camel_case
 from odim.basesignals import BaseSignals
 from pydantic import BaseModel, Field, create_model
 from odim.mongo import BaseMongoModel, ObjectId
 from datetime import datetime
 from odim import dynmodels
+from odim.references import register_model
 
 def get_class_by_name(classname):
   ''' Returns the loaded instance of a class '''
@@ -212,6 +213,9 @@ class ModelFactory(object):
                   meta_attrs["odim_hooks"][n].append(cfx)
 
       setattr(m, 'Config', type('class', (), meta_attrs))
+      invalidate_model_binding(m)
+      register_model(class_name, m)
+      register_model(collection_name, m)
       m.__doc__ = description
       m.update_forward_refs()
       return m
@@ -293,6 +297,7 @@ class ModelFactory(object):
     for xname, xfield in extend:
       new_model.__fields__[xname] = xfield
       new_model.__schema_cache__.clear()
+    invalidate_model_binding(new_model)
     return new_model
 
 
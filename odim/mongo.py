@@ -1,8 +1,10 @@
+import inspect
+import itertools
 import logging
 import re
+import time
 from datetime import datetime
 from decimal import Decimal
-from time import sleep
 from typing import List, Optional, Union
 
 import bson
@@ -12,15 +14,18 @@ from functools import wraps, partial
 import asyncio
 from pymongo import MongoClient, errors
 
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, TEXT, InsertOne, ReplaceOne, UpdateOne
 
-from odim import BaseOdimModel, NotFoundException, Odim, Operation, SearchParams, all_json_encoders
-from odim.helper import awaited, get_connection_info
+from odim import BaseOdimModel, NotFoundException, Odim, Operation, SearchParams, all_json_encoders, relevance_sort
+from odim.cache import cached_query
+from odim.metrics import instrumented, observe_statement
+from odim.indexes import Index
+from odim.helper import RetryPolicy, chunked, get_connection, get_connection_info, register_connection
+from odim import references
+from odim.transaction import Transaction, get_transaction
 
 log = logging.getLogger("uvicorn")
 
-client_connections = {}
-
 
 def async_wrap(func):
   @wraps(func)
@@ -31,13 +36,218 @@ def async_wrap(func):
       return await loop.run_in_executor(executor, f)
   return run
 
-# @async_wrap
+async def maybe_await(result):
+  ''' Results of calls that are coroutines with motor and plain values with pymongo '''
+  if inspect.isawaitable(result):
+    return await result
+  return result
+
+
 async def get_mongo_client(alias):
-  global client_connections
-  if alias not in client_connections:
+  db = get_connection(alias)
+  if db is None:
     cinf = get_connection_info(alias)
-    client_connections[alias] = MongoClient(cinf.url(withdb=False), cinf.port)[cinf.db]
-  return client_connections[alias]
+    if cinf.driver == "motor":
+      try:
+        from motor.motor_asyncio import AsyncIOMotorClient
+      except ImportError:
+        raise AttributeError("The motor driver was requested for '%s', but motor is not installed" % alias)
+      client = AsyncIOMotorClient(cinf.url(withdb=False), cinf.port)
+    else:
+      client = MongoClient(cinf.url(withdb=False), cinf.port)
+    db = register_connection(alias, client[cinf.db], close=client.close)
+  return db
+
+
+retry_stats = {}
+
+def get_retry_stats(namespace : Optional[str] = None) -> dict:
+  ''' Retry counters per "alias/collection": retries made, operations that succeeded after retrying and operations
+  that failed after the last retry '''
+  if namespace is not None:
+    return dict(retry_stats.get(namespace, {}))
+  return { k : dict(v) for k, v in retry_stats.items() }
+
+
+def is_retryable(e, write : bool = False) -> bool:
+  ''' Network errors (AutoReconnect, timeouts, no reachable server) are retried, query errors are not. Inserts and
+  bulk writes are only retried when no server was selected, so the write surely was not sent '''
+  if write:
+    return isinstance(e, errors.ServerSelectionTimeoutError)
+  return isinstance(e, errors.ConnectionFailure)
+
+
+class MongoStatement(object):
+  ''' Describes a collection call in the slow query log, formatted only when logged '''
+
+  def __init__(self, namespace : str, name : str, args : tuple):
+    self.namespace = namespace
+    self.name = name
+    self.args = args
+
+  def __str__(self):
+    return "%s.%s(%s)" % (self.namespace, self.name, str(self.args[0])[:500] if self.args else "")
+
+
+class MongoCollection(object):
+  ''' Awaitable facade over a collection. The default "sync" driver calls pymongo inline, so every query blocks the
+  event loop for its whole round trip. Operations failing with network errors are retried with the retry policy '''
+
+  def __init__(self, collection, retry : Optional[RetryPolicy] = None, namespace : Optional[str] = None, session=None):
+    self.collection = collection
+    self.retry = retry
+    self.namespace = namespace or collection.name
+    self.session = session
+
+  async def invoke(self, fnc, *args, **kwargs):
+    return fnc(*args, **kwargs)
+
+  async def retried(self, call, write : bool = False):
+    if not self.retry or not self.retry.retries:
+      return await call()
+    retried = []
+    def on_retry(e, attempt):
+      retried.append(attempt)
+      stats = retry_stats.setdefault(self.namespace, {"retries" : 0, "recovered" : 0, "failed" : 0})
+      stats["retries"]+= 1
+      log.warning("Mongo operation on %s failed, retrying (%d): %s", self.namespace, attempt+1, e)
+    try:
+      rsp = await self.retry.call(call, lambda e: is_retryable(e, write), on_retry)
+    except Exception:
+      if retried:
+        retry_stats[self.namespace]["failed"]+= 1
+      raise
+    if retried:
+      retry_stats[self.namespace]["recovered"]+= 1
+    return rsp
+
+  async def run(self, fnc, *args, **kwargs):
+    ''' Reads and idempotent writes, retried on any network error '''
+    return await self.timed(fnc.__name__, args, self.execute(fnc, args, kwargs))
+
+  async def run_write(self, fnc, *args, **kwargs):
+    ''' Inserts, which would duplicate when repeated after reaching the server '''
+    return await self.timed(fnc.__name__, args, self.execute(fnc, args, kwargs, write=True))
+
+  async def execute(self, fnc, args, kwargs, write : bool = False):
+    if self.session is not None:
+      return await self.invoke(fnc, *args, session=self.session, **kwargs)
+    return await self.retried(lambda: self.invoke(fnc, *args, **kwargs), write=write)
+
+  async def timed(self, name, args, call):
+    ''' Adds the round trip to the metrics of the running operation, logging it when slow (see odim.metrics) '''
+    start = time.perf_counter()
+    try:
+      return await call
+    finally:
+      observe_statement("mongo", MongoStatement(self.namespace, name, args), time.perf_counter()-start)
+
+  async def find(self, *args, **kwargs):
+    return await self.timed("find", args, self.execute(lambda **kw: list(self.collection.find(*args, **kwargs, **kw)), (), {}))
+
+  async def iterate(self, *args, batch_size : int = 100, **kwargs):
+    ''' Yields the documents of a cursor, fetching batch_size documents per call to the driver. A cursor can not be
+    resumed, so iterations are not retried '''
+    cursor = self.collection.find(*args, batch_size=batch_size, **kwargs)
+    try:
+      while True:
+        batch = await self.invoke(lambda: list(itertools.islice(cursor, batch_size)))
+        if not batch:
+          break
+        for doc in batch:
+          yield doc
+    finally:
+      await self.invoke(cursor.close)
+
+  async def find_one(self, *args, **kwargs):
+    return await self.run(self.collection.find_one, *args, **kwargs)
+
+  async def insert_one(self, *args, **kwargs):
+    return await self.run_write(self.collection.insert_one, *args, **kwargs)
+
+  async def insert_many(self, *args, **kwargs):
+    return await self.run_write(self.collection.insert_many, *args, **kwargs)
+
+  async def bulk_write(self, *args, **kwargs):
+    return await self.run_write(self.collection.bulk_write, *args, **kwargs)
+
+  async def replace_one(self, *args, **kwargs):
+    return await self.run(self.collection.replace_one, *args, **kwargs)
+
+  async def find_one_and_update(self, *args, **kwargs):
+    return await self.run(self.collection.find_one_and_update, *args, **kwargs)
+
+  async def update_many(self, *args, **kwargs):
+    return await self.run(self.collection.update_many, *args, **kwargs)
+
+  async def delete_one(self, *args, **kwargs):
+    return await self.run(self.collection.delete_one, *args, **kwargs)
+
+  async def delete_many(self, *args, **kwargs):
+    return await self.run(self.collection.delete_many, *args, **kwargs)
+
+  async def count_documents(self, *args, **kwargs):
+    return await self.run(self.collection.count_documents, *args, **kwargs)
+
+  async def estimated_document_count(self, *args, **kwargs):
+    return await self.run(self.collection.estimated_document_count, *args, **kwargs)
+
+  async def index_information(self):
+    return await self.run(self.collection.index_information)
+
+  async def create_index(self, *args, **kwargs):
+    return await self.run(self.collection.create_index, *args, **kwargs)
+
+
+class ExecutorMongoCollection(MongoCollection):
+  ''' Runs the blocking pymongo calls in the loop's default executor, leaving the event loop free '''
+
+  async def invoke(self, fnc, *args, **kwargs):
+    return await async_wrap(fnc)(*args, **kwargs)
+
+
+class MotorMongoCollection(MongoCollection):
+  ''' Native asyncio collection backed by motor '''
+
+  async def invoke(self, fnc, *args, **kwargs):
+    return await fnc(*args, **kwargs)
+
+  async def find(self, *args, **kwargs):
+    return await self.timed("find", args, self.execute(lambda **kw: self.collection.find(*args, **kwargs, **kw).to_list(None), (), {}))
+
+  async def iterate(self, *args, batch_size : int = 100, **kwargs):
+    cursor = self.collection.find(*args, batch_size=batch_size, **kwargs)
+    try:
+      async for doc in cursor:
+        yield doc
+    finally:
+      # kills the server side cursor when the caller stopped early
+      await maybe_await(cursor.close())
+
+
+mongo_drivers = {
+  "sync" : MongoCollection,
+  "executor" : ExecutorMongoCollection,
+  "motor" : MotorMongoCollection
+}
+
+
+def get_retry_policy(alias) -> RetryPolicy:
+  ''' The retry policy from the retries/retry_backoff/... options of the DATABASES entry '''
+  return RetryPolicy.from_options(get_connection_info(alias).options)
+
+
+async def get_mongo_collection(alias, collection_name, retry : Optional[RetryPolicy] = None):
+  ''' Returns the awaitable collection using the driver selected in the DATABASES entry (sync, executor or motor).
+  Without an explicit retry policy the one of the DATABASES entry applies. While a transaction of the alias is
+  flushing the operations run in its session and are not retried '''
+  db = await get_mongo_client(alias)
+  driver = get_connection_info(alias).driver or "sync"
+  if driver not in mongo_drivers:
+    raise AttributeError("Unknown mongo driver '%s', use one of %s" % (driver, ", ".join(mongo_drivers.keys())))
+  tx = get_transaction(alias)
+  session = tx.handle if tx is not None else None
+  return mongo_drivers[driver](db[collection_name], retry or get_retry_policy(alias), "%s/%s" % (alias, collection_name), session)
 
 class ObjectId(BsonObjectId):
 
@@ -94,44 +304,72 @@ def convert_decimal(dict_item):
 
 class OdimMongo(Odim):
   protocols = ["mongo","mongodb"]
+  id_field = "_id"
+
+  @classmethod
+  def resolve_collection_name(cls, model):
+    if hasattr(model, 'Config'):
+      if hasattr(model.Config, 'collection_name'):
+        cn = model.Config.collection_name
+        return cn
+    return model.__class__.__name__
 
   @property
   def get_collection_name(self):
-    if hasattr(self.model, 'Config'):
-      if hasattr(self.model.Config, 'collection_name'):
-        cn = self.model.Config.collection_name
-        return cn
-    return self.model.__class__.__name__
+    return self.binding.collection_name
 
 
   @property
   async def __mongo(self):
-    client = await get_mongo_client(self.get_connection_identifier)
-    return client[self.get_collection_name]
+    return await get_mongo_collection(self.get_connection_identifier, self.get_collection_name, self.binding.retry_policy)
 
 
-  async def get(self, id : Union[str, ObjectId], extend_query : dict= {}, include_deleted : bool = False):
+  @instrumented("get")
+  async def get(self, id : Union[str, ObjectId], extend_query : dict= {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None):
     if isinstance(id, str):
       id = ObjectId(id)
+    im, x = self.lookup(id, extend_query, include_deleted, fields, exclude)
+    if x is not None:
+      return x
     softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
-    
     db = await self.__mongo
 
     ext = self.get_parsed_query(extend_query)
     qry = {"_id" : id, **softdel, **ext}
-    ret = db.find_one(qry)
+    model, projection = self.get_projection(fields, exclude)
+    ret = await db.find_one(qry, projection)
     if not ret:
       raise NotFoundException()
-    ret = self.execute_hooks("pre_init", ret) # we send the DB Object into the PRE_INIT
-    x = self.model(**ret)
-    x = self.execute_hooks("post_init", x) # we send the Model Obj into the POST_INIT
+    ret = await self.async_execute_hooks("pre_init", ret) # we send the DB Object into the PRE_INIT
+    x = self.hydrate(model, ret, trusted)
+    x = await self.async_execute_hooks("post_init", x) # we send the Model Obj into the POST_INIT
+    if im is not None:
+      im.put(self.model, x)
     return x
 
 
+  async def fetch_ids(self, ids : list, extend_query : dict= {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None) -> list:
+    softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
+    qry = {"_id" : {"$in" : [ ObjectId(x) if isinstance(x, str) else x for x in ids ]}, **softdel, **self.get_parsed_query(extend_query)}
+    model, projection = self.get_projection(fields, exclude)
+    db = await self.__mongo
+    rsplist = []
+    for x in await db.find(qry, projection=projection):
+      x2 = await self.async_execute_hooks("pre_init", x)
+      rsplist.append( await self.async_execute_hooks("post_init", self.hydrate(model, x2, trusted)) )
+    return rsplist
+
+
+  @instrumented("save")
   async def save(self, extend_query : dict= {}, include_deleted : bool = False) -> ObjectId:
     if not self.instance:
       raise AttributeError("Can not save, instance not specified ")#describe more how ti instantiate
-    iii = self.execute_hooks("pre_save", self.instance, created=(not self.instance.id))
+    if isinstance(self.instance.id, str) and self.instance.id:
+      self.instance.id = ObjectId(self.instance.id)
+    tx = self.get_transaction()
+    if tx is not None:
+      return await tx.save(self, extend_query, include_deleted)
+    iii = await self.async_execute_hooks("pre_save", self.instance, created=(not self.instance.id))
     dd = convert_decimal(iii.dict(by_alias=True))
 
     if not self.instance.id:
@@ -140,21 +378,91 @@ class OdimMongo(Odim):
       self.instance.id = dd["_id"]
       softdel = {self.softdelete(): False} if self.softdelete() else {}
       db = await self.__mongo
-      ret = db.insert_one({**dd, **extend_query, **softdel})
+      ret = await db.insert_one({**dd, **extend_query, **softdel})
       created = True
     else:
       softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
       db = await self.__mongo
-      ret = db.replace_one({"_id": self.instance.id, **softdel, **self.get_parsed_query(extend_query)}, dd)
+      ret = await db.replace_one({"_id": self.instance.id, **softdel, **self.get_parsed_query(extend_query)}, dd)
       assert ret.modified_count > 0, "Not modified error"
       created = False
-    iii = self.execute_hooks("post_save", iii, created=created)
+    await self.invalidate_cache()
+    self.remember(self.instance)
+    iii = await self.async_execute_hooks("post_save", iii, created=created)
     return self.instance.id
 
 
+  @instrumented("save_many")
+  async def save_many(self, objs : List[BaseMongoModel], ordered : bool = False, chunk_size : int = 1000, extend_query : dict = {}, include_deleted : bool = False) -> List[ObjectId]:
+    if self.get_transaction() is not None:
+      return [ await Odim(obj).save(extend_query, include_deleted) for obj in objs ]
+    for chunk in chunked(objs, chunk_size):
+      saved = []
+      for obj in chunk:
+        created = not obj.id
+        iii = await self.async_execute_hooks("pre_save", obj, created=created)
+        saved.append((obj, iii, created))
+      await self.write_many([ (iii, created) for _, iii, created in saved ], ordered, extend_query, include_deleted)
+      for obj, iii, created in saved:
+        obj.id = iii.id
+        self.remember(obj)
+      await self.invalidate_cache()
+      for _, iii, created in saved:
+        await self.async_execute_hooks("post_save", iii, created=created)
+    return [obj.id for obj in objs]
+
+
+  def new_id(self):
+    return BsonObjectId()
+
+
+  async def write_many(self, items : List[tuple], ordered : bool = False, extend_query : dict = {}, include_deleted : bool = False):
+    db = await self.__mongo
+    ext = self.get_parsed_query(extend_query)
+    inserts = []
+    ops = []
+    replaced = 0
+    for iii, created in items:
+      if isinstance(iii.id, str) and iii.id:
+        iii.id = ObjectId(iii.id)
+      dd = convert_decimal(iii.dict(by_alias=True))
+      if created:
+        if not iii.id:
+          iii.id = BsonObjectId()
+        dd["_id"] = iii.id
+        softdel = {self.softdelete(): False} if self.softdelete() else {}
+        inserts.append({**dd, **extend_query, **softdel})
+        ops.append(InsertOne(inserts[-1]))
+      else:
+        softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
+        ops.append(ReplaceOne({"_id": iii.id, **softdel, **ext}, dd))
+        replaced+= 1
+    if len(inserts) == len(ops):
+      await db.insert_many(inserts, ordered=ordered)
+    else:
+      ret = await db.bulk_write(ops, ordered=ordered)
+      # like save(), a document out of the extend_query/softdelete scope is not written
+      assert ret.matched_count == replaced, "Not modified error"
+
+
+  @instrumented("update")
   async def update(self, extend_query : dict= {}, include_deleted : bool = False, only_fields : Optional[List['str']] = None):
     ''' Saves only the changed fields leaving other fields alone '''
-    iii = self.execute_hooks("pre_save", self.instance, created=False)
+    tx = self.get_transaction()
+    if tx is not None:
+      return await tx.update(self, extend_query, include_deleted, only_fields)
+    iii = await self.async_execute_hooks("pre_save", self.instance, created=False)
+    filter, update = self.get_update(iii, only_fields, extend_query, include_deleted)
+    db = await self.__mongo
+    ret = await db.find_one_and_update(filter, update)
+    await self.invalidate_cache()
+    self.remember_update(iii)
+    iii = await self.async_execute_hooks("post_save", iii, created=False)
+    return ret
+
+
+  def get_update(self, iii, only_fields : Optional[List[str]] = None, extend_query : dict = {}, include_deleted : bool = False):
+    ''' The filter and $set update writing the set fields of the instance '''
     dd = convert_decimal(iii.dict(exclude_unset=True, by_alias=True))
     if "_id" not in dd:
       raise AttributeError("Can not update document without _id")
@@ -165,10 +473,13 @@ class OdimMongo(Odim):
     if only_fields and len(only_fields)>0:
       dd = dict([(key, val) for key, val in dd.items() if key in only_fields])
     softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
+    return {"_id" : dd_id, **softdel, **self.get_parsed_query(extend_query)}, {"$set" : dd}
+
+
+  async def write_updates(self, items : List[tuple], extend_query : dict = {}, include_deleted : bool = False):
     db = await self.__mongo
-    ret = db.find_one_and_update({"_id" : dd_id, **softdel, **self.get_parsed_query(extend_query)}, {"$set" : dd})
-    iii = self.execute_hooks("post_save", iii, created=False)
-    return ret
+    ops = [ UpdateOne(*self.get_update(iii, only_fields, extend_query, include_deleted)) for iii, only_fields in items ]
+    await db.bulk_write(ops, ordered=True)
 
 
   def get_parsed_query(self, query):
@@ -180,14 +491,20 @@ class OdimMongo(Odim):
       elif op == Operation.isnot:
         rsp[k] = { "$ne" : v}
       elif op == Operation.contains:
-        rsp[k] = { "$regex" : '.*'+str(v)+'.*', "$options" : "i" }
+        rsp[k] = { "$regex" : re.escape(str(v)), "$options" : "i" }
+      elif op == Operation.startswith:
+        # anchored and case sensitive, so that it is an index range scan
+        rsp[k] = { "$regex" : "^"+re.escape(str(v)) }
+      elif op == Operation.search:
+        # needs the text index of the collection, the field name is only informative
+        rsp["$text"] = { "$search" : str(v) }
       elif op == Operation.gt:
         rsp[k] = { "$gt" : v}
       elif op == Operation.gte:
         rsp[k] = { "$gte" : v}
       elif op == Operation.lt:
         rsp[k] = { "$lt" : v}
-      elif op == Operation.gt:
+      elif op == Operation.lte:
         rsp[k] = { "$lte" : v}
       elif op == Operation.null:
         if v:
@@ -196,58 +513,139 @@ class OdimMongo(Odim):
           rsp["$and"] = [ {k : {"$exists" : True}}, {k: { "$ne" : None }} ]
     return rsp
 
-  async def find(self, query: dict, params : SearchParams = None, include_deleted : bool = False, retries=0):
-    if self.softdelete() and not include_deleted:
-      query = {self.softdelete(): False, **query}
-    #TODO use projection on model to limit to only desired fields
+  def get_find_params(self, params : SearchParams = None):
     find_params = {}
     if params:
-      find_params["skip"] = params.offset
+      find_params["skip"] = 0 if getattr(params, "after", None) else params.offset
       find_params["limit"] = params.limit
-      if params.sort not in (None,''):
-        find_params["sort"] = []
-        for so in params.sort.split(','):
-          if so[0] == "-":
-            find_params["sort"].append( (so[1:], DESCENDING) )
-          else:
-            find_params["sort"].append( (so, ASCENDING) )
-    query = self.get_parsed_query(query)
+      sort = self.get_sort(params)
+      if sort:
+        find_params["sort"] = [ (f, {"$meta" : "textScore"} if f == relevance_sort else DESCENDING if desc else ASCENDING) for f, desc in sort ]
+    return find_params
+
+
+  def get_keyset_query(self, query : dict, params : SearchParams = None):
+    ''' Restricts the parsed query to the documents sorted after the params.after cursor '''
+    keyset = self.get_keyset_values(params)
+    if not keyset:
+      return query
+    ors = []
+    for i, (f, desc, v) in enumerate(keyset):
+      cond = dict( (pf, convert_decimal(pv)) for pf, _, pv in keyset[:i] )
+      # nulls sort first ascending and last descending, $gt/$lt never match them
+      if v is None:
+        if desc:
+          continue
+        cond[f] = {"$ne" : None}
+      elif desc:
+        cond["$or"] = [ {f : {"$lt" : convert_decimal(v)}}, {f : None} ]
+      else:
+        cond[f] = {"$gt" : convert_decimal(v)}
+      ors.append(cond)
+    return { "$and" : [ query, { "$or" : ors } ] }
+
+  @instrumented("find")
+  @cached_query
+  async def find(self, query: dict, params : SearchParams = None, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None, prefetch : Optional[List[str]] = None):
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    self.record_query_shape(query, params)
+    model, projection = self.get_projection(fields, exclude)
+    find_params = self.get_find_params(params)
+    find_params["projection"] = projection
+    query = self.get_keyset_query(self.get_parsed_query(query), params)
     db = await self.__mongo
    
     rsplist = []
-    try:
-      results = db.find(query, **find_params)
-      for x in results:
-        x2 = self.execute_hooks("pre_init", x)
-        m = self.model( **x2 )
-        rsplist.append( self.execute_hooks("post_init", m) )
-      return rsplist
-    except Exception as e:
-      if retries > 5:
-            raise
-      log.warn(f'Mongo Query returned an error, retrying find({query})! {e}')
-      sleep(.2)
-      return await self.find(query, params, include_deleted, retries=retries+1)
-
-
-
-  async def count(self, query : dict, include_deleted : bool = False, retries=0):
+    for x in await db.find(query, **find_params):
+      x2 = await self.async_execute_hooks("pre_init", x)
+      m = self.hydrate(model, x2, trusted)
+      rsplist.append( await self.async_execute_hooks("post_init", m) )
+    if prefetch:
+      await references.prefetch(rsplist, model, prefetch)
+    return rsplist
+
+
+
+  async def iterate(self, query : dict, params : SearchParams = None, include_deleted : bool = False, batch_size : int = 100, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None):
     if self.softdelete() and not include_deleted:
       query = {self.softdelete(): False, **query}
+    self.record_query_shape(query, params)
+    model, projection = self.get_projection(fields, exclude)
+    find_params = self.get_find_params(params)
+    find_params["projection"] = projection
+    db = await self.__mongo
+    async for x in db.iterate(self.get_keyset_query(self.get_parsed_query(query), params), batch_size=batch_size, **find_params):
+      x2 = await self.async_execute_hooks("pre_init", x)
+      m = self.hydrate(model, x2, trusted)
+      yield await self.async_execute_hooks("post_init", m)
 
-    try:
-      db = await self.__mongo
-      c = db.count_documents(query)
-      return c
-    except Exception as e:
-      if retries > 5:
-        raise
-      log.warn(f'Mongo Query returned an error, retrying count({query})! {e}')
-      sleep(.2)
-      return await self.count(query, include_deleted, retries=retries+1)
+
+  @instrumented("count")
+  @cached_query
+  async def count(self, query : dict, include_deleted : bool = False, limit : Optional[int] = None):
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    self.record_query_shape(query)
+    db = await self.__mongo
+    return await db.count_documents(self.get_parsed_query(query), **({"limit" : limit} if limit else {}))
+
+
+  def get_index_spec(self, index : Index):
+    ''' The create_index keys and options of an index declaration '''
+    keys = [ ("_id" if f == "id" else f, TEXT if index.text else DESCENDING if desc else ASCENDING) for f, desc in index.fields ]
+    options = {"name" : index.name}
+    if index.unique:
+      options["unique"] = True
+    if index.partial:
+      options["partialFilterExpression"] = self.get_parsed_query(index.partial)
+    if index.ttl is not None:
+      options["expireAfterSeconds"] = index.ttl
+    return keys, options
+
+
+  def same_index(self, current : dict, keys : list, index : Index) -> bool:
+    if bool(current.get("unique")) != bool(index.unique) or current.get("expireAfterSeconds") != index.ttl:
+      return False
+    if index.text:
+      # text indexes are stored as _fts/_ftsx keys with the fields in weights
+      return sorted(current.get("weights", {}).keys()) == sorted( k for k, _ in keys )
+    return [ tuple(k) for k in current["key"] ] == keys
 
 
+  async def ensure_indexes(self) -> dict:
+    db = await self.__mongo
+    existing = await db.index_information()
+    rsp = {"created" : [], "existing" : [], "conflicts" : []}
+    for index in self.binding.indexes:
+      keys, options = self.get_index_spec(index)
+      current = existing.get(index.name)
+      if current is None:
+        await db.create_index(keys, **options)
+        rsp["created"].append(index.name)
+      elif self.same_index(current, keys, index):
+        rsp["existing"].append(index.name)
+      else:
+        log.warning("Index %s of %s differs from its declaration, drop it to have it recreated", index.name, self.get_collection_name)
+        rsp["conflicts"].append(index.name)
+    return rsp
+
+
+  @cached_query
+  async def estimate_count(self, query : dict, include_deleted : bool = False, cap : Optional[int] = None) -> int:
+    ''' Without filters this is the collection metadata count (estimated_document_count, soft deleted documents
+    included). Filtered queries have no cheap estimate on Mongo, they are counted up to cap (exactly without one) '''
+    if query:
+      return await self.count(query, include_deleted, limit=cap)
+    db = await self.__mongo
+    return await db.estimated_document_count()
+
+
+  @instrumented("delete")
   async def delete(self, obj : Union[str, ObjectId, BaseMongoModel], extend_query : dict= {}, force_harddelete : bool = False):
+    tx = self.get_transaction()
+    if tx is not None:
+      return await tx.delete(self, obj, extend_query, force_harddelete)
     if isinstance(obj, str):
       d = {"_id" : ObjectId(obj)}
     elif isinstance(obj, ObjectId):
@@ -258,17 +656,113 @@ class OdimMongo(Odim):
     softdelete = self.softdelete() and not force_harddelete
     db = await self.__mongo
     if self.has_hooks("pre_remove","post_remove"):
-      ret = db.find_one(d)
+      ret = await db.find_one(d)
       if not ret:
         raise NotFoundException()
-      ret = self.execute_hooks("pre_init", ret)
-      x = self.model(**ret)
-      x = self.execute_hooks("post_init", x)
-      x = self.execute_hooks("pre_remove", x, softdelete=softdelete)
+      ret = await self.async_execute_hooks("pre_init", ret)
+      x = self.hydrate(self.model, ret)
+      x = await self.async_execute_hooks("post_init", x)
+      x = await self.async_execute_hooks("pre_remove", x, softdelete=softdelete)
     if softdelete:
-      rsp = db.find_one_and_update(d, {"$set": {self.softdelete(): True}})
+      rsp = await db.find_one_and_update(d, {"$set": {self.softdelete(): True}})
     else:
-      rsp = db.delete_one(d)
+      rsp = await db.delete_one(d)
+    await self.invalidate_cache()
+    self.forget(getattr(obj, "id", obj))
     if self.has_hooks("post_remove"):
-      self.execute_hooks("post_remove", x, softdelete=softdelete)
+      await self.async_execute_hooks("post_remove", x, softdelete=softdelete)
     return rsp
+
+
+  async def write_deletes(self, ids : list, extend_query : dict = {}, softdelete : bool = False):
+    query = {"_id" : {"$in" : [ ObjectId(x) if isinstance(x, str) else x for x in ids ]}, **self.get_parsed_query(extend_query)}
+    db = await self.__mongo
+    if softdelete:
+      await db.update_many(query, {"$set": {self.softdelete(): True}})
+    else:
+      await db.delete_many(query)
+
+
+  @classmethod
+  async def begin_transaction(cls, tx : Transaction):
+    db = await get_mongo_client(tx.alias)
+    session = await maybe_await(db.client.start_session())
+    session.start_transaction()
+    tx.handle = session
+
+  @classmethod
+  async def commit_transaction(cls, tx : Transaction):
+    try:
+      await maybe_await(tx.handle.commit_transaction())
+    finally:
+      session, tx.handle = tx.handle, None
+      await maybe_await(session.end_session())
+
+  @classmethod
+  async def rollback_transaction(cls, tx : Transaction):
+    if tx.handle is None:
+      return
+    try:
+      if tx.handle.in_transaction:
+        await maybe_await(tx.handle.abort_transaction())
+    finally:
+      await maybe_await(tx.handle.end_session())
+
+
+  async def load_matching(self, db, query : dict):
+    ''' Instances (with init hooks) of the documents matching the already parsed query '''
+    rsplist = []
+    for x in await db.find(query):
+      x2 = await self.async_execute_hooks("pre_init", x)
+      rsplist.append( await self.async_execute_hooks("post_init", self.hydrate(self.model, x2)) )
+    return rsplist
+
+
+  @instrumented("update_many")
+  async def update_many(self, query : dict, set_fields : dict, include_deleted : bool = False, hooks : bool = True) -> int:
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    query = self.get_parsed_query(query)
+    db = await self.__mongo
+    objs = None
+    if hooks and self.has_hooks("pre_save", "post_save"):
+      objs = await self.load_matching(db, query)
+      for i, obj in enumerate(objs):
+        for k, v in set_fields.items():
+          setattr(obj, k, v)
+        objs[i] = await self.async_execute_hooks("pre_save", obj, created=False)
+      query = {**query, "_id" : {"$in" : [obj.id for obj in objs]}}
+    rsp = await db.update_many(query, {"$set" : convert_decimal(set_fields)})
+    await self.invalidate_cache()
+    self.forget()
+    if objs:
+      for obj in objs:
+        await self.async_execute_hooks("post_save", obj, created=False)
+    return rsp.modified_count
+
+
+  @instrumented("delete_many")
+  async def delete_many(self, query : dict, force_harddelete : bool = False, include_deleted : bool = False, hooks : bool = True) -> int:
+    softdelete = self.softdelete() and not force_harddelete
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    query = self.get_parsed_query(query)
+    db = await self.__mongo
+    objs = None
+    if hooks and self.has_hooks("pre_remove", "post_remove"):
+      objs = await self.load_matching(db, query)
+      for i, obj in enumerate(objs):
+        objs[i] = await self.async_execute_hooks("pre_remove", obj, softdelete=softdelete)
+      query = {**query, "_id" : {"$in" : [obj.id for obj in objs]}}
+    if softdelete:
+      rsp = await db.update_many(query, {"$set": {self.softdelete(): True}})
+      cnt = rsp.modified_count
+    else:
+      rsp = await db.delete_many(query)
+      cnt = rsp.deleted_count
+    await self.invalidate_cache()
+    self.forget()
+    if objs:
+      for obj in objs:
+        await self.async_execute_hooks("post_remove", obj, softdelete=softdelete)
+    return cnt
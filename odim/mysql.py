@@ -1,28 +1,169 @@
+import asyncio
 import logging
 import re
+import time
+from contextlib import asynccontextmanager
 from enum import Enum
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import aiomysql.cursors
+import pymysql.err
 from pydantic import BaseModel
 from pymysql import escape_string
-from pymysql.converters import escape_bytes_prefixed, escape_item
 
-from odim import BaseOdimModel, NotFoundException, Odim, Operation, SearchParams, get_connection_info
+from odim import BaseOdimModel, NotFoundException, Odim, Operation, SearchParams, get_connection_info, relevance_sort
+from odim import references
+from odim.transaction import Transaction, get_transaction
+from odim.cache import cached_query
+from odim.metrics import instrumented, observe_statement
+from odim.indexes import Index
+from odim.helper import RetryPolicy, chunked, get_config, get_connection, register_connection
 
 log = logging.getLogger("uvicorn")
-pools = {}
+
+
+# the connection options handed to aiomysql.create_pool with their types, and the ones odim reads itself
+pool_options = {"minsize" : (int, ), "maxsize" : (int, ), "pool_recycle" : (int, float), "connect_timeout" : (int, float),
+                "charset" : (str, ), "autocommit" : (bool, type(None))}
+odim_options = ("acquire_timeout", "retries", "retry_backoff", "retry_max_backoff", "retry_jitter")
+
+
+def get_pool_kwargs(db, options : dict) -> dict:
+  ''' The create_pool arguments from the connection options, checked by name and type so that e.g. a mistyped option
+  or autocommit=yes does not silently change the pool '''
+  kw = {}
+  for k, v in options.items():
+    if k in pool_options:
+      types = pool_options[k]
+      if not isinstance(v, types) or (isinstance(v, bool) and bool not in types):
+        raise AttributeError("Option '%s' of '%s' must be %s, not %r" % (k, db, " or ".join(t.__name__ for t in types), v))
+      kw[k] = v
+    elif k not in odim_options:
+      raise AttributeError("Unknown option '%s' of '%s', use %s" % (k, db, ", ".join(list(pool_options)+list(odim_options))))
+  return kw
+
+# client errors of a dropped or unreachable server: can't connect, server has gone away, lost connection during query
+reconnect_errors = (2003, 2006, 2013)
+# the subset where the statement surely did not run, so writes can be retried too
+unsent_errors = (2003, 2006)
+
+
+class PoolState(object):
+  ''' Settings and counters of the pool opened for one DATABASES alias '''
+
+  def __init__(self, pool, options : dict):
+    self.pool = pool
+    self.acquire_timeout = options.get("acquire_timeout")
+    self.retry = RetryPolicy.from_options(options)
+    self.waiters = 0
+    self.acquires = 0
+    self.acquire_wait = 0.0
+    self.acquire_wait_max = 0.0
+    self.timeouts = 0
+    self.retries = 0
+    self.errors = 0
+
+  def stats(self):
+    return {"size" : self.pool.size,
+            "minsize" : self.pool.minsize,
+            "maxsize" : self.pool.maxsize,
+            "in_use" : self.pool.size - self.pool.freesize,
+            "free" : self.pool.freesize,
+            "waiters" : self.waiters,
+            "acquires" : self.acquires,
+            "acquire_wait_avg_ms" : 1000*self.acquire_wait/self.acquires if self.acquires else 0.0,
+            "acquire_wait_max_ms" : 1000*self.acquire_wait_max,
+            "acquire_timeouts" : self.timeouts,
+            "retries" : self.retries,
+            "errors" : self.errors}
+
+
+pool_states = {}
+
+def get_pool_stats(db : Optional[str] = None) -> dict:
+  ''' Usage of the open pools per alias (or of one alias): connections in use and free, coroutines waiting for one,
+  acquire wait times, timeouts and retries '''
+  if db is not None:
+    return pool_states[db].stats() if db in pool_states else {}
+  return { alias : state.stats() for alias, state in pool_states.items() }
+
+
+async def close_pool(db, pool):
+  if pool_states.get(db) and pool_states[db].pool is pool:
+    del pool_states[db]
+  pool.close()
+  await pool.wait_closed()
 
 
 async def connected_pool(db):
-  global pools
-  if not db in pools:
+  pool = get_connection(db)
+  if pool is None:
     cn = get_connection_info(db)
-    if not cn.port:
-      cn.port = 3306
-    pools[db] =  await aiomysql.create_pool(host=cn.host, port=cn.port, user=cn.username, password=cn.password,
-                                            db=cn.db, cursorclass=aiomysql.cursors.DictCursor)
-  return pools[db]
+    kw = get_pool_kwargs(db, cn.options)
+    pool = await aiomysql.create_pool(host=cn.host, port=cn.port or 3306, user=cn.username, password=cn.password,
+                                      db=cn.db, cursorclass=aiomysql.cursors.DictCursor, **kw)
+    pool_states[db] = PoolState(pool, cn.options)
+    register_connection(db, pool, close=lambda: close_pool(db, pool))
+  return pool
+
+
+def get_pool_state(db, pool) -> PoolState:
+  state = pool_states.get(db)
+  if state is None or state.pool is not pool:
+    # pools registered from outside with register_connection
+    options = get_connection_info(db).options if db in get_config('DATABASES', default={}) else {}
+    state = pool_states[db] = PoolState(pool, options)
+  return state
+
+
+@asynccontextmanager
+async def acquire(db):
+  ''' A connection of the alias' pool, waiting at most the acquire_timeout option '''
+  pool = await connected_pool(db)
+  state = get_pool_state(db, pool)
+  started = time.perf_counter()
+  state.waiters+= 1
+  try:
+    if state.acquire_timeout:
+      conn = await asyncio.wait_for(pool.acquire(), state.acquire_timeout)
+    else:
+      conn = await pool.acquire()
+  except asyncio.TimeoutError:
+    state.timeouts+= 1
+    raise
+  finally:
+    state.waiters-= 1
+  waited = time.perf_counter() - started
+  state.acquires+= 1
+  state.acquire_wait+= waited
+  state.acquire_wait_max = max(state.acquire_wait_max, waited)
+  try:
+    yield conn
+  finally:
+    await pool.release(conn)
+
+
+def is_reconnect_error(e, write : bool = False) -> bool:
+  if isinstance(e, pymysql.err.InterfaceError):
+    # the connection was already closed, nothing was sent
+    return True
+  if isinstance(e, pymysql.err.OperationalError) and e.args:
+    return e.args[0] in (unsent_errors if write else reconnect_errors)
+  return False
+
+
+async def with_retry(db, fnc, write : bool = False):
+  ''' Runs fnc on a fresh connection again when the server dropped the connection. Writes are only repeated when
+  the statement surely did not reach the server '''
+  state = get_pool_state(db, await connected_pool(db))
+  def on_retry(e, attempt):
+    state.retries+= 1
+    log.warning("MySQL connection to %s dropped, retrying (%d): %s", db, attempt+1, e)
+  try:
+    return await state.retry.call(fnc, lambda e: is_reconnect_error(e, write), on_retry)
+  except Exception:
+    state.errors+= 1
+    raise
 
 
 class Op(Enum):
@@ -31,22 +172,150 @@ class Op(Enum):
   fetchall = 2
 
 
-async def execute_sql(db, sql, co : Op = Op.execute):
-  log.info(sql)
-  pool = await connected_pool(db)
-  async with pool.acquire() as conn:
-    cursor = await conn.cursor()
-    executed = await cursor.execute(sql)
-    if co == Op.fetchone:
-      return await cursor.fetchone()
-    elif co == Op.fetchall:
-      return await cursor.fetchall()
-    else: #execute
-      await conn.commit()
-      return cursor
-
-    #TODO handle disconnects and ends
-    #TODO pymysql.err.OperationalError
+async def fetch_result(cursor, co : Op):
+  if co == Op.fetchone:
+    return await cursor.fetchone()
+  elif co == Op.fetchall:
+    return await cursor.fetchall()
+  return cursor
+
+
+async def execute_sql(db, sql, co : Op = Op.execute, args : Optional[tuple] = None):
+  ''' Runs the statement, with args the %s placeholders of the sql are filled with the values escaped by the driver.
+  While a transaction of the alias is flushing its pinned connection is used and left uncommitted. The time it took
+  goes to the metrics of the running operation, slow statements are logged (see odim.metrics) '''
+  start = time.perf_counter()
+  tx = get_transaction(db)
+  try:
+    if tx is not None and tx.handle is not None:
+      async with tx.handle.cursor() as cursor:
+        await cursor.execute(sql, args)
+        return await fetch_result(cursor, co)
+    async def run():
+      async with acquire(db) as conn:
+        async with conn.cursor() as cursor:
+          await cursor.execute(sql, args)
+          if co == Op.execute:
+            await conn.commit()
+          return await fetch_result(cursor, co)
+    return await with_retry(db, run, write=(co == Op.execute))
+  finally:
+    observe_statement("mysql", sql, time.perf_counter()-start)
+
+
+async def execute_sql_batch(db, statements : List[tuple]) -> list:
+  ''' Runs the (sql, args) statements on one connection in one transaction, either all of them are written or none.
+  While a transaction of the alias is flushing they go to its pinned connection and are committed with it. Returns the
+  lastrowid of each statement '''
+  async def run_on(conn):
+    rsp = []
+    for sql, args in statements:
+      start = time.perf_counter()
+      try:
+        async with conn.cursor() as cursor:
+          await cursor.execute(sql, args)
+          rsp.append(cursor.lastrowid)
+      finally:
+        observe_statement("mysql", sql, time.perf_counter()-start)
+    return rsp
+  tx = get_transaction(db)
+  if tx is not None and tx.handle is not None:
+    return await run_on(tx.handle)
+  async def run():
+    async with acquire(db) as conn:
+      await conn.begin()
+      try:
+        rsp = await run_on(conn)
+        await conn.commit()
+      except BaseException:
+        await conn.rollback()
+        raise
+      return rsp
+  return await with_retry(db, run, write=True)
+
+
+async def iterate_sql(db, sql, batch_size : int = 100, args : Optional[tuple] = None):
+  ''' Streams the rows of a SELECT through a server side cursor, keeping only batch_size rows in memory. It is not
+  retried on a dropped connection, the caller may have consumed rows already '''
+  async with acquire(db) as conn:
+    cursor = await conn.cursor(aiomysql.cursors.SSDictCursor)
+    try:
+      start = time.perf_counter()
+      await cursor.execute(sql, args)
+      observe_statement("mysql", sql, time.perf_counter()-start)
+      while True:
+        rows = await cursor.fetchmany(batch_size)
+        if not rows:
+          break
+        for row in rows:
+          yield row
+    finally:
+      await cursor.close()
+
+
+auto_increment_steps = {}
+
+async def get_auto_increment_step(db) -> int:
+  ''' The server's auto_increment_increment, the distance between the ids generated by one multi row INSERT '''
+  if db not in auto_increment_steps:
+    rsp = await execute_sql(db, "SELECT @@auto_increment_increment AS step", Op.fetchone, ())
+    auto_increment_steps[db] = int(rsp["step"]) if rsp and rsp.get("step") else 1
+  return auto_increment_steps[db]
+
+
+sql_templates = {}
+max_sql_templates = 4096
+
+def compiled_sql(key, build):
+  ''' The SQL template of a statement shape (model, operation, field names and operators), built once and reused.
+  Only the placeholders are in the template, the values go separately as args to execute_sql '''
+  sql = sql_templates.get(key)
+  if sql is None:
+    if len(sql_templates) >= max_sql_templates:
+      sql_templates.clear()
+    sql = build()
+    sql_templates[key] = sql
+  return sql
+
+
+def quote_name(name, action : str = "Using"):
+  if not isinstance(name, str) or not re.fullmatch("[a-zA-Z0-9_]+", name):
+    raise AttributeError("%s a non ASCII field name" % action)
+  return "`"+name+"`"
+
+
+def quote_table(table):
+  return escape_string(table).replace("%", "%%")
+
+
+comparisons = {
+  Operation.exact : "=%s",
+  Operation.isnot : "!=%s",
+  Operation.contains : " LIKE %s",
+  Operation.startswith : " LIKE %s",
+  Operation.gt : " > %s",
+  Operation.gte : " >= %s",
+  Operation.lt : " < %s",
+  Operation.lte : " <= %s",
+}
+
+
+def escape_like(value) -> str:
+  return str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def comparison_arg(op, value):
+  if op == Operation.contains:
+    return "%"+escape_like(value)+"%"
+  if op == Operation.startswith:
+    # a prefix pattern can use the index of the column
+    return escape_like(value)+"%"
+  return value
+
+
+def match_against(k : str) -> str:
+  ''' MATCH over the FULLTEXT index of the field(s), the field of `title,body__search` may list several '''
+  return "MATCH (%s) AGAINST (%%s IN NATURAL LANGUAGE MODE)" % ",".join( quote_name(f, "Searching on") for f in k.split(",") )
 
 
 
@@ -57,179 +326,523 @@ class BaseMysqlModel(BaseOdimModel):
 class OdimMysql(Odim):
   protocols = ["mysql"]
 
-  def escape(self, obj):
-    """ Escape whatever value you pass to it"""
-    if isinstance(obj, str):
-      return "'" + escape_string(obj) + "'"
-    if isinstance(obj, bytes):
-      return escape_bytes_prefixed(obj)
-    return escape_item(obj, getattr(self.model.Config, 'charset', 'utf-8'))
-
+  @classmethod
+  def resolve_collection_name(cls, model):
+    if hasattr(model, 'Config'):
+      if hasattr(model.Config, 'table_name'):
+        cn = model.Config.table_name
+        return cn
+    return model.__class__.__name__
 
   def get_table_name(self):
-    ci = self.get_connection_identifier
-    if hasattr(self.model, 'Config'):
-      if hasattr(self.model.Config, 'table_name'):
-        cn = self.model.Config.table_name
-        return ci, cn
-    return ci, self.model.__class__.__name__
+    return self.get_connection_identifier, self.binding.collection_name
 
 
-  async def get(self, id : str, extend_query : dict= {}, include_deleted : bool = False):
+  @instrumented("get")
+  async def get(self, id : str, extend_query : dict= {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None):
     '''
     Retrieves the document by its id
     :param id: id of the docuemnt
     :param kwargs:
     :return: the document as pydantic instance '''
-    #TODO just the desired fields
+    im, x = self.lookup(id, extend_query, include_deleted, fields, exclude)
+    if x is not None:
+      return x
     db, table = self.get_table_name()
-    query = {"id" : self.escape(id), **extend_query}
+    query = {"id" : id, **extend_query}
     if self.softdelete() and not include_deleted:
       query[self.softdelete()] = False
-    wh = self.get_where(query)
-    rsp = await execute_sql(db, "SELECT * FROM %s WHERE %s" % (escape_string(table), wh), Op.fetchone)
+    wh, args = self.get_where(query)
+    model, columns = self.get_projection(fields, exclude)
+    sql = compiled_sql((self.model, "get", table, tuple(columns or ()), wh),
+                       lambda: "SELECT %s FROM %s WHERE %s" % (self.get_columns(columns), quote_table(table), wh))
+    rsp = await execute_sql(db, sql, Op.fetchone, args)
     if not rsp:
       raise NotFoundException()
-    ret = self.execute_hooks("pre_init", rsp)
-    x = self.model(**ret)
-    return self.execute_hooks("post_init", x)
-
-  def get_field_pairs(self, field_dict):
-    inss = []
-    for k, v in field_dict.items():
-      if not re.match("[a-zA-Z0-9_]+", k):
-        raise AttributeError("Writing a non ASCII field name")
-      if k!="id":
-        inss.append( "`"+k+"`="+str(self.escape(v)) )
-    return ",".join(inss)
+    ret = await self.async_execute_hooks("pre_init", rsp)
+    x = self.hydrate(model, ret, trusted)
+    x = await self.async_execute_hooks("post_init", x)
+    if im is not None:
+      im.put(self.model, x)
+    return x
+
+  async def fetch_ids(self, ids : list, extend_query : dict= {}, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None) -> list:
+    db, table = self.get_table_name()
+    query = dict(extend_query)
+    if self.softdelete() and not include_deleted:
+      query[self.softdelete()] = False
+    wh, args = self.get_where(query)
+    model, columns = self.get_projection(fields, exclude)
+    sql = "SELECT %s FROM %s WHERE %s AND `id` IN (%s)" % (self.get_columns(columns), quote_table(table), wh, ",".join("%s" for _ in ids))
+    rsplist = []
+    for row in await execute_sql(db, sql, Op.fetchall, args + tuple(ids)):
+      x2 = await self.async_execute_hooks("pre_init", row)
+      rsplist.append( await self.async_execute_hooks("post_init", self.hydrate(model, x2, trusted)) )
+    return rsplist
+
+  def get_columns(self, columns : Optional[List[str]] = None):
+    if not columns:
+      return "*"
+    return ",".join(quote_name(c, "Selecting") for c in columns)
+
+  def get_field_pairs(self, field_dict) -> Tuple[str, tuple]:
+    ''' The `field`=%s list of a SET clause and its values, the id is never written '''
+    keys = tuple(k for k in field_dict.keys() if k!="id")
+    sql = compiled_sql((self.model, "set", keys), lambda: ",".join(quote_name(k, "Writing")+"=%s" for k in keys))
+    return sql, tuple(field_dict[k] for k in keys)
 
+  @instrumented("save")
   async def save(self, extend_query : dict= {}, include_deleted : bool = False):
     ''' Saves the document and returns its identifier '''
+    tx = self.get_transaction()
+    if tx is not None:
+      return await tx.save(self, extend_query, include_deleted)
     db, table = self.get_table_name()
-    iii = self.execute_hooks("pre_save", self.instance, created=(not self.instance.id))
+    iii = await self.async_execute_hooks("pre_save", self.instance, created=(not self.instance.id))
     do = iii.dict(by_alias=True)
 
     if self.instance.id in (None, ""):
       if self.softdelete() and self.softdelete() not in do:
         do[self.softdelete()] = False
-      upff = self.get_field_pairs({**extend_query, **do})
-      rsp = await execute_sql(db, "INSERT INTO %s SET %s" % (escape_string(table), upff), Op.execute)
+      upff, args = self.get_field_pairs({**extend_query, **do})
+      rsp = await execute_sql(db, "INSERT INTO %s SET %s" % (quote_table(table), upff), Op.execute, args)
       self.instance.id = rsp.lastrowid
       iii.id = self.instance.id
-      iii = self.execute_hooks("post_save", iii, created=True)
+      await self.invalidate_cache()
+      self.remember(self.instance)
+      iii = await self.async_execute_hooks("post_save", iii, created=True)
       return rsp.lastrowid
     else:
       softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
-      upff = self.get_field_pairs(do)
-      whr = self.get_where({"id" : self.instance.id, **softdel, **extend_query})
-      sql = "UPDATE %s SET %s WHERE %s" % (escape_string(table), upff, whr)
-      rsp = await execute_sql(db, sql, Op.execute)
-      iii = self.execute_hooks("post_save", iii, created=False)
+      upff, args = self.get_field_pairs(do)
+      whr, wargs = self.get_where({"id" : self.instance.id, **softdel, **extend_query})
+      sql = "UPDATE %s SET %s WHERE %s" % (quote_table(table), upff, whr)
+      rsp = await execute_sql(db, sql, Op.execute, args+wargs)
+      await self.invalidate_cache()
+      self.remember(self.instance)
+      iii = await self.async_execute_hooks("post_save", iii, created=False)
       return self.instance.id
 
 
+  def get_insert_sql(self, table, rows : List[dict]) -> Tuple[str, tuple]:
+    ''' Multi row INSERT ... VALUES, the columns missing in a row get their DEFAULT '''
+    columns = []
+    for row in rows:
+      for k in row.keys():
+        if k not in columns:
+          columns.append(k)
+    columns = tuple(columns)
+    values = []
+    args = []
+    for row in rows:
+      mask = tuple(c in row for c in columns)
+      values.append( compiled_sql((self.model, "values", columns, mask),
+                                  lambda: "(" + ",".join("%s" if m else "DEFAULT" for m in mask) + ")") )
+      args.extend(row[c] for c in columns if c in row)
+    head = compiled_sql((self.model, "insert", table, columns),
+                        lambda: "INSERT INTO %s (%s) VALUES " % (quote_table(table), ",".join(quote_name(c, "Writing") for c in columns)))
+    return head + ",".join(values), tuple(args)
+
+
+  @instrumented("save_many")
+  async def save_many(self, objs : List[BaseModel], ordered : bool = False, chunk_size : int = 1000, extend_query : dict = {}, include_deleted : bool = False) -> list:
+    ''' Each chunk is written in one transaction on one connection: one multi row INSERT for the new rows and one UPDATE
+    per row that already has an id, scoped by extend_query/softdelete like in save().
+    The ids of new rows are derived from the first generated auto increment value, stepping by auto_increment_increment.
+    That holds for InnoDB tables, which allocate the ids of a multi row INSERT without explicit ids ("simple insert") in
+    one block in every innodb_autoinc_lock_mode, but not for other storage engines. MySQL always stops at the first
+    failing row, `ordered` is accepted for compatibility. '''
+    if self.get_transaction() is not None:
+      return [ await Odim(obj).save(extend_query, include_deleted) for obj in objs ]
+    for chunk in chunked(objs, chunk_size):
+      saved = []
+      for obj in chunk:
+        created = obj.id in (None, "")
+        iii = await self.async_execute_hooks("pre_save", obj, created=created)
+        saved.append((obj, iii, created))
+      await self.write_many([ (iii, created) for _, iii, created in saved ], ordered, extend_query, include_deleted)
+      for obj, iii, created in saved:
+        obj.id = iii.id
+        self.remember(obj)
+      await self.invalidate_cache()
+      for _, iii, created in saved:
+        await self.async_execute_hooks("post_save", iii, created=created)
+    return [obj.id for obj in objs]
+
+
+  async def write_many(self, items : List[tuple], ordered : bool = False, extend_query : dict = {}, include_deleted : bool = False):
+    db, table = self.get_table_name()
+    inserts = []
+    updates = []
+    for iii, created in items:
+      do = iii.dict(by_alias=True)
+      if created:
+        if self.softdelete() and self.softdelete() not in do:
+          do[self.softdelete()] = False
+        do = {**extend_query, **do}
+        do.pop("id", None)
+        inserts.append((iii, do))
+      else:
+        updates.append(do)
+    statements = []
+    if inserts:
+      statements.append(self.get_insert_sql(table, [do for _, do in inserts]))
+    # existing rows are scoped like in save(), a row of another tenant or a soft deleted one is left alone
+    softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
+    for do in updates:
+      upff, args = self.get_field_pairs(do)
+      whr, wargs = self.get_where({"id" : do["id"], **softdel, **extend_query})
+      statements.append(("UPDATE %s SET %s WHERE %s" % (quote_table(table), upff, whr), args+wargs))
+    if not statements:
+      return
+    step = await get_auto_increment_step(db) if len(inserts) > 1 else 1
+    rowids = await execute_sql_batch(db, statements)
+    for i, (iii, do) in enumerate(inserts):
+      iii.id = rowids[0] + i*step
+
+
+  @instrumented("update")
   async def update(self, extend_query : dict= {}, include_deleted : bool = False, only_fields : Optional[List['str']] = None):
     ''' Updates just the partial document '''
+    tx = self.get_transaction()
+    if tx is not None:
+      return await tx.update(self, extend_query, include_deleted, only_fields)
+    iii = await self.async_execute_hooks("pre_save", self.instance, created=False)
+    await self.write_updates([(iii, only_fields)], extend_query, include_deleted)
+    await self.invalidate_cache()
+    self.remember_update(iii)
+    iii = await self.async_execute_hooks("post_save", iii, created=False)
+
+
+  async def write_updates(self, items : List[tuple], extend_query : dict = {}, include_deleted : bool = False):
+    ''' One UPDATE per instance, the set fields differ from row to row '''
     db, table = self.get_table_name()
-    iii = self.execute_hooks("pre_save", self.instance, created=False)
-    dd = iii.dict(exclude_unset=True, by_alias=True)
-    dd_id = dd["id"]
-    del dd["id"]
-    if only_fields and len(only_fields)>0:
-      dd = dict([(key, val) for key, val in dd.items() if key in only_fields])
     softdel = {self.softdelete(): False} if self.softdelete() and not include_deleted else {}
-    upff = self.get_field_pairs(dd)
-    whr = self.get_where({"id" :dd_id, **softdel, **extend_query})
-    sql = "UPDATE %s SET %s WHERE %s" % (escape_string(table), upff, whr)
-    rsp = await execute_sql(db, sql, Op.execute)
-    iii = self.execute_hooks("post_save", iii, created=False)
-
-
-  def get_where(self, query):
+    for iii, only_fields in items:
+      dd = iii.dict(exclude_unset=True, by_alias=True)
+      dd_id = dd["id"]
+      del dd["id"]
+      if only_fields and len(only_fields)>0:
+        dd = dict([(key, val) for key, val in dd.items() if key in only_fields])
+      upff, args = self.get_field_pairs(dd)
+      whr, wargs = self.get_where({"id" :dd_id, **softdel, **extend_query})
+      sql = "UPDATE %s SET %s WHERE %s" % (quote_table(table), upff, whr)
+      await execute_sql(db, sql, Op.execute, args+wargs)
+
+
+  def get_where(self, query) -> Tuple[str, tuple]:
+    ''' The WHERE template of the query shape and the values for its placeholders '''
+    ops = self.parse_query_operations(query)
+    shape = tuple( (k, op, bool(v) if op == Operation.null else None) for k, (op, v) in ops.items() )
+    args = tuple( comparison_arg(op, v) for op, v in ops.values() if op in comparisons or op == Operation.search )
+    return compiled_sql((self.model, "where", shape), lambda: self.build_where(shape)), args
+
+  def build_where(self, shape):
     whr = []
-    for k, (op, v) in self.parse_query_operations(query).items():
-      if not re.match("[a-zA-Z0-9_]+", k):
-        raise AttributeError("Searching on a non ASCII field name")
-      if op == Operation.exact:
-        whr.append( "`"+k+"`="+str(self.escape(v)) )
-      elif op == Operation.isnot:
-        whr.append( "`"+k+"`!="+str(self.escape(v)) )
-      elif op == Operation.contains:
-        whr.append( "`"+k+"` LIKE '%"+str(escape_string(v)+"%'") )
-      elif op == Operation.gt:
-        whr.append( "`"+k+"` > "+str(self.escape(v)) )
-      elif op == Operation.gte:
-        whr.append( "`"+k+"` >= "+str(self.escape(v)) )
-      elif op == Operation.lt:
-        whr.append( "`"+k+"` < "+str(self.escape(v)) )
-      elif op == Operation.lte:
-        whr.append( "`"+k+"` <= "+str(self.escape(v)) )
+    for k, op, isnull in shape:
+      if op == Operation.search:
+        whr.append( match_against(k) )
       elif op == Operation.null:
-        if v:
-          whr.append( "`"+k+"` IS NULL" )
-        else:
-          whr.append( "`"+k+"` IS NOT NULL" )
+        whr.append( quote_name(k, "Searching on")+(" IS NULL" if isnull else " IS NOT NULL") )
+      elif op in comparisons:
+        whr.append( quote_name(k, "Searching on")+comparisons[op] )
     return  "1" if len(whr) == 0  else " AND ".join(whr)
 
 
-  async def find(self, query : dict, params : SearchParams = None, include_deleted : bool = False):
+  @instrumented("find")
+  @cached_query
+  async def find(self, query : dict, params : SearchParams = None, include_deleted : bool = False, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None, prefetch : Optional[List[str]] = None):
     ''' Performs search using a dictionary qury to find documents on that particular collection/table
     :param query: dictionary of field:value pairs
     :param params: additional search params like ordering and limit offset
+    :param fields: select only these columns
+    :param exclude: select all model fields but these
     :return: the list of documents as per pydantic type    '''
     db, table = self.get_table_name()
-    if self.softdelete() and not include_deleted:
-      query = {self.softdelete(): False, **query}
-    where = self.get_where(query)
-    sql_params = ""
-    if params:
-      if params.sort not in (None, ''):
-        sql_params+= " ORDER BY "
-        paramslist = []
-        for x in params.sort.split(","):
-          paramslist.append( (x[1:]+" DESC ") if x[0] == "-" else (x+" ASC ") )
-        sql_params+= ",".join(paramslist)
-      if params.limit:
-        sql_params+= " LIMIT "+str(params.limit)
-      if params.offset:
-        sql_params+= " OFFSET "+str(params.offset)
-    rsp = await execute_sql(db, "SELECT * FROM %s WHERE %s %s" % (escape_string(table), where, sql_params), Op.fetchall)
+    model, columns = self.get_projection(fields, exclude)
+    sql, args = self.get_select_sql(table, query, params, include_deleted, columns)
+    rsp = await execute_sql(db, sql, Op.fetchall, args)
     rsplist = []
     for row in rsp:
-      x2 = self.execute_hooks("pre_init", row)
-      m = self.model( **row )
-      rsplist.append( self.execute_hooks("post_init", m) )
+      x2 = await self.async_execute_hooks("pre_init", row)
+      m = self.hydrate(model, x2, trusted)
+      rsplist.append( await self.async_execute_hooks("post_init", m) )
+    if prefetch:
+      await references.prefetch(rsplist, model, prefetch)
     return rsplist
 
 
-  async def count(self, query : dict, include_deleted : bool = False) -> int:
+  async def iterate(self, query : dict, params : SearchParams = None, include_deleted : bool = False, batch_size : int = 100, fields : Optional[List[str]] = None, exclude : Optional[List[str]] = None, trusted : Optional[bool] = None):
+    db, table = self.get_table_name()
+    model, columns = self.get_projection(fields, exclude)
+    sql, args = self.get_select_sql(table, query, params, include_deleted, columns)
+    async for row in iterate_sql(db, sql, batch_size, args):
+      x2 = await self.async_execute_hooks("pre_init", row)
+      m = self.hydrate(model, x2, trusted)
+      yield await self.async_execute_hooks("post_init", m)
+
+
+  def get_select_sql(self, table, query : dict, params : SearchParams = None, include_deleted : bool = False, columns : Optional[List[str]] = None) -> Tuple[str, tuple]:
+    ''' The SELECT of find/iterate and its arguments, the statement template is cached per query shape, sort and
+    pagination mode. Sort fields are validated like any other field name '''
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    self.record_query_shape(query, params)
+    where, args = self.get_where(query)
+    keyset = (self.get_keyset_values(params) if params else None) or []
+    sort = tuple(self.get_sort(params)) if params else ()
+    limit = params.limit if params else None
+    offset = params.offset if params and not keyset else None
+    for i, (f, desc, v) in enumerate(keyset):
+      if v is None and desc:
+        continue
+      args+= tuple( pv for _, _, pv in keyset[:i] if pv is not None ) + (() if v is None else (v, ))
+    searches = [ (k, v) for k, (op, v) in self.parse_query_operations(query).items() if op == Operation.search ]
+    if any( f == relevance_sort for f, _ in sort ):
+      if not searches:
+        raise AttributeError("Sorting by relevance needs a __search condition")
+      args+= tuple( v for _, v in searches ) * sum( 1 for f, _ in sort if f == relevance_sort )
+    if limit:
+      args+= (int(limit), )
+    if offset:
+      args+= (int(offset), )
+
+    def build():
+      wh = where
+      if keyset:
+        ors = []
+        for i, (f, desc, v) in enumerate(keyset):
+          # NULLs sort first ascending and last descending, < and > never match them
+          if v is None and desc:
+            continue
+          conds = [ quote_name(pf, "Sorting by")+(" IS NULL" if pv is None else "=%s") for pf, _, pv in keyset[:i] ]
+          name = quote_name(f, "Sorting by")
+          if v is None:
+            conds.append( name+" IS NOT NULL" )
+          elif desc:
+            conds.append( "("+name+" < %s OR "+name+" IS NULL)" )
+          else:
+            conds.append( name+" > %s" )
+          ors.append( "(" + " AND ".join(conds) + ")" )
+        wh = "(" + wh + ") AND (" + " OR ".join(ors) + ")"
+      sql_params = ""
+      if sort:
+        sql_params+= " ORDER BY " + ",".join( self.get_order_by(f, desc, searches) for f, desc in sort )
+      if limit:
+        sql_params+= " LIMIT %s"
+      if offset:
+        sql_params+= " OFFSET %s"
+      return "SELECT %s FROM %s WHERE %s%s" % (self.get_columns(columns), quote_table(table), wh, sql_params)
+    key = (self.model, "select", table, tuple(columns or ()), where, tuple((f, desc, v is None) for f, desc, v in keyset), sort, bool(limit), bool(offset))
+    return compiled_sql(key, build), args
+
+  def get_order_by(self, field, desc, searches):
+    if field == relevance_sort:
+      # most relevant first, like the Mongo textScore
+      return "+".join( match_against(k) for k, _ in searches ) + " DESC"
+    return quote_name(field, "Sorting by")+(" DESC" if desc else " ASC")
+
+
+  @instrumented("count")
+  @cached_query
+  async def count(self, query : dict, include_deleted : bool = False, limit : Optional[int] = None) -> int:
     ''' Do the search and count the documents
     :param query: dictionary of field:value pairs
+    :param limit: stop counting at this number
     :return: the number of results '''
     db, table = self.get_table_name()
     if self.softdelete() and not include_deleted:
       query = {self.softdelete(): False, **query}
-    where = self.get_where(query)
-    rsp = await execute_sql(db, "SELECT COUNT(*) as cnt FROM %s WHERE %s" % (escape_string(table), where), Op.fetchone)
+    self.record_query_shape(query)
+    where, args = self.get_where(query)
+    if limit:
+      sql = compiled_sql((self.model, "count_capped", table, where),
+                         lambda: "SELECT COUNT(*) as cnt FROM (SELECT 1 FROM %s WHERE %s LIMIT %%s) AS capped" % (quote_table(table), where))
+      args+= (int(limit), )
+    else:
+      sql = compiled_sql((self.model, "count", table, where),
+                         lambda: "SELECT COUNT(*) as cnt FROM %s WHERE %s" % (quote_table(table), where))
+    rsp = await execute_sql(db, sql, Op.fetchone, args)
     return rsp["cnt"]
 
 
+  def get_index_sql(self, table, index : Index) -> str:
+    ''' The CREATE INDEX of an index declaration. MySQL has no partial indexes, a full one is created for non unique
+    partial ones (ensure_indexes skips unique partial ones) '''
+    kind = "FULLTEXT " if index.text else "UNIQUE " if index.unique else ""
+    if index.text:
+      columns = ",".join( quote_name(f, "Indexing") for f in index.field_names )
+    else:
+      columns = ",".join( quote_name(f, "Indexing")+(" DESC" if desc else " ASC") for f, desc in index.fields )
+    return "CREATE %sINDEX %s ON %s (%s)" % (kind, quote_name(index.name, "Indexing"), quote_table(table), columns)
+
+
+  async def ensure_indexes(self) -> dict:
+    db, table = self.get_table_name()
+    rows = await execute_sql(db, "SHOW INDEX FROM %s" % quote_table(table), Op.fetchall, ())
+    existing = {}
+    for row in sorted(rows, key=lambda r: (r["Key_name"], r["Seq_in_index"])):
+      existing.setdefault(row["Key_name"], []).append(row)
+    rsp = {"created" : [], "existing" : [], "conflicts" : [], "skipped" : []}
+    for index in self.binding.indexes:
+      if index.ttl is not None:
+        log.warning("MySQL has no TTL indexes, skipping %s of %s", index.name, table)
+        rsp["skipped"].append(index.name)
+        continue
+      if index.partial and index.unique:
+        # a full unique index would reject rows the partial one allows, e.g. soft deleted duplicates
+        log.warning("MySQL has no partial indexes, skipping the unique partial index %s of %s", index.name, table)
+        rsp["skipped"].append(index.name)
+        continue
+      current = existing.get(index.name)
+      if current is None:
+        await execute_sql(db, self.get_index_sql(table, index), Op.execute, ())
+        rsp["created"].append(index.name)
+      elif [ r["Column_name"] for r in current ] == index.field_names and (not current[0]["Non_unique"]) == bool(index.unique) and (current[0].get("Index_type") == "FULLTEXT") == bool(index.text):
+        rsp["existing"].append(index.name)
+      else:
+        log.warning("Index %s of %s differs from its declaration, drop it to have it recreated", index.name, table)
+        rsp["conflicts"].append(index.name)
+    return rsp
+
+
+  @cached_query
+  async def estimate_count(self, query : dict, include_deleted : bool = False, cap : Optional[int] = None) -> int:
+    ''' The optimizer's row estimate, information_schema TABLE_ROWS without filters or EXPLAIN rows with them '''
+    db, table = self.get_table_name()
+    if not query:
+      rsp = await execute_sql(db, "SELECT TABLE_ROWS as cnt FROM information_schema.TABLES WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s", Op.fetchone, (table, ))
+      if rsp and rsp["cnt"] is not None:
+        return rsp["cnt"]
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    where, args = self.get_where(query)
+    rsp = await execute_sql(db, "EXPLAIN SELECT * FROM %s WHERE %s" % (quote_table(table), where), Op.fetchone, args)
+    return int(rsp["rows"] or 0) if rsp else 0
+
+
+  @instrumented("delete")
   async def delete(self, obj : Union[str, int, BaseModel], extend_query : dict= {}, force_harddelete : bool = False):
     ''' Delete the document from storage '''
+    tx = self.get_transaction()
+    if tx is not None:
+      return await tx.delete(self, obj, extend_query, force_harddelete)
     db, table = self.get_table_name()
     id = obj if not isinstance(obj, BaseModel) else obj.id
     softdelete = self.softdelete() and not force_harddelete
     if self.has_hooks("pre_remove","post_remove"):
       x = await self.get(id)
-      x = self.execute_hooks("pre_remove", x, softdelete=softdelete)
+      x = await self.async_execute_hooks("pre_remove", x, softdelete=softdelete)
+    whr, args = self.get_where({"id" : id, **extend_query})
     if softdelete:
-      whr = self.get_where({"id" : self.escape(id), **extend_query})
-      await execute_sql(db, "UPDATE %s SET `%s`=true WHERE %s" % (escape_string(table), self.softdelete(), whr), Op.execute)
+      await execute_sql(db, "UPDATE %s SET %s=true WHERE %s" % (quote_table(table), quote_name(self.softdelete()), whr), Op.execute, args)
     else:
-      whr = self.get_where({"id" : self.escape(id), **extend_query})
-      await execute_sql(db, "DELETE FROM %s WHERE %s" % (escape_string(table), whr), Op.execute)
+      await execute_sql(db, "DELETE FROM %s WHERE %s" % (quote_table(table), whr), Op.execute, args)
+    await self.invalidate_cache()
+    self.forget(id)
     if self.has_hooks("post_remove"):
-      self.execute_hooks("post_remove", x, softdelete=softdelete)
+      await self.async_execute_hooks("post_remove", x, softdelete=softdelete)
     #TODO detect not found
 
 
+
+
+  async def load_matching(self, db, table, where : str, args : tuple = ()):
+    ''' Instances (with init hooks) of the rows matching the where clause '''
+    rsplist = []
+    for row in await execute_sql(db, "SELECT * FROM %s WHERE %s" % (quote_table(table), where), Op.fetchall, args):
+      x2 = await self.async_execute_hooks("pre_init", row)
+      rsplist.append( await self.async_execute_hooks("post_init", self.hydrate(self.model, x2)) )
+    return rsplist
+
+
+  def get_ids_where(self, where : str, args : tuple, objs : List[BaseModel]) -> Tuple[str, tuple]:
+    return where + " AND `id` IN (" + ",".join("%s" for _ in objs) + ")", args + tuple(obj.id for obj in objs)
+
+
+  async def write_deletes(self, ids : list, extend_query : dict = {}, softdelete : bool = False):
+    db, table = self.get_table_name()
+    where, args = self.get_where(extend_query)
+    where, args = where + " AND `id` IN (" + ",".join("%s" for _ in ids) + ")", args + tuple(ids)
+    if softdelete:
+      await execute_sql(db, "UPDATE %s SET %s=true WHERE %s" % (quote_table(table), quote_name(self.softdelete()), where), Op.execute, args)
+    else:
+      await execute_sql(db, "DELETE FROM %s WHERE %s" % (quote_table(table), where), Op.execute, args)
+
+
+  @classmethod
+  async def begin_transaction(cls, tx : Transaction):
+    tx.acquired = acquire(tx.alias)
+    tx.handle = await tx.acquired.__aenter__()
+    await tx.handle.begin()
+
+  @classmethod
+  async def commit_transaction(cls, tx : Transaction):
+    try:
+      await tx.handle.commit()
+    finally:
+      # a connection released in the middle of a failed commit is closed by the pool
+      tx.handle = None
+      await tx.acquired.__aexit__(None, None, None)
+
+  @classmethod
+  async def rollback_transaction(cls, tx : Transaction):
+    if tx.handle is None:
+      return
+    try:
+      await tx.handle.rollback()
+    finally:
+      await tx.acquired.__aexit__(None, None, None)
+
+
+  @instrumented("update_many")
+  async def update_many(self, query : dict, set_fields : dict, include_deleted : bool = False, hooks : bool = True) -> int:
+    db, table = self.get_table_name()
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    where, args = self.get_where(query)
+    objs = None
+    if hooks and self.has_hooks("pre_save", "post_save"):
+      objs = await self.load_matching(db, table, where, args)
+      if not objs:
+        return 0
+      for i, obj in enumerate(objs):
+        for k, v in set_fields.items():
+          setattr(obj, k, v)
+        objs[i] = await self.async_execute_hooks("pre_save", obj, created=False)
+      where, args = self.get_ids_where(where, args, objs)
+    upff, uargs = self.get_field_pairs(set_fields)
+    rsp = await execute_sql(db, "UPDATE %s SET %s WHERE %s" % (quote_table(table), upff, where), Op.execute, uargs+args)
+    await self.invalidate_cache()
+    self.forget()
+    if objs:
+      for obj in objs:
+        await self.async_execute_hooks("post_save", obj, created=False)
+    return rsp.rowcount
+
+
+  @instrumented("delete_many")
+  async def delete_many(self, query : dict, force_harddelete : bool = False, include_deleted : bool = False, hooks : bool = True) -> int:
+    db, table = self.get_table_name()
+    softdelete = self.softdelete() and not force_harddelete
+    if self.softdelete() and not include_deleted:
+      query = {self.softdelete(): False, **query}
+    where, args = self.get_where(query)
+    objs = None
+    if hooks and self.has_hooks("pre_remove", "post_remove"):
+      objs = await self.load_matching(db, table, where, args)
+      if not objs:
+        return 0
+      for i, obj in enumerate(objs):
+        objs[i] = await self.async_execute_hooks("pre_remove", obj, softdelete=softdelete)
+      where, args = self.get_ids_where(where, args, objs)
+    if softdelete:
+      rsp = await execute_sql(db, "UPDATE %s SET %s=true WHERE %s" % (quote_table(table), quote_name(self.softdelete()), where), Op.execute, args)
+    else:
+      rsp = await execute_sql(db, "DELETE FROM %s WHERE %s" % (quote_table(table), where), Op.execute, args)
+    await self.invalidate_cache()
+    self.forget()
+    if objs:
+      for obj in objs:
+        await self.async_execute_hooks("post_remove", obj, softdelete=softdelete)
+    return rsp.rowcount
@@ -0,0 +1,128 @@
+'''
+Per request query log. While a log is active every Odim operation of the request is recorded with its query shape
+(the query fields and sort, without the values) and duration. Shapes repeated at least repeat_threshold times, like a
+get() per row of a listing, are reported as N+1 suspects with a warning.
+
+Activate it for a whole application with the ASGI middleware, which also adds a Server-Timing header:
+
+    app.add_middleware(QueryLogMiddleware, repeat_threshold=5)
+
+for some routes with `dependencies=[Depends(query_log)]`, with `OdimRouter.mount_crud(..., server_timing=True)` or
+in code with `with query_log_scope() as ql:`.
+'''
+import contextvars
+import logging
+from typing import List, Optional
+
+from odim.helper import context_scope
+
+log = logging.getLogger("uvicorn")
+
+current_query_log = contextvars.ContextVar("odim_query_log", default=None)
+
+
+def get_query_log() -> Optional["QueryLog"]:
+  return current_query_log.get()
+
+
+def query_shape(args : tuple, kwargs : dict) -> str:
+  ''' The fields and sort of the query an operation was called with, "" for calls by id '''
+  query = args[0] if args and isinstance(args[0], dict) else kwargs.get("query")
+  params = args[1] if len(args) > 1 else kwargs.get("params")
+  shape = ",".join(sorted(query.keys())) if isinstance(query, dict) else ""
+  sort = getattr(params, "sort", None)
+  if sort:
+    shape+= " sort="+sort
+  return shape
+
+
+class QueryRecord(object):
+  __slots__ = ("model", "operation", "shape", "duration", "db", "nested")
+
+  def __init__(self, model : str, operation : str, shape : str, duration : float, db : float, nested : bool):
+    self.model = model
+    self.operation = operation
+    self.shape = shape
+    self.duration = duration
+    self.db = db
+    self.nested = nested # run by another operation (prefetch, loader), its time is part of that one
+
+  def as_dict(self):
+    return {"model" : self.model, "operation" : self.operation, "shape" : self.shape, "duration" : self.duration, "db" : self.db, "nested" : self.nested}
+
+
+class QueryLog(object):
+
+  def __init__(self, repeat_threshold : int = 5):
+    self.repeat_threshold = repeat_threshold
+    self.records = []
+
+  def record(self, model : str, operation : str, shape : str, duration : float, db : float, nested : bool = False):
+    self.records.append(QueryRecord(model, operation, shape, duration, db, nested))
+
+  def repeated(self) -> List[dict]:
+    ''' The shapes run at least repeat_threshold times, most repeated first '''
+    groups = {}
+    for r in self.records:
+      g = groups.setdefault((r.model, r.operation, r.shape), {"model" : r.model, "operation" : r.operation, "shape" : r.shape, "count" : 0, "duration" : 0.0})
+      g["count"]+= 1
+      g["duration"]+= r.duration
+    return sorted([ g for g in groups.values() if g["count"] >= self.repeat_threshold ], key=lambda g: -g["count"])
+
+  def stats(self) -> dict:
+    top = [ r for r in self.records if not r.nested ]
+    return {"queries" : len(self.records), "duration" : sum( r.duration for r in top ), "db" : sum( r.db for r in self.records )}
+
+  def server_timing(self) -> str:
+    ''' The Server-Timing header value, total and database time in milliseconds and the worst N+1 suspect '''
+    st = self.stats()
+    rsp = 'odim;dur=%.1f;desc="%d queries", odim-db;dur=%.1f' % (1000*st["duration"], st["queries"], 1000*st["db"])
+    repeated = self.repeated()
+    if repeated:
+      g = repeated[0]
+      rsp+= ', odim-repeated;dur=%.1f;desc="%s.%s x%d"' % (1000*g["duration"], g["model"], g["operation"], g["count"])
+    return rsp
+
+  def warn_repeated(self, where : str = ""):
+    for g in self.repeated():
+      log.warning("Possible N+1%s: %s.%s(%s) ran %d times, %.1fms", " in "+where if where else "", g["model"], g["operation"], g["shape"], g["count"], 1000*g["duration"])
+
+
+class query_log_scope(context_scope):
+  ''' Activates a fresh query log for the enclosed code, usable with `with` and `async with` '''
+  var = current_query_log
+
+  def __init__(self, query_log : Optional[QueryLog] = None, repeat_threshold : int = 5):
+    super().__init__(query_log or QueryLog(repeat_threshold))
+    self.query_log = self.value
+
+
+async def query_log():
+  ''' FastAPI dependency scoping a query log to the request, the N+1 suspects are logged when it ends '''
+  with query_log_scope() as ql:
+    yield ql
+  ql.warn_repeated()
+
+
+class QueryLogMiddleware(object):
+  ''' ASGI middleware logging the queries of every request, adding the Server-Timing header and warning about N+1
+  suspects. The header is added when the response starts, queries of streamed bodies are only in the warnings '''
+
+  def __init__(self, app, server_timing : bool = True, repeat_threshold : int = 5):
+    self.app = app
+    self.server_timing = server_timing
+    self.repeat_threshold = repeat_threshold
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      return await self.app(scope, receive, send)
+    ql = QueryLog(self.repeat_threshold)
+
+    async def send_timed(message):
+      if message["type"] == "http.response.start" and self.server_timing:
+        message = {**message, "headers" : list(message.get("headers", [])) + [(b"server-timing", ql.server_timing().encode("latin-1"))]}
+      await send(message)
+
+    with query_log_scope(ql):
+      await self.app(scope, receive, send_timed)
+    ql.warn_repeated("%s %s" % (scope.get("method"), scope.get("path")))
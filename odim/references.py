@@ -0,0 +1,91 @@
+'''
+Reference prefetching. A field holding the id (or a list of ids) of another model's documents is declared with `ref`,
+then `find(..., prefetch=["author"])` collects the referenced ids of the whole page, loads them with one get_many per
+referenced model and attaches them to the instances, readable with `obj.referenced("author")`.
+
+    class Post(BaseMongoModel):
+      author : Optional[ObjectId] = Field(None, ref=Author)   # or ref="app.models.Author"
+
+Schemas loaded with ModelFactory.load_mongo_model declare it as {"type" : "ObjectId", "ref" : "Author"}, naming the
+class (or collection) of another loaded schema.
+
+The `ref` is moved out of the field into field_references when the model class is created, a model class in the
+field's extras would break the OpenAPI schema of the routes exposing the model.
+'''
+import importlib
+import inspect
+from typing import List
+
+models_by_name = {}
+field_references = {} # (model, field name) -> referenced model or its name
+
+def register_model(name : str, model):
+  ''' Makes the model resolvable by name in `ref` declarations '''
+  models_by_name[name] = model
+
+
+def resolve_model(ref):
+  if inspect.isclass(ref):
+    return ref
+  if ref in models_by_name:
+    return models_by_name[ref]
+  if isinstance(ref, str) and "." in ref:
+    module, name = ref.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+  raise AttributeError("Unknown referenced model '%s'" % ref)
+
+
+def collect_references(model):
+  ''' Moves the `ref` declarations of the model's fields into field_references, keeping them out of the JSON schema '''
+  for name, field in model.__fields__.items():
+    ref = field.field_info.extra.pop("ref", None)
+    if ref is not None:
+      field_references[(model, name)] = ref
+
+
+def get_reference(model, name : str):
+  ''' The model referenced by the field `name`, declared on the model or inherited '''
+  ref = None
+  if name in model.__fields__:
+    for cls in model.__mro__:
+      ref = field_references.get((cls, name))
+      if ref is not None:
+        break
+  if ref is None:
+    raise AttributeError("%s.%s is not declared as a reference (Field(..., ref=Model))" % (model.__name__, name))
+  return resolve_model(ref)
+
+
+def referenced_ids(value) -> list:
+  if value is None:
+    return []
+  if isinstance(value, (list, tuple, set)):
+    return [ v for v in value if v is not None ]
+  return [value]
+
+
+async def prefetch(objs : list, model, names : List[str]):
+  ''' Loads the documents referenced by the `names` fields of objs with one get_many per referenced model '''
+  from odim import Odim
+  targets = {}
+  for name in names:
+    targets.setdefault(get_reference(model, name), []).append(name)
+  for target, fields in targets.items():
+    ids = {}
+    for obj in objs:
+      for name in fields:
+        for id in referenced_ids(getattr(obj, name, None)):
+          ids.setdefault(str(id), id)
+    found = {}
+    if ids:
+      for x in await Odim(target).get_many(list(ids.values())):
+        if x is not None:
+          found[str(x.id)] = x
+    for obj in objs:
+      for name in fields:
+        value = getattr(obj, name, None)
+        if isinstance(value, (list, tuple, set)):
+          obj._references[name] = [ found.get(str(id)) for id in referenced_ids(value) ]
+        else:
+          obj._references[name] = found.get(str(value)) if value is not None else None
+  return objs
@@ -1,14 +1,45 @@
 '''
 Contains the extended FastAPI router, for simplified CRUD from a model
 '''
+import asyncio
 from typing import Any, List, Optional, Sequence, Set, Type, Union
 
 import fastapi
 from fastapi import Depends, params
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, create_model
 
 from odim import Odim, OkResponse, SearchResponse
 from odim.dependencies import SearchParams
+from odim.identity import identity_map as odim_identity_map
+from odim.querylog import query_log_scope
+
+
+def check_search_params(model, search_params : SearchParams):
+  ''' Unknown fields to return or a pagination cursor not matching the sort of the request are the client's error '''
+  for f in search_params.fields or []:
+    if f not in model.__fields__:
+      raise fastapi.HTTPException(status_code=400, detail="Unknown field '%s' in fields" % f)
+  try:
+    Odim(model).get_keyset_values(search_params)
+  except ValueError as e:
+    raise fastapi.HTTPException(status_code=400, detail=str(e))
+
+
+class QueryLogRoute(fastapi.routing.APIRoute):
+  ''' Route logging the Odim queries of each request, adding them as Server-Timing header and warning about N+1 suspects '''
+
+  def get_route_handler(self):
+    handler = super().get_route_handler()
+    async def timed_handler(request : fastapi.Request):
+      with query_log_scope() as ql:
+        response = await handler(request)
+      response.headers["Server-Timing"] = ql.server_timing()
+      ql.warn_repeated("%s %s" % (request.method, request.url.path))
+      return response
+    return timed_handler
+
 
 class OdimRouter(fastapi.APIRouter):
   ''' Simplified FastAPI router for easy CRUD '''
@@ -22,7 +53,14 @@ class OdimRouter(fastapi.APIRouter):
                  include_in_schema: bool = True,
                  methods : Optional[Union[Set[str], List[str]]] = ('create','get','search','save','update','delete'),
                  methods_exclude : Optional[Union[Set[str], List[str]]] = [],
-                 extend_query : dict= {}):
+                 extend_query : dict= {},
+                 cache_ttl : Optional[int] = None,
+                 stream : Optional[str] = None,
+                 stream_batch_size : int = 100,
+                 total : str = "exact",
+                 total_cap : int = 10000,
+                 identity_map : bool = False,
+                 server_timing : bool = False):
     ''' Add endpoints for CRUD operations for particular model
     :param path: base_path, for the model resource location eg: /api/houses/
     :param model: pydantic/Odim BaseModel, that is used for eg. Houses
@@ -32,8 +70,20 @@ class OdimRouter(fastapi.APIRouter):
     :param methods: methods to automatically generate ('create','get','search','save','update','delete')
     :param methods_exclude: methods to NOT automatically generate ('create','get','search','save','update','delete')
     :param extend_query: adds these parameters to every query and sets it on the object upon creation. keys are fields, values can be exact values or functions taking request as parameter
+    :param cache_ttl: serve search results from the result cache for this many seconds (defaults to the model's Config.cache_ttl)
+    :param stream: "ndjson" or "json" makes the search endpoint stream the results (one object per line, or a JSON array) while iterating the cursor, instead of returning a SearchResponse. limit=0 streams all matching documents
+    :param stream_batch_size: how many documents are fetched per cursor batch when streaming
+    :param total: how the search endpoint counts the total: "exact", "estimated" (database statistics, filtered Mongo searches are counted up to total_cap), "capped" (stops counting at total_cap) or "none"
+    :param total_cap: the limit for the capped total
+    :param identity_map: scope an identity map to each request, repeated gets of the same id return the same instance
+    :param server_timing: log the Odim queries of each request, report them in a Server-Timing header and warn about N+1 suspects
     '''
     add_methods = [ x for x in methods if x not in methods_exclude ]
+    if identity_map:
+      dependencies = list(dependencies or []) + [Depends(odim_identity_map)]
+    route_class = QueryLogRoute if server_timing else None
+    if total not in ("exact", "estimated", "capped", "none"):
+      raise AttributeError("Unknown total mode '%s', use one of exact, estimated, capped, none" % total)
 
     if 'create' in add_methods:
       async def create(request : fastapi.Request, obj : model):
@@ -50,7 +100,8 @@ class OdimRouter(fastapi.APIRouter):
                          summary="Create new %s" % model.schema().get('title'),
                          description = "Create new instance of %s " %  model.schema().get('title'),
                          methods = ["POST"],
-                         include_in_schema = include_in_schema)
+                         include_in_schema = include_in_schema,
+                         route_class_override = route_class)
 
     if 'get' in add_methods:
       async def get(request : fastapi.Request, id : str):
@@ -63,14 +114,43 @@ class OdimRouter(fastapi.APIRouter):
                          summary="Get %s by id" % model.schema().get('title'),
                          description = "Return individual %s details " % model.schema().get('title'),
                          methods = ["GET"],
-                         include_in_schema = include_in_schema)
+                         include_in_schema = include_in_schema,
+                         route_class_override = route_class)
 
-    if 'search' in add_methods:
+    if 'search' in add_methods and stream:
+      async def search_stream(request : fastapi.Request, search_params : dict = Depends(SearchParams)):
+        check_search_params(model, search_params)
+        sp = {**search_params.q, **exec_extend_query(request,extend_query)}
+        return stream_response(Odim(model).iterate(sp, search_params, batch_size=stream_batch_size, fields=search_params.fields), stream)
+      self.add_api_route(path = path,
+                         endpoint=search_stream,
+                         response_class=StreamingResponse,
+                         tags=tags,
+                         dependencies = dependencies,
+                         summary="Search for %ss" % model.schema().get('title'),
+                         description = "Streams the listing search results for %s as %s" %  (model.schema().get('title'), stream),
+                         methods = ["GET"],
+                         include_in_schema = include_in_schema,
+                         route_class_override = route_class)
+    elif 'search' in add_methods:
       async def search(request : fastapi.Request, search_params : dict = Depends(SearchParams)):
+        check_search_params(model, search_params)
         sp = {**search_params.q, **exec_extend_query(request,extend_query)}
-        rsp = { "results" : await Odim(model).find(sp, search_params),
-                "total" : await Odim(model).count(sp),
+        fields = search_params.fields
+        if fields and search_params.sort:
+          # the sort keys are needed for the next_cursor
+          fields = fields + [ f.lstrip("-") for f in search_params.sort.split(",") if f.lstrip("-") in model.__fields__ ]
+        results, cnt = await asyncio.gather(Odim(model).find(sp, search_params, fields=fields, cache_ttl=cache_ttl),
+                                            Odim(model).total(sp, total, total_cap, cache_ttl=cache_ttl))
+        rsp = { "results" : results,
+                "total" : cnt,
                 "search" : search_params.dict()}
+        if getattr(results, "cached", None):
+          rsp["cached"] = results.cached
+        rsp["next_cursor"] = Odim(model).next_cursor(results, search_params)
+        if search_params.fields:
+          # the partial documents would not validate against the full response model
+          return JSONResponse(jsonable_encoder(rsp, by_alias=True))
         return rsp
       self.add_api_route(path = path,
                          endpoint=search,
@@ -80,7 +160,8 @@ class OdimRouter(fastapi.APIRouter):
                          summary="Search for %ss" % model.schema().get('title'),
                          description = "Performs a listing search for %s " %  model.schema().get('title'),
                          methods = ["GET"],
-                         include_in_schema = include_in_schema)
+                         include_in_schema = include_in_schema,
+                         route_class_override = route_class)
 
     if 'save' in add_methods:
       async def save(request : fastapi.Request, id : str, obj : model):
@@ -95,7 +176,8 @@ class OdimRouter(fastapi.APIRouter):
                      summary="Replace %s by id" % model.schema().get('title'),
                      description = "PUT replaces the original %s as whole  " %  model.schema().get('title'),
                      methods = ["PUT"],
-                     include_in_schema = include_in_schema)
+                     include_in_schema = include_in_schema,
+                     route_class_override = route_class)
 
     if 'update' in add_methods:
       async def update(request : fastapi.Request, id : str, obj : model):
@@ -110,7 +192,8 @@ class OdimRouter(fastapi.APIRouter):
                      summary="Partial update %s by id" % model.schema().get('title'),
                      description = "Just updates individual fields of %s " %  model.schema().get('title'),
                      methods = ["Patch"],
-                     include_in_schema = include_in_schema)
+                     include_in_schema = include_in_schema,
+                     route_class_override = route_class)
 
     if 'delete' in add_methods:
       async def delete(request : fastapi.Request, id : str) -> None:
@@ -125,7 +208,8 @@ class OdimRouter(fastapi.APIRouter):
                      summary="Delete %s by id" % model.schema().get('title'),
                      description = "Deletes individual instance of %s " %  model.schema().get('title'),
                      methods = ["DELETE"],
-                     include_in_schema = include_in_schema)
+                     include_in_schema = include_in_schema,
+                     route_class_override = route_class)
 
 
 
@@ -212,6 +296,25 @@ async def delete_{model_name}(id : str):
 
 
 
+STREAM_MEDIA_TYPES = {"ndjson" : "application/x-ndjson", "json" : "application/json"}
+
+def stream_response(iterator, fmt : str = "ndjson"):
+  ''' Wraps an Odim iterate() generator into a StreamingResponse, serialized as NDJSON or as one JSON array '''
+  if fmt not in STREAM_MEDIA_TYPES:
+    raise AttributeError("Unknown stream format '%s', use one of %s" % (fmt, ", ".join(STREAM_MEDIA_TYPES.keys())))
+  async def ndjson():
+    async for obj in iterator:
+      yield obj.json(by_alias=True) + "\n"
+  async def json_array():
+    first = True
+    yield "["
+    async for obj in iterator:
+      yield ("" if first else ",") + obj.json(by_alias=True)
+      first = False
+    yield "]"
+  return StreamingResponse(ndjson() if fmt == "ndjson" else json_array(), media_type=STREAM_MEDIA_TYPES[fmt])
+
+
 def exec_extend_query(request : fastapi.Request, sl : dict = {}):
   out = {}
   for k, v in sl.items():
@@ -0,0 +1,150 @@
+'''
+Unit of work over one DATABASES alias. Inside `async with odim.transaction("main") as tx:` the save, update and delete
+calls of models stored in that alias are queued instead of written. On leaving the block they are flushed in bulk
+(consecutive writes of the same model and kind go in one statement/bulk_write) and committed once, on MySQL over one
+pinned pooled connection, on Mongo in a client session transaction (which needs a replica set). The pre_save and
+pre_remove hooks run when the call is made, post_save and post_remove only after the commit succeeded. An exception
+inside the block discards the queue, nothing is written.
+
+MySQL auto increment ids of new rows are only known after the commit, save() returns None for them inside the block.
+Mongo ids are generated upfront, so related documents can reference each other.
+'''
+import contextvars
+import itertools
+from typing import Optional
+
+from pydantic import BaseModel
+
+from odim.helper import resolve_connector_for_alias
+
+active_transactions = contextvars.ContextVar("odim_transactions", default={})
+
+
+def get_transaction(alias) -> Optional["Transaction"]:
+  ''' The transaction open for the alias in the current context, if any '''
+  return active_transactions.get().get(alias)
+
+
+class Transaction(object):
+
+  def __init__(self, alias : str):
+    self.alias = alias
+    self.connector = resolve_connector_for_alias(alias)
+    self.operations = []
+    self.deferred = []
+    self.handle = None # the pinned connection or session while flushing
+    self.outer = None
+    self.token = None
+
+  async def __aenter__(self):
+    outer = get_transaction(self.alias)
+    if outer is not None:
+      # nested blocks join the outer transaction
+      self.outer = outer
+      return outer
+    self.token = active_transactions.set({**active_transactions.get(), self.alias : self})
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    if self.outer is not None:
+      return False
+    try:
+      if exc_type is None:
+        await self.flush()
+    finally:
+      active_transactions.reset(self.token)
+      self.token = None
+      if exc_type is not None:
+        self.rollback()
+    if exc_type is None:
+      await self.run_deferred()
+    return False
+
+
+  async def save(self, odim, extend_query : dict = {}, include_deleted : bool = False):
+    obj = odim.instance
+    created = obj.id in (None, "")
+    iii = await odim.async_execute_hooks("pre_save", obj, created=created)
+    if created:
+      iii.id = obj.id = odim.new_id()
+    self.operations.append((odim, "save", (obj, iii, created), {"extend_query" : extend_query, "include_deleted" : include_deleted}))
+    return obj.id
+
+  async def update(self, odim, extend_query : dict = {}, include_deleted : bool = False, only_fields=None):
+    iii = await odim.async_execute_hooks("pre_save", odim.instance, created=False)
+    self.operations.append((odim, "update", (iii, only_fields), {"extend_query" : extend_query, "include_deleted" : include_deleted}))
+
+  async def delete(self, odim, obj, extend_query : dict = {}, force_harddelete : bool = False):
+    id = obj.id if isinstance(obj, BaseModel) else obj
+    softdelete = bool(odim.softdelete()) and not force_harddelete
+    x = None
+    if odim.has_hooks("pre_remove", "post_remove"):
+      x = await odim.get(id, extend_query)
+      x = await odim.async_execute_hooks("pre_remove", x, softdelete=softdelete)
+    self.operations.append((odim, "delete", (id, x), {"extend_query" : extend_query, "softdelete" : softdelete}))
+
+
+  async def flush(self):
+    ''' Writes the queued operations and commits them, the post hooks run afterwards (on leaving the block) '''
+    if not self.operations:
+      return
+    operations, self.operations = self.operations, []
+    mapped = []
+    await self.connector.begin_transaction(self)
+    try:
+      for (model, kind, kwargs), group in itertools.groupby(operations, key=lambda o: (o[0].model, o[1], o[3])):
+        group = list(group)
+        odim = group[0][0]
+        items = [ item for _, _, item, _ in group ]
+        if kind == "save":
+          await odim.write_many([ (iii, created) for _, iii, created in items ], ordered=True, **kwargs)
+          for obj, iii, created in items:
+            obj.id = iii.id
+            mapped.append((odim.remember, obj))
+            self.deferred.append((odim, "post_save", iii, {"created" : created}))
+        elif kind == "update":
+          await odim.write_updates(items, **kwargs)
+          for iii, _ in items:
+            mapped.append((odim.remember_update, iii))
+            self.deferred.append((odim, "post_save", iii, {"created" : False}))
+        elif kind == "delete":
+          await odim.write_deletes([ id for id, _ in items ], **kwargs)
+          for id, x in items:
+            mapped.append((odim.forget, id))
+            if x is not None:
+              self.deferred.append((odim, "post_remove", x, {"softdelete" : kwargs["softdelete"]}))
+      await self.connector.commit_transaction(self)
+    except BaseException:
+      self.deferred = []
+      await self.connector.rollback_transaction(self)
+      raise
+    finally:
+      self.handle = None
+    # the identity map only follows what was committed
+    for fnc, obj in mapped:
+      fnc(obj)
+    invalidated = set()
+    for odim, _, _, _ in operations:
+      if odim.binding not in invalidated:
+        invalidated.add(odim.binding)
+        await odim.invalidate_cache()
+
+  async def commit(self):
+    ''' Flushes and commits what was queued so far, the block stays open for further writes '''
+    await self.flush()
+    await self.run_deferred()
+
+  def rollback(self):
+    ''' Drops the queued, not yet flushed operations '''
+    self.operations = []
+    self.deferred = []
+
+  async def run_deferred(self):
+    deferred, self.deferred = self.deferred, []
+    for odim, hook_type, obj, kwargs in deferred:
+      await odim.async_execute_hooks(hook_type, obj, **kwargs)
+
+
+def transaction(alias : str) -> Transaction:
+  ''' Unit of work over the DATABASES alias, use as `async with odim.transaction("main") as tx:` '''
+  return Transaction(alias)
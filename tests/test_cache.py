@@ -0,0 +1,15 @@
+from datetime import datetime
+from decimal import Decimal
+
+from bson import ObjectId
+
+from odim.cache import cache_key
+
+
+def test_cache_key_tells_types_apart():
+  id = ObjectId()
+  assert cache_key("find", ({"_id" : id}, ), {}) != cache_key("find", ({"_id" : str(id)}, ), {})
+  now = datetime.now()
+  assert cache_key("find", ({"at" : now}, ), {}) != cache_key("find", ({"at" : str(now)}, ), {})
+  assert cache_key("find", ({"price" : Decimal("1.5")}, ), {}) != cache_key("find", ({"price" : "1.5"}, ), {})
+  assert cache_key("find", ({"_id" : id}, ), {}) == cache_key("find", ({"_id" : ObjectId(str(id))}, ), {})
@@ -0,0 +1,17 @@
+import pytest
+
+from odim.helper import configure_databases, parse_connection_info
+from odim.mysql import get_pool_kwargs
+
+
+def test_option_values_are_typed():
+  configure_databases({"sql" : "mysql://u:p@localhost/sql?autocommit=false&maxsize=20&connect_timeout=2.5&charset=utf8mb4&retries=None"})
+  options = parse_connection_info("sql").options
+  assert options == {"autocommit" : False, "maxsize" : 20, "connect_timeout" : 2.5, "charset" : "utf8mb4", "retries" : None}
+  assert get_pool_kwargs("sql", options) == {"autocommit" : False, "maxsize" : 20, "connect_timeout" : 2.5, "charset" : "utf8mb4"}
+
+
+@pytest.mark.parametrize("options", [{"autocommit" : "yes"}, {"maxsize" : True}, {"maxsize" : 2.5}, {"max_size" : 20}])
+def test_invalid_pool_options(options):
+  with pytest.raises(AttributeError):
+    get_pool_kwargs("sql", options)
@@ -0,0 +1,43 @@
+import asyncio
+
+from odim.mongo import MotorMongoCollection
+
+
+class MotorCursor(object):
+  ''' Like motor's cursor, close() is a coroutine '''
+
+  def __init__(self, docs):
+    self.docs = docs
+    self.closed = False
+
+  def __aiter__(self):
+    return self.iterate()
+
+  async def iterate(self):
+    for doc in self.docs:
+      yield doc
+
+  async def close(self):
+    self.closed = True
+
+
+class MotorCollection(object):
+  name = "items"
+
+  def __init__(self, docs):
+    self.cursor = MotorCursor(docs)
+
+  def find(self, *args, **kwargs):
+    return self.cursor
+
+
+def test_motor_iterate_closes_cursor_on_early_exit():
+  collection = MotorCollection([{"n" : i} for i in range(10)])
+  async def run():
+    it = MotorMongoCollection(collection).iterate({})
+    async for doc in it:
+      if doc["n"] == 2:
+        break
+    await it.aclose()
+  asyncio.run(run())
+  assert collection.cursor.closed
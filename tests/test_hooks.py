@@ -0,0 +1,64 @@
+import asyncio
+import threading
+
+from odim import BaseOdimModel
+from odim.helper import awaited
+
+
+class Inner(BaseOdimModel):
+  name : str
+
+  class Config:
+    pass
+
+
+class Outer(BaseOdimModel):
+  name : str
+  inner : Inner
+
+  class Config:
+    pass
+
+
+async def inner_pre_validate(cls, values):
+  values["name"] = values["name"].upper()
+  return values
+
+
+async def outer_pre_validate(cls, values):
+  # builds another model with an async hook while running on the hook thread
+  values["inner"] = Inner(name=values["name"])
+  return values
+
+Inner.add_hook("pre_validate", inner_pre_validate)
+Outer.add_hook("pre_validate", outer_pre_validate)
+
+
+def run_with_timeout(coro, timeout=5):
+  result = {}
+  thread = threading.Thread(target=lambda: result.setdefault("value", asyncio.run(coro)), daemon=True)
+  thread.start()
+  thread.join(timeout)
+  assert not thread.is_alive(), "nested async hooks deadlocked"
+  return result["value"]
+
+
+def test_nested_async_hooks_in_running_loop():
+  async def build():
+    return Outer(name="a")
+  obj = run_with_timeout(build())
+  assert obj.inner.name == "A"
+
+
+def test_nested_async_hooks_without_loop():
+  assert Outer(name="b").inner.name == "B"
+
+
+def test_awaited_values_and_coroutines():
+  async def value():
+    return 1
+  assert awaited(2) == 2
+  assert awaited(value()) == 1
+  async def in_loop():
+    return awaited(value())
+  assert asyncio.run(in_loop()) == 1
@@ -0,0 +1,29 @@
+import asyncio
+from typing import Optional
+
+from odim import Odim
+from odim.mysql import BaseMysqlModel
+
+
+class Code(BaseMysqlModel):
+  id : Optional[int]
+  code : str
+  tenant : Optional[str]
+
+  class Config:
+    db_name = "sql"
+    table_name = "codes"
+    softdelete = "deleted"
+    indexes = [
+      {"fields" : ["code"], "unique" : True, "partial" : {"deleted" : False}},
+      {"fields" : ["tenant"], "partial" : {"deleted" : False}},
+      {"fields" : ["tenant"], "unique" : True, "name" : "tenant_unique"},
+    ]
+
+
+def test_mysql_skips_unique_partial_index(mysql_pool):
+  rsp = asyncio.run(Odim(Code).ensure_indexes())
+  created = [ sql for sql, _ in mysql_pool.statements if sql.startswith("CREATE") ]
+  assert len(rsp["skipped"]) == 1 and len(rsp["created"]) == 2
+  assert not any( "`code`" in sql for sql in created )
+  assert any( sql.startswith("CREATE UNIQUE INDEX `tenant_unique`") for sql in created )
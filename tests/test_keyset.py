@@ -0,0 +1,64 @@
+import asyncio
+from typing import Optional
+
+import pytest
+
+from odim import Odim, SearchParams
+from odim.mongo import BaseMongoModel
+from odim.mysql import BaseMysqlModel
+
+
+class Item(BaseMongoModel):
+  value : Optional[int]
+
+  class Config:
+    db_name = "main"
+    collection_name = "items"
+
+
+class Row(BaseMysqlModel):
+  id : Optional[int]
+  value : Optional[int]
+
+  class Config:
+    db_name = "sql"
+    table_name = "rows"
+
+
+def test_offset_pages_keep_the_plain_sort():
+  odim = Odim(Item)
+  assert odim.get_find_params(SearchParams(sort="value"))["sort"] == [("value", 1)]
+  assert "sort" not in odim.get_find_params(SearchParams())
+  assert odim.get_find_params(SearchParams(sort="value", keyset=True))["sort"] == [("value", 1), ("_id", 1)]
+  sql, _ = Odim(Row).get_select_sql("rows", {}, SearchParams())
+  assert "ORDER BY" not in sql
+  sql, _ = Odim(Row).get_select_sql("rows", {}, SearchParams(sort="-value"))
+  assert sql.endswith("ORDER BY `value` DESC LIMIT %s")
+
+
+@pytest.mark.parametrize("sort", ["value", "-value"])
+def test_keyset_pages_through_nulls(mongo_db, sort):
+  mongo_db.items.insert_many([ {"value" : None if i % 3 == 0 else i % 4} for i in range(11) ])
+  async def run():
+    odim = Odim(Item)
+    params = SearchParams(limit=3, sort=sort, keyset=True)
+    seen = []
+    while True:
+      page = await odim.find({}, params)
+      seen+= page
+      cursor = odim.next_cursor(page, params)
+      if cursor is None:
+        return seen
+      params = SearchParams(limit=3, sort=sort, after=cursor)
+  seen = asyncio.run(run())
+  assert sorted( str(x.id) for x in seen ) == sorted( str(d["_id"]) for d in mongo_db.items.find() )
+
+
+def test_mysql_keyset_null_conditions():
+  odim = Odim(Row)
+  cursor = odim.next_cursor([Row(id=4, value=None)], SearchParams(limit=1, sort="value", keyset=True))
+  sql, args = odim.get_select_sql("rows", {}, SearchParams(limit=1, sort="value", after=cursor))
+  assert "(`value` IS NOT NULL) OR (`value` IS NULL AND `id` > %s)" in sql and args == (4, 1)
+  cursor = odim.next_cursor([Row(id=4, value=2)], SearchParams(limit=1, sort="-value", keyset=True))
+  sql, args = odim.get_select_sql("rows", {}, SearchParams(limit=1, sort="-value", after=cursor))
+  assert "((`value` < %s OR `value` IS NULL)) OR (`value`=%s AND `id` > %s)" in sql and args == (2, 2, 4, 1)
@@ -0,0 +1,39 @@
+from typing import Optional
+
+import pytest
+
+import odim
+from odim import Odim
+from odim.mongo import BaseMongoModel
+
+
+class Item(BaseMongoModel):
+  a : Optional[int]
+  b : Optional[int]
+  c : Optional[int]
+
+  class Config:
+    db_name = "main"
+    collection_name = "items"
+
+
+def test_projected_models_are_keyed_on_the_field_set():
+  assert Odim(Item).get_projected_model(["a", "b"]) is Odim(Item).get_projected_model(["b", "a", "a"])
+  assert set(Odim(Item).get_projected_model(["b"]).__fields__) == {"id", "b"}
+
+
+def test_projected_models_are_bounded(monkeypatch):
+  monkeypatch.setattr(odim, "max_projected_models", 2)
+  odim.projected_models.clear()
+  first = Odim(Item).get_projected_model(["a"])
+  Odim(Item).get_projected_model(["b"])
+  Odim(Item).get_projected_model(["c"])
+  assert len(odim.projected_models) == 2
+  assert Odim(Item).get_projected_model(["a"]) is not first
+
+
+def test_unknown_field_is_not_cached():
+  odim.projected_models.clear()
+  with pytest.raises(AttributeError):
+    Odim(Item).get_projected_model(["secret"])
+  assert not odim.projected_models
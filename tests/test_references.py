@@ -0,0 +1,48 @@
+import asyncio
+from typing import List, Optional
+
+import fastapi
+from pydantic import Field
+
+from odim import Odim
+from odim.mongo import BaseMongoModel, ObjectId
+from odim.router import OdimRouter
+
+
+class Author(BaseMongoModel):
+  name : str
+
+  class Config:
+    db_name = "main"
+    collection_name = "authors"
+
+
+class Post(BaseMongoModel):
+  title : str
+  author : Optional[ObjectId] = Field(None, ref=Author)
+  editors : List[ObjectId] = Field([], ref="Author")
+
+  class Config:
+    db_name = "main"
+    collection_name = "posts"
+
+
+def test_openapi_of_model_with_ref():
+  app = fastapi.FastAPI()
+  router = OdimRouter()
+  router.mount_crud("/posts/", model=Post)
+  app.include_router(router)
+  schema = app.openapi()
+  properties = schema["components"]["schemas"]["Post"]["properties"]
+  assert "ref" not in properties["author"] and "ref" not in properties["editors"]
+
+
+def test_prefetch(mongo_db):
+  from odim.references import register_model
+  register_model("Author", Author)
+  a, b = ObjectId(), ObjectId()
+  mongo_db.authors.insert_many([{"_id" : a, "name" : "A"}, {"_id" : b, "name" : "B"}])
+  mongo_db.posts.insert_one({"title" : "x", "author" : a, "editors" : [b, a]})
+  posts = asyncio.run(Odim(Post).find({}, prefetch=["author", "editors"]))
+  assert posts[0].referenced("author").name == "A"
+  assert [ x.name for x in posts[0].referenced("editors") ] == ["B", "A"]
@@ -0,0 +1,65 @@
+import asyncio
+import json
+from typing import Optional
+
+import fastapi
+import httpx
+
+from odim.helper import encode_cursor
+from odim.mongo import BaseMongoModel
+from odim.router import OdimRouter
+
+
+class Item(BaseMongoModel):
+  name : str
+  value : Optional[int]
+
+  class Config:
+    db_name = "main"
+    collection_name = "items"
+
+
+def search(query : str, stream : Optional[str] = None) -> httpx.Response:
+  app = fastapi.FastAPI()
+  router = OdimRouter()
+  router.mount_crud("/items/", model=Item, stream=stream)
+  app.include_router(router)
+  async def run():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+      return await client.get("/items/?"+query)
+  return asyncio.run(run())
+
+
+def test_search_pages_with_cursor(mongo_db):
+  mongo_db.items.insert_many([ {"name" : "n%d" % i, "value" : i} for i in range(5) ])
+  rsp = search("limit=2&sort=value&keyset=true")
+  assert rsp.status_code == 200
+  rsp = search("limit=2&sort=value&after="+rsp.json()["next_cursor"])
+  assert [ x["value"] for x in rsp.json()["results"] ] == [2, 3]
+
+
+def test_search_cursor_of_another_sort(mongo_db):
+  rsp = search("sort=value,name&after="+encode_cursor([1]))
+  assert rsp.status_code == 400
+
+
+def test_search_relevance_sort_with_cursor(mongo_db):
+  rsp = search("sort=_score&q="+json.dumps({"name__search" : "x"})+"&after="+encode_cursor([1]))
+  assert rsp.status_code == 400
+
+
+def test_search_stream_cursor_of_another_sort(mongo_db):
+  rsp = search("sort=value&after="+encode_cursor([1]), stream="ndjson")
+  assert rsp.status_code == 400
+
+
+def test_search_fields(mongo_db):
+  mongo_db.items.insert_one({"name" : "a", "value" : 1})
+  rsp = search("fields=name")
+  assert rsp.status_code == 200
+  assert set(rsp.json()["results"][0].keys()) == {"_id", "name"}
+
+
+def test_search_unknown_fields(mongo_db):
+  assert search("fields=name,secret").status_code == 400
+  assert search("fields=secret", stream="ndjson").status_code == 400
@@ -0,0 +1,47 @@
+import asyncio
+from typing import Optional
+
+from bson import ObjectId
+
+from odim import Odim
+from odim.mongo import BaseMongoModel
+from odim.mysql import BaseMysqlModel
+
+
+class Item(BaseMongoModel):
+  name : str
+
+  class Config:
+    db_name = "main"
+    collection_name = "items"
+
+
+class Row(BaseMysqlModel):
+  id : Optional[int]
+  name : str
+
+  class Config:
+    db_name = "sql"
+    table_name = "rows"
+
+
+def test_mongo_save_many_str_ids_update(mongo_db):
+  ids = mongo_db.items.insert_many([{"name" : "a"}, {"name" : "b"}]).inserted_ids
+  objs = [ Item(name="A"), Item(name="B"), Item(name="c") ]
+  objs[0].id, objs[1].id = str(ids[0]), str(ids[1])
+  saved = asyncio.run(Odim(Item).save_many(objs))
+  assert saved[:2] == ids and all( isinstance(id, ObjectId) for id in saved )
+  assert sorted( x["name"] for x in mongo_db.items.find() ) == ["A", "B", "c"]
+
+
+def test_mysql_save_many_ids_step_by_auto_increment_increment(mysql_pool):
+  mysql_pool.results["SELECT @@auto_increment_increment AS step"] = {"step" : 2}
+  ids = asyncio.run(Odim(Row).save_many([ Row(name="n%d" % i) for i in range(3) ]))
+  assert ids == [1, 3, 5]
+
+
+def test_mysql_save_many_is_one_transaction(mysql_pool):
+  ids = asyncio.run(Odim(Row).save_many([ Row(name="new"), Row(id=7, name="old"), Row(id=8, name="older") ]))
+  assert ids == [1, 7, 8]
+  writes = [ sql.split(" ")[0] for sql, _ in mysql_pool.statements if not sql.startswith("SELECT") ]
+  assert writes == ["BEGIN", "INSERT", "UPDATE", "UPDATE", "COMMIT"]
@@ -0,0 +1,22 @@
+import asyncio
+
+from odim.identity import get_identity_map, identity_scope
+from odim.querylog import QueryLog, get_query_log, query_log_scope
+
+
+def test_scopes_nest_and_restore():
+  assert get_identity_map() is None and get_query_log() is None
+  with identity_scope() as outer:
+    with identity_scope() as inner:
+      assert get_identity_map() is inner and inner is not outer
+    assert get_identity_map() is outer
+  assert get_identity_map() is None
+
+
+def test_async_scope_with_given_value():
+  ql = QueryLog(repeat_threshold=2)
+  async def run():
+    async with query_log_scope(ql) as active:
+      assert active is ql and get_query_log() is ql
+    return get_query_log()
+  assert asyncio.run(run()) is None
@@ -0,0 +1,19 @@
+import asyncio
+
+from odim import Odim
+from odim.mongo import BaseMongoModel
+
+
+class Item(BaseMongoModel):
+  value : int
+
+  class Config:
+    db_name = "main"
+    collection_name = "items"
+
+
+def test_mongo_estimated_total(mongo_db):
+  mongo_db.items.insert_many([ {"value" : i % 2} for i in range(30) ])
+  assert asyncio.run(Odim(Item).total({}, "estimated")) == 30
+  assert asyncio.run(Odim(Item).total({"value" : 1}, "estimated", cap=10)) == 10
+  assert asyncio.run(Odim(Item).total({"value" : 1}, "estimated", cap=100)) == 15
@@ -0,0 +1,79 @@
+import asyncio
+from typing import Optional
+
+import pytest
+from bson import ObjectId
+
+import odim
+from odim import Odim
+from odim.mongo import BaseMongoModel
+from odim.mysql import BaseMysqlModel
+
+
+class Note(BaseMongoModel):
+  text : str
+  tenant : Optional[str]
+
+  class Config:
+    db_name = "main"
+    collection_name = "notes"
+    softdelete = "deleted"
+
+
+class Row(BaseMysqlModel):
+  id : Optional[int]
+  name : str
+  tenant : Optional[str]
+
+  class Config:
+    db_name = "sql"
+    table_name = "rows"
+    softdelete = "deleted"
+
+
+def test_mongo_save_out_of_tenant_scope_fails(mongo_db):
+  id = mongo_db.notes.insert_one({"text" : "mine", "tenant" : "a", "deleted" : False}).inserted_id
+  async def run():
+    async with odim.transaction("main"):
+      await Odim(Note(id=id, text="theirs", tenant="a")).save(extend_query={"tenant" : "b"})
+  with pytest.raises(AssertionError):
+    asyncio.run(run())
+  assert mongo_db.notes.find_one({"_id" : id})["text"] == "mine"
+  assert mongo_db.notes.count_documents({}) == 1
+
+
+def test_mongo_save_soft_deleted_fails(mongo_db):
+  id = mongo_db.notes.insert_one({"text" : "gone", "tenant" : "a", "deleted" : True}).inserted_id
+  async def run():
+    async with odim.transaction("main"):
+      await Odim(Note(id=id, text="back", tenant="a")).save(extend_query={"tenant" : "a"})
+  with pytest.raises(AssertionError):
+    asyncio.run(run())
+  assert mongo_db.notes.find_one({"_id" : id})["text"] == "gone"
+
+
+def test_mongo_save_str_id_in_scope(mongo_db):
+  id = mongo_db.notes.insert_one({"text" : "old", "tenant" : "a", "deleted" : False}).inserted_id
+  async def run():
+    async with odim.transaction("main"):
+      note = Note(text="new", tenant="a")
+      note.id = str(id)
+      return await Odim(note).save(extend_query={"tenant" : "a"})
+  saved = asyncio.run(run())
+  assert isinstance(saved, ObjectId) and saved == id
+  assert mongo_db.notes.find_one({"_id" : id})["text"] == "new"
+  assert mongo_db.notes.count_documents({}) == 1
+
+
+def test_mysql_save_is_scoped_update(mysql_pool):
+  async def run():
+    async with odim.transaction("sql"):
+      await Odim(Row(id=7, name="x", tenant="a")).save(extend_query={"tenant" : "b"})
+  asyncio.run(run())
+  writes = [ (sql, args) for sql, args in mysql_pool.statements if args is not None ]
+  assert len(writes) == 1
+  sql, args = writes[0]
+  assert sql.startswith("UPDATE") and "ON DUPLICATE KEY" not in sql
+  where = sql.split(" WHERE ", 1)[1]
+  assert "`id`" in where and "`deleted`" in where and "`tenant`" in where
+  assert args[-3:] == (7, False, "b")